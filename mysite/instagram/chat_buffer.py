@@ -0,0 +1,178 @@
+"""
+Write-behind buffer for chat messages.
+
+Consumers hand unsaved Message instances to the buffer of their worker's
+event loop instead of awaiting one INSERT per frame. The buffer writes them
+with bulk_create every FLUSH_SIZE messages or FLUSH_INTERVAL_MS, whichever
+comes first. When MAX_PENDING messages are waiting, put() blocks, which
+slows the sending socket down instead of growing memory without bound.
+
+A batch that fails to write is kept and tried again on the next flush;
+if that fails too, its messages are written one by one and only the ones
+that still fail (say, for a chat deleted meanwhile) are dropped.
+
+Buffers are held until they are drained, even after their loop closed.
+The ASGI lifespan shutdown (see asgi.py) writes what is left of its loop's
+buffer, and interpreter exit writes the buffers of loops that no longer
+run, for servers without lifespan support. A worker killed outright
+(SIGKILL, a hard timeout) loses at most the messages of its last
+FLUSH_INTERVAL_MS.
+"""
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .inbox import record_messages
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# Event loop -> MessageBuffer; strong references, so a buffer outlives its loop until drained
+_buffers = {}
+
+
+class MessageBuffer:
+    def __init__(self, flush_size, flush_interval, max_pending):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        # A batch whose first write failed
+        self._retry = []
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def put(self, message):
+        self.start()
+        await self._queue.put(message)
+        if self._queue.qsize() >= self.flush_size:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def _take(self):
+        batch = []
+        while len(batch) < self.flush_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def flush(self):
+        async with self._lock:
+            if self._retry:
+                batch, self._retry = self._retry, []
+                await database_sync_to_async(write_each)(batch)
+            batch = self._take()
+            while batch:
+                try:
+                    await database_sync_to_async(write_messages)(batch)
+                except Exception:
+                    logger.exception('Failed to persist %d chat messages; retrying them', len(batch))
+                    self._retry = batch
+                    return
+                batch = self._take()
+
+    async def drain(self):
+        """Write whatever is left, in the loop that owns the buffer; used at shutdown."""
+        while self._retry or not self._queue.empty():
+            await self.flush()
+
+    def drain_closed(self):
+        """Like drain(), for a buffer whose loop no longer runs."""
+        if self._retry:
+            batch, self._retry = self._retry, []
+            write_each(batch)
+        batch = self._take()
+        while batch:
+            write_each(batch)
+            batch = self._take()
+
+    def empty(self):
+        return not self._retry and self._queue.empty()
+
+
+def write_messages(messages):
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            record_messages(messages)
+    except Exception:
+        # Rolled back, so the ids bulk_create assigned may be taken again
+        for message in messages:
+            message.pk = None
+        raise
+
+
+def write_each(messages):
+    """Write ``messages`` together if possible, else one by one, dropping the ones that fail."""
+    try:
+        write_messages(messages)
+        return
+    except Exception:
+        pass
+    for message in messages:
+        try:
+            write_messages([message])
+        except Exception:
+            logger.exception('Dropped a chat message of chat %s', message.chat_id)
+
+
+def get_buffer():
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        for other, pending in list(_buffers.items()):
+            if other.is_closed() and pending.empty():
+                del _buffers[other]
+        config = settings.CHAT_BUFFER
+        buffer = _buffers[loop] = MessageBuffer(
+            flush_size=config['FLUSH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL_MS'] / 1000,
+            max_pending=config['MAX_PENDING'],
+        )
+    return buffer
+
+
+def drain_all():
+    """
+    Write the messages of every buffer whose loop no longer runs, then drop
+    the buffers of closed loops. A running loop drains its own buffer (see
+    ``lifespan``); asyncio queues must not be read from other threads.
+    """
+    for loop, buffer in list(_buffers.items()):
+        if loop.is_running():
+            continue
+        buffer.drain_closed()
+        if loop.is_closed():
+            _buffers.pop(loop, None)
+
+
+atexit.register(drain_all)
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan application that drains the buffers when the server shuts down."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            buffer = _buffers.get(asyncio.get_running_loop())
+            if buffer is not None:
+                await buffer.drain()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
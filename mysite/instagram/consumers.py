@@ -1,34 +1,141 @@
-import json
+import asyncio
+import time
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from . import frames, presence
+from .chat_buffer import get_buffer
+from .models import Chat, Message
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"chat_{self.room_name}"
+        self.user = self.scope.get("user")
+        self.user_id = self.user.pk if self.user is not None and self.user.is_authenticated else None
+        self.chat_id = None
+        self.last_heartbeat = 0
+        self.encoding, self.batch, subprotocol = frames.negotiate(self.scope)
+        self.outbox = []
+        self.outbox_bytes = 0
+        self.flush_task = None
+
+        # Only members of the chat may join its group
+        if self.user_id is not None:
+            self.chat_id = await self.get_chat_id()
+        if self.chat_id is None:
+            await self.close()
+            return
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
-        await self.accept()
+        # A subprotocol must be echoed back; fall back to the one that carried the token
+        await self.accept(subprotocol or self.scope.get("token_subprotocol"))
+
+        self.last_heartbeat = time.monotonic()
+        if await presence.connected(self.user_id):
+            await self.broadcast_presence(online=True)
 
     async def disconnect(self, close_code):
+        if self.chat_id is None:
+            return
         # Leave room group
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await get_buffer().flush()
+
+        if await presence.disconnected(self.user_id):
+            await self.broadcast_presence(online=False)
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
+    async def receive(self, text_data=None, bytes_data=None):
+        data = frames.decode(text_data, bytes_data)
+        event_type = data.get("type", "message")
+
+        # Any frame proves the socket is alive; refresh presence at most
+        # once per heartbeat interval instead of on every frame
+        if time.monotonic() - self.last_heartbeat >= settings.PRESENCE["HEARTBEAT"]:
+            self.last_heartbeat = time.monotonic()
+            await presence.heartbeat(self.user_id)
+
+        if event_type == "heartbeat":
+            return
+        if event_type == "typing":
+            # Coalesced across workers: one broadcast per user and room per interval
+            if await presence.allow_typing(self.room_name, self.user_id):
+                await self.broadcast("chat.typing", {"type": "typing", "user": self.user_id}, user=self.user_id)
+            return
+
+        message = data["message"]
+
+        # Queue for persistence; blocks only when the worker's buffer is full
+        await get_buffer().put(Message(chat_id=self.chat_id, author_id=self.user_id, text=message))
 
         # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": "chat.message", "message": message}
-        )
+        await self.broadcast("chat.message", {"message": message})
+
+    async def broadcast(self, event_type, payload, **extra):
+        # Encoded here once; every recipient forwards the ready-made frame
+        await self.channel_layer.group_send(self.room_group_name, {
+            "type": event_type, "frames": frames.encode(payload), **extra,
+        })
 
     # Receive message from room group
     async def chat_message(self, event):
-        message = event["message"]
+        await self.deliver(event["frames"][self.encoding])
+
+    async def chat_typing(self, event):
+        if event["user"] != self.user_id:
+            await self.deliver(event["frames"][self.encoding])
+
+    async def chat_presence(self, event):
+        if event["user"] != self.user_id:
+            await self.deliver(event["frames"][self.encoding])
+
+    async def broadcast_presence(self, online):
+        await self.broadcast("chat.presence", {
+            "type": "presence", "user": self.user_id, "online": online, "last_seen": time.time(),
+        }, user=self.user_id)
+
+    async def deliver(self, frame):
+        if not self.batch:
+            await self.send_frame(frame)
+            return
+        self.outbox.append(frame)
+        self.outbox_bytes += len(frame)
+        config = settings.CHAT_FRAMES
+        if len(self.outbox) >= config["BATCH_MAX_MESSAGES"] or self.outbox_bytes >= config["BATCH_MAX_BYTES"]:
+            await self.flush_outbox()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.CHAT_FRAMES["BATCH_INTERVAL_MS"] / 1000)
+        self.flush_task = None
+        await self.flush_outbox()
+
+    async def flush_outbox(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.outbox:
+            batch, self.outbox, self.outbox_bytes = self.outbox, [], 0
+            await self.send_frame(frames.join(self.encoding, batch))
+
+    async def send_frame(self, frame):
+        if self.encoding == "msgpack":
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
 
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({"message": message}))
\ No newline at end of file
+    @database_sync_to_async
+    def get_chat_id(self):
+        # Rooms are named after the Chat they belong to
+        if not self.room_name.isdigit():
+            return None
+        return (Chat.objects.filter(pk=int(self.room_name), person=self.user_id)
+                .values_list("pk", flat=True).first())
@@ -0,0 +1,86 @@
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import UserProfile, Follow, Post, PostLike, Comment, CommentLike
+
+
+def adjust(model, pk, **deltas):
+    """Atomically add ``deltas`` to counter columns of one row."""
+    if pk is None or not deltas:
+        return
+    model.objects.filter(pk=pk).update(
+        **{field: Greatest(F(field) + delta, 0) for field, delta in deltas.items()}
+    )
+
+
+def adjust_many(model, field, deltas):
+    """Add per-row deltas ``{pk: delta}`` to one counter column in a single UPDATE."""
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    change = Case(*[When(pk=pk, then=Value(delta)) for pk, delta in deltas.items()],
+                  default=Value(0), output_field=IntegerField())
+    model.objects.filter(pk__in=deltas).update(**{field: Greatest(F(field) + change, 0)})
+
+
+def count_subquery(queryset, fk):
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{fk: OuterRef('pk')}).order_by()
+            .values(fk).annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+# model -> {counter field: (source queryset, fk pointing back at the model)}
+COUNTERS = {
+    UserProfile: {
+        'count_follower': (Follow.objects.all(), 'follower'),
+        'count_following': (Follow.objects.all(), 'following'),
+        'count_post': (Post.objects.all(), 'user'),
+    },
+    Post: {
+        'count_post_like': (PostLike.objects.filter(like=True), 'post'),
+        'count_comment': (Comment.objects.all(), 'post'),
+    },
+    Comment: {
+        'count_comment_like': (CommentLike.objects.filter(like=True), 'comment'),
+        'count_reply': (Comment.objects.all(), 'parent'),
+    },
+}
+
+
+def reconcile(model, batch_size=1000, dry_run=False):
+    """
+    Compare stored counters with the source tables chunk by chunk and
+    repair drift. Fixes are applied as deltas so concurrent signal updates
+    are not lost. Returns a tuple of (rows checked, rows repaired).
+    """
+    counters = COUNTERS[model]
+    annotations = {f'actual_{field}': count_subquery(qs, fk) for field, (qs, fk) in counters.items()}
+    checked = repaired = 0
+    last_pk = None
+    while True:
+        pks = model.objects.order_by('pk')
+        if last_pk is not None:
+            pks = pks.filter(pk__gt=last_pk)
+        pks = list(pks.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        rows = (model.objects.filter(pk__in=pks).annotate(**annotations)
+                .values('pk', *counters, *annotations))
+        for row in rows:
+            checked += 1
+            deltas = {}
+            for field in counters:
+                delta = row[f'actual_{field}'] - row[field]
+                if delta:
+                    deltas[field] = delta
+            if deltas:
+                repaired += 1
+                if not dry_run:
+                    adjust(model, row['pk'], **deltas)
+    return checked, repaired
@@ -0,0 +1,164 @@
+"""
+Home timeline.
+
+Posts of regular accounts are pushed into TimelineEntry rows of every
+follower when they are created (fan-out-on-write). Accounts with more than
+FEED_FANOUT_LIMIT followers are skipped on write and merged in at read time
+(fan-out-on-read), so one post never turns into millions of inserts.
+
+Fan-out runs on a background thread once the post is committed. A
+PendingFanOut row is written in the same transaction as the post and
+deleted when every timeline has it, so fan-outs lost to a worker restart
+are finished by ``manage.py rebuild_timelines --pending``. Timelines are
+cut back to their newest FEED_TIMELINE_LENGTH entries by ``manage.py
+trim_timelines``, which keeps the table growing with the number of users,
+not of posts.
+"""
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import UserProfile, Follow, Post, TimelineEntry, PendingFanOut
+from .pagination import keyset_filter
+
+ORDERING = ('-created_at', '-post_id')
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def is_large_account(user):
+    # count_following is the number of Follow rows pointing at the user,
+    # i.e. the size of their audience.
+    return user.count_following > settings.FEED_FANOUT_LIMIT
+
+
+def _entries(user_ids, post):
+    return [TimelineEntry(user_id=user_id, post_id=post.pk, author_id=post.user_id,
+                          created_at=post.created_at) for user_id in user_ids]
+
+
+def trim(user_id):
+    """Drop the entries past the newest FEED_TIMELINE_LENGTH of ``user_id``'s timeline."""
+    length = settings.FEED_TIMELINE_LENGTH
+    # The last entry to keep and, if the timeline is over the cap, the one after it
+    keys = list(TimelineEntry.objects.filter(user_id=user_id).order_by(*ORDERING)
+                .values_list('created_at', 'post_id')[length - 1:length + 1])
+    if len(keys) < 2:
+        return 0
+    deleted, _ = TimelineEntry.objects.filter(keyset_filter(ORDERING, keys[0]), user_id=user_id).delete()
+    return deleted
+
+
+def _push(user_ids, post):
+    TimelineEntry.objects.bulk_create(_entries(user_ids, post), ignore_conflicts=True)
+
+
+def fan_out_post(post_id):
+    post = Post.objects.select_related('user').filter(pk=post_id).first()
+    if post is None:
+        return
+    _push([post.user_id], post)
+    if is_large_account(post.user):
+        PendingFanOut.objects.filter(post_id=post_id).delete()
+        return
+    followers = (Follow.objects.filter(following_id=post.user_id, follower__isnull=False)
+                 .values_list('follower_id', flat=True))
+    batch = []
+    for follower_id in followers.iterator(chunk_size=settings.FEED_FANOUT_BATCH):
+        batch.append(follower_id)
+        if len(batch) >= settings.FEED_FANOUT_BATCH:
+            _push(batch, post)
+            batch = []
+    if batch:
+        _push(batch, post)
+    PendingFanOut.objects.filter(post_id=post_id).delete()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.FEED_FANOUT_WORKERS,
+                                           thread_name_prefix='feed-fanout')
+    return _executor
+
+
+def _run(post_id):
+    try:
+        fan_out_post(post_id)
+    except Exception:
+        logger.exception('Failed to fan out post %s', post_id)
+    finally:
+        connections.close_all()
+
+
+def schedule_fan_out(post_id):
+    """Fan ``post_id`` out once the current transaction commits."""
+    PendingFanOut.objects.get_or_create(post_id=post_id)
+    if settings.FEED_FANOUT_ASYNC:
+        transaction.on_commit(lambda: get_executor().submit(_run, post_id))
+    else:
+        transaction.on_commit(partial(fan_out_post, post_id))
+
+
+def remove_post(post_id):
+    TimelineEntry.objects.filter(post_id=post_id).delete()
+
+
+def backfill_follow(follower_id, following_id):
+    """Copy the latest posts of a newly followed account into the follower's timeline."""
+    if follower_id is None or following_id is None:
+        return
+    author = UserProfile.objects.filter(pk=following_id).first()
+    if author is None or is_large_account(author):
+        return
+    posts = Post.objects.filter(user=author).order_by('-created_at', '-id')[:settings.FEED_BACKFILL]
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user_id=follower_id, post_id=post.pk, author_id=author.pk,
+                       created_at=post.created_at) for post in posts],
+        ignore_conflicts=True,
+    )
+    trim(follower_id)
+
+
+def remove_follow(follower_id, following_id):
+    if follower_id is None or following_id is None or follower_id == following_id:
+        return
+    TimelineEntry.objects.filter(user_id=follower_id, author_id=following_id).delete()
+
+
+def read_feed(user, limit, after=None):
+    """
+    Return up to ``limit`` posts of ``user``'s home timeline that come after
+    the (created_at, post id) position ``after``, newest first.
+    """
+    entries = TimelineEntry.objects.filter(user=user)
+    if after is not None:
+        entries = entries.filter(keyset_filter(ORDERING, after))
+    keys = list(entries.order_by(*ORDERING).values_list('created_at', 'post_id')[:limit])
+
+    large_accounts = (Follow.objects.filter(follower=user,
+                                            following__count_following__gt=settings.FEED_FANOUT_LIMIT)
+                      .values_list('following_id', flat=True))
+    pulled = Post.objects.filter(user_id__in=list(large_accounts))
+    if after is not None:
+        pulled = pulled.filter(keyset_filter(('-created_at', '-id'), after))
+    pulled_keys = pulled.order_by('-created_at', '-id').values_list('created_at', 'id')[:limit]
+
+    merged = []
+    for key in heapq.merge(keys, pulled_keys, reverse=True):
+        if not merged or merged[-1] != key:
+            merged.append(key)
+        if len(merged) == limit:
+            break
+
+    posts = Post.objects.select_related('user').in_bulk([post_id for _, post_id in merged])
+    return [posts[post_id] for _, post_id in merged if post_id in posts], merged
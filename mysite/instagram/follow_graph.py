@@ -0,0 +1,156 @@
+"""
+In-process follow graph for relationship checks.
+
+Each worker keeps, per user, the sorted ids of the accounts they follow and
+of their followers in compact ``array('q')`` arrays (8 bytes per edge and
+direction). "Does the viewer follow these authors?" is one bisect per
+author, and mutual counts intersect the shorter array into the longer one,
+so serializers can flag dozens of users without a query.
+
+The graph is held by a LocalIndex: loaded in the background when a worker
+starts, kept current in every worker through the Follow signals and the
+LocalIndex journal, and reloaded every FOLLOW_GRAPH['REFRESH_SECONDS'].
+Until it is loaded, the functions below ask the database, one query per
+call.
+"""
+import bisect
+from array import array
+
+from django.conf import settings
+from django.db.models import Count
+
+from .local_index import LocalIndex
+from .models import Follow
+
+EMPTY = array('q')
+
+
+def _contains(values, value):
+    position = bisect.bisect_left(values, value)
+    return position < len(values) and values[position] == value
+
+
+def _intersection_size(first, second):
+    if len(first) > len(second):
+        first, second = second, first
+    return sum(1 for value in first if _contains(second, value))
+
+
+class FollowGraph:
+    def __init__(self, edges=()):
+        """``edges`` are ``(follower, following)`` pairs sorted by follower, then following."""
+        self.following = {}
+        self.followers = {}
+        reverse = {}
+        for follower, following in edges:
+            if follower == following:
+                continue
+            self.following.setdefault(follower, array('q')).append(following)
+            reverse.setdefault(following, []).append(follower)
+        for user_id, followers in reverse.items():
+            self.followers[user_id] = array('q', sorted(followers))
+
+    @staticmethod
+    def _insert(adjacency, user_id, value):
+        values = adjacency.setdefault(user_id, array('q'))
+        position = bisect.bisect_left(values, value)
+        if position == len(values) or values[position] != value:
+            values.insert(position, value)
+
+    @staticmethod
+    def _delete(adjacency, user_id, value):
+        values = adjacency.get(user_id, EMPTY)
+        position = bisect.bisect_left(values, value)
+        if position < len(values) and values[position] == value:
+            del values[position]
+            if not values:
+                del adjacency[user_id]
+
+    def add(self, follower, following):
+        if follower is None or following is None or follower == following:
+            return
+        self._insert(self.following, follower, following)
+        self._insert(self.followers, following, follower)
+
+    def remove(self, follower, following):
+        self._delete(self.following, follower, following)
+        self._delete(self.followers, following, follower)
+
+    def is_following(self, viewer, user_ids):
+        """``{user id: viewer follows them}``"""
+        values = self.following.get(viewer, EMPTY)
+        return {user_id: _contains(values, user_id) for user_id in user_ids}
+
+    def is_followed_by(self, viewer, user_ids):
+        """``{user id: they follow the viewer}``"""
+        values = self.followers.get(viewer, EMPTY)
+        return {user_id: _contains(values, user_id) for user_id in user_ids}
+
+    def common_following(self, first, second):
+        """Sorted ids of the accounts both users follow."""
+        a, b = self.following.get(first, EMPTY), self.following.get(second, EMPTY)
+        if len(a) > len(b):
+            a, b = b, a
+        return [value for value in a if _contains(b, value)]
+
+    def mutual_counts(self, viewer, user_ids):
+        """``{user id: how many accounts the viewer follows follow them}``"""
+        following = self.following.get(viewer, EMPTY)
+        return {user_id: _intersection_size(following, self.followers.get(user_id, EMPTY))
+                for user_id in user_ids}
+
+
+def load():
+    edges = (Follow.objects.filter(follower__isnull=False, following__isnull=False)
+             .order_by('follower', 'following').values_list('follower', 'following')
+             .iterator(chunk_size=10000))
+    return FollowGraph(edges)
+
+
+graph = LocalIndex('follow graph', load, lambda: settings.FOLLOW_GRAPH['REFRESH_SECONDS'])
+get_graph, warm, reset, apply = graph.get, graph.warm, graph.reset, graph.apply
+
+
+def is_following(viewer, user_ids):
+    current = get_graph()
+    if current is None:
+        followed = set(Follow.objects.filter(follower=viewer, following__in=user_ids)
+                       .values_list('following_id', flat=True))
+        return {user_id: user_id in followed for user_id in user_ids}
+    return current.is_following(viewer, user_ids)
+
+
+def mutual_counts(viewer, user_ids):
+    current = get_graph()
+    if current is None:
+        counts = dict(Follow.objects
+                      .filter(following__in=user_ids,
+                              follower__in=Follow.objects.filter(follower=viewer).values('following'))
+                      .exclude(follower=viewer).values('following').annotate(mutual=Count('pk'))
+                      .order_by().values_list('following', 'mutual'))
+        return {user_id: counts.get(user_id, 0) for user_id in user_ids}
+    return current.mutual_counts(viewer, user_ids)
+
+
+def apply_flags(data, viewer):
+    """
+    Fill the ``is_following`` flags of every serialized user (a dict with
+    ``id`` and ``is_following``) nested in ``data`` for ``viewer``.
+    """
+    users = []
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            if 'is_following' in item and 'id' in item:
+                users.append(item)
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    if not users:
+        return
+    flags = {}
+    if viewer is not None and viewer.is_authenticated:
+        flags = is_following(viewer.pk, {user['id'] for user in users})
+    for user in users:
+        user['is_following'] = flags.get(user['id'])
@@ -0,0 +1,61 @@
+"""
+Wire formats for chat sockets.
+
+A group event is encoded once, by the socket that sends it, into every
+supported encoding; recipients forward the ready-made frame instead of
+serializing the same payload again. Clients pick an encoding and opt into
+batching with a subprotocol (``chat.msgpack``, ``chat.json.batch``, ...) or
+with ``?encoding=msgpack&batch=1`` in the query string. A batched socket
+receives arrays of events, collected for up to BATCH_INTERVAL_MS.
+"""
+import json
+from urllib.parse import parse_qs
+
+import msgpack
+
+ENCODINGS = ('json', 'msgpack')
+SUBPROTOCOL_PREFIX = 'chat.'
+BATCH_SUFFIX = '.batch'
+
+
+def encode(payload):
+    """Return the payload as a frame in every supported encoding."""
+    return {
+        'json': json.dumps(payload, separators=(',', ':')),
+        'msgpack': msgpack.packb(payload, use_bin_type=True),
+    }
+
+
+def decode(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data, raw=False)
+    return json.loads(text_data)
+
+
+def join(encoding, frames):
+    """Concatenate encoded events into one array frame without decoding them."""
+    if encoding == 'msgpack':
+        return msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames)
+    return '[' + ','.join(frames) + ']'
+
+
+def negotiate(scope):
+    """
+    Return ``(encoding, batch, subprotocol)`` for a connecting socket.
+    The first offered subprotocol we understand wins over the query string.
+    """
+    for subprotocol in scope.get('subprotocols') or ():
+        if not subprotocol.startswith(SUBPROTOCOL_PREFIX):
+            continue
+        name = subprotocol[len(SUBPROTOCOL_PREFIX):]
+        batch = name.endswith(BATCH_SUFFIX)
+        if batch:
+            name = name[:-len(BATCH_SUFFIX)]
+        if name in ENCODINGS:
+            return name, batch, subprotocol
+    params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    encoding = params.get('encoding', ['json'])[-1]
+    if encoding not in ENCODINGS:
+        encoding = 'json'
+    batch = params.get('batch', ['0'])[-1] in ('1', 'true', 'yes')
+    return encoding, batch, None
@@ -0,0 +1,65 @@
+"""
+Hashtags parsed from post descriptions.
+
+Every tag of a post gets a PostHashtag row carrying a copy of the post's
+created_at, so the posts of a tag, newest first, are one range of the
+(hashtag, -created_at, -post) index. Hashtag.post_count is raised here
+and lowered by the PostHashtag delete signal, which also covers posts
+being deleted.
+"""
+import re
+
+from django.conf import settings
+
+from .counters import adjust_many
+from .models import Hashtag, PostHashtag
+
+HASHTAG_RE = re.compile(r'(?<![\w/&#])#(\w+)')
+NAME_LENGTH = Hashtag._meta.get_field('name').max_length
+
+
+def normalize(name):
+    return name.lstrip('#').casefold()
+
+
+def extract(text):
+    """Return the distinct normalized tags of ``text``, in order of appearance."""
+    tags = []
+    for match in HASHTAG_RE.finditer(text or ''):
+        tag = normalize(match.group(1))
+        if len(tag) <= NAME_LENGTH and not tag.isdigit() and tag not in tags:
+            tags.append(tag)
+            if len(tags) == settings.HASHTAG_MAX_PER_POST:
+                break
+    return tags
+
+
+def sync_posts(posts):
+    """Make the PostHashtag rows of ``posts`` match their descriptions."""
+    wanted = {post.pk: set(extract(post.description)) for post in posts}
+    current = {}
+    for pk, post_id, name in (PostHashtag.objects.filter(post__in=wanted)
+                              .values_list('pk', 'post_id', 'hashtag__name')):
+        current.setdefault(post_id, {})[name] = pk
+
+    stale = [pk for post_id, tags in current.items() for name, pk in tags.items()
+             if name not in wanted[post_id]]
+    if stale:
+        # Deleted one by one, so the delete signal lowers the counts
+        PostHashtag.objects.filter(pk__in=stale).delete()
+
+    missing = {post.pk: wanted[post.pk] - set(current.get(post.pk, ())) for post in posts}
+    names = set().union(*missing.values())
+    if not names:
+        return
+    Hashtag.objects.bulk_create([Hashtag(name=name) for name in sorted(names)], ignore_conflicts=True)
+    ids = dict(Hashtag.objects.filter(name__in=names).values_list('name', 'pk'))
+    PostHashtag.objects.bulk_create([
+        PostHashtag(post_id=post.pk, hashtag_id=ids[name], created_at=post.created_at)
+        for post in posts for name in sorted(missing[post.pk])
+    ])
+    added = {}
+    for tags in missing.values():
+        for name in tags:
+            added[ids[name]] = added.get(ids[name], 0) + 1
+    adjust_many(Hashtag, 'post_count', added)
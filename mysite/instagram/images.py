@@ -0,0 +1,174 @@
+"""
+Resized variants of uploaded images.
+
+After an image is committed, a background thread renders every size in
+IMAGE_VARIANTS['SIZES'] in every format of IMAGE_VARIANTS['FORMATS'] and
+saves them next to the original (``post_images/cat.jpg`` gets
+``post_images/cat.thumb.webp`` and so on). The result is recorded in the
+row's ``image_variants``:
+
+    {'source': 'post_images/cat.jpg',
+     'thumb': {'webp': {'name': ..., 'width': 150, 'height': 150}, 'jpeg': {...}},
+     ...}
+
+``source`` tells which upload the variants belong to, so replacing the
+image schedules a new run and the old files are removed. An upload that
+is missing or is not an image is recorded as ``{'source': ..., 'error':
+...}``, so it is not scheduled again on every save of its row.
+
+Renders are queued on an in-process thread pool; one lost to a worker
+restart still shows up as a row whose image is not the ``source`` of its
+variants, and ``manage.py generate_image_variants`` renders those.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.db.models.fields.json import KeyTextTransform
+from PIL import Image, ImageOps
+
+from . import response_cache
+
+logger = logging.getLogger(__name__)
+
+PIL_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+# Keys of image_variants that are not sizes
+META_KEYS = ('source', 'error')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class SourceError(Exception):
+    """The uploaded file is missing or is not an image."""
+
+
+def variant_files(variants):
+    for name, formats in variants.items():
+        if name in META_KEYS:
+            continue
+        for info in formats.values():
+            yield info['name']
+
+
+def needs_variants(instance, retry_failed=False):
+    source = instance.image.name if instance.image else None
+    if retry_failed and 'error' in instance.image_variants:
+        return True
+    return source != instance.image_variants.get('source')
+
+
+def pending(queryset, retry_failed=False):
+    """The rows of ``queryset`` with an image that needs_variants()."""
+    source = KeyTextTransform('source', 'image_variants')
+    condition = Q(source__isnull=True) | ~Q(source=F('image'))
+    if retry_failed:
+        condition |= Q(image_variants__has_key='error')
+    return queryset.exclude(image='').exclude(image__isnull=True).annotate(source=source).filter(condition)
+
+
+def render(image, size, crop):
+    if crop:
+        return ImageOps.fit(image, size, Image.LANCZOS)
+    image = image.copy()
+    image.thumbnail(size, Image.LANCZOS)
+    return image
+
+
+def build_variants(field_file):
+    config = settings.IMAGE_VARIANTS
+    storage = field_file.storage
+    root = os.path.splitext(field_file.name)[0]
+    variants = {'source': field_file.name}
+    try:
+        field_file.open('rb')
+    except OSError as exc:
+        raise SourceError(str(exc)) from exc
+    with field_file:
+        try:
+            original = Image.open(field_file)
+            original.load()
+        except (OSError, Image.DecompressionBombError) as exc:
+            raise SourceError(str(exc)) from exc
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if original.has_transparency_data else 'RGB')
+        for name, spec in config['SIZES'].items():
+            image = render(original, tuple(spec['size']), spec.get('crop', False))
+            variants[name] = {}
+            for extension in config['FORMATS']:
+                output = image.convert('RGB') if extension == 'jpeg' else image
+                buffer = BytesIO()
+                output.save(buffer, PIL_FORMATS[extension], quality=config['QUALITY'], optimize=True)
+                saved = storage.save(f'{root}.{name}.{extension}', ContentFile(buffer.getvalue()))
+                variants[name][extension] = {'name': saved, 'width': image.width, 'height': image.height}
+    return variants
+
+
+def generate_variants(model, pk, retry_failed=False):
+    """Render the variants of one row's current image and record them."""
+    row = model.objects.filter(pk=pk).first()
+    if row is None or not needs_variants(row, retry_failed):
+        return False
+    storage = row.image.storage if row.image else model._meta.get_field('image').storage
+    try:
+        variants = build_variants(row.image) if row.image else {}
+    except SourceError as exc:
+        # Would fail the same way on every save; the command retries these on request
+        logger.warning('Cannot render variants of %s %s: %s', model.__name__, pk, exc)
+        variants = {'source': row.image.name, 'error': str(exc) or 'unreadable'}
+    # Only record the result if the image was not replaced meanwhile
+    current = model.objects.filter(pk=pk)
+    if row.image:
+        current = current.filter(image=row.image.name)
+    else:
+        current = current.filter(Q(image='') | Q(image__isnull=True))
+    updated = current.update(image_variants=variants)
+    stale = variant_files(variants if not updated else row.image_variants)
+    for name in stale:
+        storage.delete(name)
+    if updated:
+        response_cache.bump(*dependencies(row))
+    return bool(updated)
+
+
+def dependencies(row):
+    # Mirrors the invalidation in signals.py for responses embedding images
+    if row._meta.model_name == 'userprofile':
+        return [('user', row.pk)]
+    if row._meta.model_name == 'post':
+        return [('post', row.pk), ('user', row.user_id)]
+    return [('user', row.user_id)]
+
+
+def _run(model, pk):
+    try:
+        generate_variants(model, pk)
+    except Exception:
+        logger.exception('Failed to generate image variants for %s %s', model.__name__, pk)
+    finally:
+        connections.close_all()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_VARIANTS['WORKERS'],
+                                           thread_name_prefix='image-variants')
+    return _executor
+
+
+def schedule(instance):
+    """Generate variants for ``instance`` once the current transaction commits."""
+    model, pk = type(instance), instance.pk
+    if settings.IMAGE_VARIANTS['ASYNC']:
+        transaction.on_commit(lambda: get_executor().submit(_run, model, pk))
+    else:
+        transaction.on_commit(lambda: generate_variants(model, pk))
@@ -0,0 +1,45 @@
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, When
+
+from .models import Chat, ChatRead, Message
+from .pagination import keyset_filter
+
+
+def record_messages(messages):
+    """
+    Move the inbox pointers of the affected chats to the newest stored
+    message and add the new messages to every other member's unread count.
+    Runs a couple of UPDATEs per chat, however many messages the batch has.
+    """
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[message.chat_id].append(message)
+    with transaction.atomic():
+        for chat_id, items in by_chat.items():
+            last = max(items, key=lambda message: (message.created_date, message.pk))
+            (Chat.objects.filter(pk=chat_id, last_message_at__lte=last.created_date)
+             .update(last_message=last, last_message_at=last.created_date))
+            total = len(items)
+            own = Counter(message.author_id for message in items)
+            ChatRead.objects.filter(chat_id=chat_id).update(unread_count=Case(
+                *[When(user_id=author_id, then=F('unread_count') + (total - count))
+                  for author_id, count in own.items()],
+                default=F('unread_count') + total,
+            ))
+
+
+def mark_read(chat, user, message=None):
+    """Mark ``chat`` as read by ``user`` up to ``message`` (default: the latest one)."""
+    if message is None or message.pk == chat.last_message_id:
+        last_read_id, unread = chat.last_message_id, 0
+    else:
+        later = Message.objects.filter(chat=chat).filter(
+            keyset_filter(('created_date', 'id'), (message.created_date, message.pk)))
+        last_read_id, unread = message.pk, later.exclude(author=user).count()
+    ChatRead.objects.update_or_create(chat=chat, user=user, defaults={
+        'last_read_message_id': last_read_id,
+        'unread_count': unread,
+    })
+    return unread
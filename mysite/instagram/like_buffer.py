@@ -0,0 +1,243 @@
+"""
+Write-behind buffer for post likes.
+
+With LIKE_BUFFER['ENABLED'], post_like/set/ no longer writes PostLike rows
+or the post counter. Every change is appended to a log in the cache under a
+sequence number taken with ``incr``, the user's latest state is kept per
+post, and the change is added to the post's pending delta. ``manage.py
+flush_likes`` replays the log every FLUSH_INTERVAL seconds with one
+bulk_create and one bulk_update of PostLike rows and a single counter
+UPDATE for all touched posts, so a viral post's row is written once per
+interval instead of once per tap.
+
+Reads add the pending delta to count_post_like, so users see their own
+like immediately. The delta is only an estimate until the next flush; the
+flusher recomputes the exact change from the rows it writes. The cache must
+be shared by every worker and the flusher (set REDIS_URL).
+"""
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import takewhile
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from . import response_cache
+from .counters import adjust_many
+from .models import UserProfile, Post, PostLike
+
+logger = logging.getLogger(__name__)
+
+SEQ_KEY = 'likebuf:seq'
+FLUSHED_KEY = 'likebuf:flushed'
+LOCK_KEY = 'likebuf:lock'
+GAP_KEY = 'likebuf:gap'
+LOCK_TIMEOUT = 5 * 60
+USER_LOCK_TIMEOUT = 5
+USER_LOCK_RETRY = 0.05
+
+
+class LikeConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Another like change of this user is in progress.'
+    default_code = 'like_conflict'
+
+
+def _cache():
+    return caches[settings.LIKE_BUFFER['ALIAS']]
+
+
+def _event_key(seq):
+    return f'likebuf:event:{seq}'
+
+
+def _state_key(post_id, user_id):
+    return f'likebuf:state:{post_id}:{user_id}'
+
+
+def _delta_key(post_id):
+    return f'likebuf:delta:{post_id}'
+
+
+def enabled():
+    return settings.LIKE_BUFFER['ENABLED']
+
+
+@contextmanager
+def _user_lock(cache, user_id):
+    """
+    Serialize one user's record_likes() calls across workers, so two
+    identical taps cannot both see the old state. Waits once for
+    USER_LOCK_RETRY, then raises LikeConflict rather than holding the
+    request thread. A holder that dies releases it after USER_LOCK_TIMEOUT.
+    """
+    key = f'likebuf:lock:user:{user_id}'
+    if not cache.add(key, 1, timeout=USER_LOCK_TIMEOUT):
+        time.sleep(USER_LOCK_RETRY)
+        if not cache.add(key, 1, timeout=USER_LOCK_TIMEOUT):
+            raise LikeConflict()
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def _add_delta(cache, post_id, delta):
+    try:
+        cache.incr(_delta_key(post_id), delta)
+    except ValueError:
+        # Expired in between; the flush corrects the counter anyway
+        pass
+
+
+def record_likes(user, ids, like):
+    """
+    Buffer ``user``'s like on the posts in ``ids``. Returns ``{post id:
+    count_post_like}`` including pending changes, for the posts that exist.
+    """
+    cache = _cache()
+    timeout = settings.LIKE_BUFFER['TIMEOUT']
+    posts = sorted(Post.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    with _user_lock(cache, user.pk):
+        states = cache.get_many([_state_key(pk, user.pk) for pk in posts])
+        unbuffered = [pk for pk in posts if _state_key(pk, user.pk) not in states]
+        stored = dict(PostLike.objects.filter(user=user, post__in=unbuffered).values_list('post_id', 'like'))
+
+        changes = {}
+        for pk in posts:
+            previous = states.get(_state_key(pk, user.pk), bool(stored.get(pk)))
+            if previous != like:
+                changes[pk] = int(like) - int(previous)
+        if changes:
+            cache.add(SEQ_KEY, 0, timeout=None)
+            last = cache.incr(SEQ_KEY, len(changes))
+            cache.set_many({
+                _event_key(seq): (user.pk, pk, like, delta)
+                for seq, (pk, delta) in zip(range(last - len(changes) + 1, last + 1), changes.items())
+            }, timeout=timeout)
+            # After the events, so a writer that dies before them leaves no
+            # state the flusher will never write
+            cache.set_many({_state_key(pk, user.pk): like for pk in changes}, timeout=timeout)
+            for pk, delta in changes.items():
+                if not cache.add(_delta_key(pk), 0, timeout=timeout):
+                    cache.touch(_delta_key(pk), timeout=timeout)
+                _add_delta(cache, pk, delta)
+    return pending_counts(dict(Post.objects.filter(pk__in=posts).values_list('pk', 'count_post_like')))
+
+
+def pending_counts(counts):
+    """Add the pending deltas to stored counters ``{post id: count}``."""
+    if not enabled() or not counts:
+        return counts
+    deltas = _cache().get_many([_delta_key(pk) for pk in counts])
+    return {pk: max(count + deltas.get(_delta_key(pk), 0), 0) for pk, count in counts.items()}
+
+
+def apply_events(events):
+    """
+    Write ``(user id, post id, like, delta)`` events, oldest first, to the
+    database. Returns the ids of the posts whose counter changed.
+    """
+    final = {}
+    for user_id, post_id, like, delta in events:
+        final[user_id, post_id] = like
+    with transaction.atomic():
+        # Locked like likes.set_likes() does, so no request writes these
+        # users' rows between the read below and the upsert
+        users = set(UserProfile.objects.select_for_update().filter(pk__in={user_id for user_id, _ in final})
+                    .order_by('pk').values_list('pk', flat=True))
+        posts = set(Post.objects.filter(pk__in={post_id for _, post_id in final})
+                    .values_list('pk', flat=True))
+        final = {pair: like for pair, like in final.items() if pair[0] in users and pair[1] in posts}
+        existing = {
+            (row.user_id, row.post_id): row
+            for row in PostLike.objects.select_for_update().filter(user__in=users, post__in=posts)
+            if (row.user_id, row.post_id) in final
+        }
+        deltas = defaultdict(int)
+        created, updated = [], []
+        for (user_id, post_id), like in final.items():
+            row = existing.get((user_id, post_id))
+            if row is None:
+                if like:
+                    created.append(PostLike(user_id=user_id, post_id=post_id, like=True))
+                    deltas[post_id] += 1
+            elif row.like != like:
+                row.like = like
+                updated.append(row)
+                deltas[post_id] += 1 if like else -1
+        PostLike.objects.bulk_create(created, update_conflicts=True, unique_fields=['user', 'post'],
+                                     update_fields=['like'])
+        PostLike.objects.bulk_update(updated, ['like'])
+        adjust_many(Post, 'count_post_like', deltas)
+    return [pk for pk, delta in deltas.items() if delta]
+
+
+def flush(batch_size=None):
+    """Apply every buffered event; returns the number of events read."""
+    cache = _cache()
+    # Two flushers would both count rows that neither saw before
+    if not cache.add(LOCK_KEY, 1, timeout=LOCK_TIMEOUT):
+        return 0
+    try:
+        return _flush(cache, batch_size or settings.LIKE_BUFFER['BATCH_SIZE'])
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _flush(cache, batch_size):
+    head = cache.get(SEQ_KEY) or 0
+    flushed = cache.get(FLUSHED_KEY) or 0
+    if flushed > head:
+        # The sequence was lost (cache restart); start over with it
+        flushed = 0
+    total = 0
+    while flushed < head:
+        seqs = range(flushed + 1, min(flushed + batch_size, head) + 1)
+        found = cache.get_many([_event_key(seq) for seq in seqs])
+        # Stop at the first missing event; the next flush starts there
+        keys = list(takewhile(found.__contains__, (_event_key(seq) for seq in seqs)))
+        if not keys:
+            if not _skip_gap(cache, seqs[0]):
+                break
+            flushed = seqs[0]
+            cache.set(FLUSHED_KEY, flushed, timeout=None)
+            continue
+        events = [found[key] for key in keys]
+        changed = apply_events(events)
+
+        contributed = defaultdict(int)
+        for user_id, post_id, like, delta in events:
+            contributed[post_id] += delta
+        flushed += len(keys)
+        cache.set(FLUSHED_KEY, flushed, timeout=None)
+        for post_id, delta in contributed.items():
+            _add_delta(cache, post_id, -delta)
+        # Only now, or a rebuilt response would count these likes twice
+        response_cache.bump(*[('post', pk) for pk in changed])
+        cache.delete_many(keys)
+        total += len(events)
+    return total
+
+
+def _skip_gap(cache, seq):
+    """
+    Whether to give up on the missing event ``seq``. It usually belongs to a
+    writer between its incr() and set_many() and shows up shortly; only
+    once it has been missing for LIKE_BUFFER['GAP_SECONDS'] is it taken as
+    lost (its writer died, or it expired).
+    """
+    now = time.time()
+    gap = cache.get(GAP_KEY)
+    if gap is None or gap[0] != seq:
+        cache.set(GAP_KEY, (seq, now), timeout=None)
+        return False
+    if now - gap[1] < settings.LIKE_BUFFER['GAP_SECONDS']:
+        return False
+    logger.warning('Buffered like %d was never written; skipping it', seq)
+    return True
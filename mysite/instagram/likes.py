@@ -0,0 +1,48 @@
+"""
+Idempotent like/unlike.
+
+set_likes() stores the desired state for a batch of targets with one
+INSERT ... ON CONFLICT DO UPDATE and applies the counter changes as one
+UPDATE per batch, instead of a lookup, insert or update and counter
+update per tap. Repeating a request changes nothing, so retries are safe.
+bulk_create bypasses the model signals, so the counters and the response
+cache are handled here.
+"""
+from functools import partial
+
+from django.db import transaction
+
+from . import response_cache
+from .counters import adjust_many
+from .models import UserProfile, Post, PostLike, Comment, CommentLike
+
+# like model -> (target model, target field, counter on the target)
+LIKES = {
+    PostLike: (Post, 'post', 'count_post_like'),
+    CommentLike: (Comment, 'comment', 'count_comment_like'),
+}
+
+
+def set_likes(model, user, ids, like):
+    """
+    Set ``user``'s like on every target in ``ids`` to ``like``. Returns
+    ``{target id: counter}`` for the targets that exist.
+    """
+    target_model, target_field, counter = LIKES[model]
+    with transaction.atomic():
+        # Requests of one user are serialized, so the previous state read
+        # below is still true when the upsert runs; other users do not wait.
+        list(UserProfile.objects.select_for_update().filter(pk=user.pk).values_list('pk'))
+        targets = set(target_model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        previous = dict(model.objects.filter(user=user, **{f'{target_field}__in': targets})
+                        .values_list(f'{target_field}_id', 'like'))
+        model.objects.bulk_create(
+            [model(user=user, like=like, **{f'{target_field}_id': pk}) for pk in sorted(targets)],
+            update_conflicts=True, unique_fields=['user', target_field], update_fields=['like'],
+        )
+        deltas = {pk: int(like) - int(bool(previous.get(pk))) for pk in targets}
+        adjust_many(target_model, counter, deltas)
+        changed = [pk for pk, delta in deltas.items() if delta]
+        if model is PostLike and changed:
+            transaction.on_commit(partial(response_cache.bump, *[('post', pk) for pk in changed]))
+        return dict(target_model.objects.filter(pk__in=targets).values_list('pk', counter))
@@ -0,0 +1,151 @@
+"""
+Lifecycle of a structure each worker process builds from the database.
+
+LocalIndex loads it in the background, when the worker starts (see
+wsgi.py and asgi.py) or on first use; until then ``get()`` returns None
+and callers answer from the database instead. Committed changes (signals
+call ``apply``) are appended to a journal in the shared cache under a
+sequence number, and every ``get()`` replays the entries added since its
+last call, so a change made in one worker shows up in all of them on their
+next request. The structure is also rebuilt every ``refresh_seconds()``,
+and whenever the journal has lost entries it still needed.
+
+A rebuild reads the journal's sequence number before it loads and
+replays every later entry, which can include changes the load already
+saw, so changes must be idempotent: they set a state rather than adjust
+it.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+def _cache():
+    return caches[settings.LOCAL_INDEX['ALIAS']]
+
+
+class LocalIndex:
+    def __init__(self, name, load, refresh_seconds):
+        self.name = name
+        self.load = load
+        self.refresh_seconds = refresh_seconds
+        self.key = 'localindex:' + name.replace(' ', '_')
+        self._index = None
+        self._seq = 0
+        self._loaded_at = 0
+        self._loading = False
+        # Bumped by reset(), so loads started before it are discarded
+        self._generation = 0
+        self._gap = None
+        self._lock = threading.Lock()
+
+    def _seq_key(self):
+        return f'{self.key}:seq'
+
+    def _entry_key(self, seq):
+        return f'{self.key}:{seq}'
+
+    def refresh(self):
+        """Rebuild from the database in the calling thread and return the new index."""
+        with self._lock:
+            generation = self._generation
+        seq = _cache().get(self._seq_key(), 0)
+        index = self.load()
+        with self._lock:
+            if generation != self._generation:
+                return None
+            self._index, self._seq, self._loaded_at, self._gap = index, seq, time.monotonic(), None
+        self._catch_up()
+        return index
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Failed to load the %s', self.name)
+            finally:
+                with self._lock:
+                    self._loading = False
+                connection.close()
+        threading.Thread(target=run, daemon=True).start()
+
+    def _catch_up(self):
+        """Apply the journal entries other workers added since the last call."""
+        cache = _cache()
+        seq = cache.get(self._seq_key(), 0)
+        start = self._seq
+        if seq == start:
+            return
+        if seq < start or seq - start > settings.LOCAL_INDEX['MAX_REPLAY']:
+            # The journal was evicted and restarted, or too much changed
+            self._refresh_in_background()
+            return
+        entries = cache.get_many([self._entry_key(n) for n in range(start + 1, seq + 1)])
+        with self._lock:
+            if self._index is None:
+                return
+            for n in range(self._seq + 1, seq + 1):
+                entry = entries.get(self._entry_key(n))
+                if entry is None:
+                    break
+                method, args = entry
+                getattr(self._index, method)(*args)
+                self._seq = n
+            if self._seq == seq:
+                self._gap = None
+                return
+            # A writer between its incr and set, or an entry that expired;
+            # only the latter outlasts GAP_SECONDS
+            now = time.monotonic()
+            if self._gap is None or self._gap[0] != self._seq:
+                self._gap = (self._seq, now)
+                return
+            if now - self._gap[1] < settings.LOCAL_INDEX['GAP_SECONDS']:
+                return
+        self._refresh_in_background()
+
+    def get(self):
+        """Return the index, or None while this worker has not loaded it yet."""
+        if self._index is None:
+            self._refresh_in_background()
+            return None
+        self._catch_up()
+        if time.monotonic() - self._loaded_at > self.refresh_seconds():
+            self._refresh_in_background()
+        return self._index
+
+    def warm(self):
+        """Load in the background; called once per worker at startup."""
+        self._refresh_in_background()
+
+    def reset(self):
+        with self._lock:
+            self._index, self._seq, self._gap = None, 0, None
+            self._generation += 1
+
+    def apply(self, method, *args):
+        """Publish a committed change to every worker, starting with this one."""
+        cache = _cache()
+        cache.add(self._seq_key(), 0, timeout=None)
+        try:
+            seq = cache.incr(self._seq_key())
+        except ValueError:
+            # Evicted in between; other workers see the change on their next rebuild
+            seq = None
+        if seq is not None:
+            cache.set(self._entry_key(seq), (method, args), settings.LOCAL_INDEX['JOURNAL_TIMEOUT'])
+        with self._lock:
+            if self._index is not None:
+                getattr(self._index, method)(*args)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from instagram.hashtags import sync_posts
+from instagram.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Parse hashtags of existing posts into the hashtag index (safe to re-run).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        posts = Post.objects.only('pk', 'description', 'created_at').order_by('pk')
+        total = 0
+        batch = []
+        for post in posts.iterator(chunk_size=options['batch_size']):
+            batch.append(post)
+            if len(batch) == options['batch_size']:
+                total += self._sync(batch)
+                batch = []
+        total += self._sync(batch)
+        self.stdout.write(f'{total} posts processed')
+
+    def _sync(self, batch):
+        with transaction.atomic():
+            sync_posts(batch)
+        return len(batch)
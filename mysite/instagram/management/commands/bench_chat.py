@@ -0,0 +1,152 @@
+import asyncio
+import json
+import statistics
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from instagram import frames
+from instagram.middleware import JWTAuthMiddleware
+from instagram.models import Chat, UserProfile
+from instagram.routing import websocket_urlpatterns
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = ('Benchmark ChatConsumer fan-out: connect many WebsocketCommunicator clients across rooms, '
+            'broadcast messages and report connect latency, throughput and delivery latency. '
+            'Users, chats and tokens are created in a throwaway test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=500)
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent per room.')
+        parser.add_argument('--connect-concurrency', type=int, default=100)
+        parser.add_argument('--layer', choices=['memory', 'settings'], default='memory',
+                            help='Use InMemoryChannelLayer (default) or CHANNEL_LAYERS from settings.')
+        parser.add_argument('--capacity', type=int, default=10000,
+                            help='Per-channel capacity of the in-memory layer.')
+        parser.add_argument('--encoding', choices=frames.ENCODINGS, default='json')
+        parser.add_argument('--batch', action='store_true', help='Ask for batched outbound frames.')
+        parser.add_argument('--timeout', type=float, default=60)
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            sockets = self.create_members(options['clients'], min(options['rooms'], options['clients']))
+            if options['layer'] == 'memory':
+                layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                                      'CONFIG': {'capacity': options['capacity']}}}
+                with override_settings(CHANNEL_LAYERS=layers):
+                    report = asyncio.run(self.run(sockets, options))
+            else:
+                report = asyncio.run(self.run(sockets, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        for line in report:
+            self.stdout.write(line)
+
+    def create_members(self, clients, rooms):
+        """Return one (chat id, access token) pair per client, spread over ``rooms`` chats."""
+        users = UserProfile.objects.bulk_create(
+            [UserProfile(username=f'bench{index}') for index in range(clients)])
+        chats = [Chat.objects.create() for _ in range(rooms)]
+        for room, chat in enumerate(chats):
+            chat.person.add(*users[room::rooms])
+        return [(chats[index % rooms].pk, str(AccessToken.for_user(user))) for index, user in enumerate(users)]
+
+    def get_application(self):
+        return JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def room_path(self, chat_id, token):
+        return f'/ws/chat/{chat_id}/?token={token}'
+
+    async def run(self, sockets, options):
+        application = self.get_application()
+        clients = len(sockets)
+        members = {}
+
+        connect_latencies = []
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(index):
+            room, token = sockets[index]
+            subprotocol = f'{frames.SUBPROTOCOL_PREFIX}{options["encoding"]}{frames.BATCH_SUFFIX if options["batch"] else ""}'
+            communicator = WebsocketCommunicator(application, self.room_path(room, token), subprotocols=[subprotocol])
+            async with semaphore:
+                started = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=options['timeout'])
+                connect_latencies.append(time.perf_counter() - started)
+            if not connected:
+                raise RuntimeError(f'client {index} was rejected')
+            members.setdefault(room, []).append(communicator)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connect(index) for index in range(clients)))
+        connect_elapsed = time.perf_counter() - started
+        rooms = len(members)
+
+        delivery_latencies = []
+        received_frames = []
+
+        async def listen(communicator, expected):
+            received = 0
+            while received < expected:
+                frame = await communicator.receive_from(timeout=options['timeout'])
+                received_frames.append(1)
+                payload = frames.decode(*((None, frame) if isinstance(frame, bytes) else (frame, None)))
+                for event in payload if options['batch'] else [payload]:
+                    if 'message' not in event:
+                        continue
+                    received += 1
+                    sent_at = json.loads(event['message'])['sent_at']
+                    delivery_latencies.append(time.perf_counter() - sent_at)
+
+        async def speak(room):
+            senders = members[room]
+            for sequence in range(options['messages']):
+                sender = senders[sequence % len(senders)]
+                payload = frames.encode({
+                    'message': json.dumps({'sent_at': time.perf_counter(), 'sequence': sequence}),
+                })[options['encoding']]
+                if options['encoding'] == 'msgpack':
+                    await sender.send_to(bytes_data=payload)
+                else:
+                    await sender.send_to(text_data=payload)
+                await asyncio.sleep(0)
+
+        started = time.perf_counter()
+        listeners = [listen(communicator, options['messages'])
+                     for room in members for communicator in members[room]]
+        await asyncio.gather(*listeners, *(speak(room) for room in members))
+        fanout_elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*(communicator.disconnect() for room in members for communicator in members[room]))
+
+        sent = rooms * options['messages']
+        delivered = len(delivery_latencies)
+        return [
+            f'clients={clients} rooms={rooms} messages/room={options["messages"]} layer={options["layer"]} '
+            f'encoding={options["encoding"]} batch={options["batch"]}',
+            f'connect: total {connect_elapsed:.3f}s, '
+            f'p50 {percentile(connect_latencies, 0.5) * 1000:.2f}ms, '
+            f'p99 {percentile(connect_latencies, 0.99) * 1000:.2f}ms',
+            f'fan-out: {sent} sent, {delivered} delivered in {fanout_elapsed:.3f}s '
+            f'({delivered / fanout_elapsed if fanout_elapsed else 0:.0f} deliveries/s, '
+            f'{len(received_frames)} frames)',
+            f'delivery latency: mean {statistics.fmean(delivery_latencies) * 1000 if delivered else 0:.2f}ms, '
+            f'p50 {percentile(delivery_latencies, 0.5) * 1000:.2f}ms, '
+            f'p99 {percentile(delivery_latencies, 0.99) * 1000:.2f}ms',
+        ]
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from instagram.models import UserProfile
+from instagram.suggestions import compute
+
+
+class Command(BaseCommand):
+    help = 'Recompute "people you may know" for every user, a chunk of users at a time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Users per chunk; each chunk is one grouped query.')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Suggestions kept per user (default: FOLLOW_SUGGESTIONS_PER_USER).')
+
+    def handle(self, *args, **options):
+        users = UserProfile.objects.filter(is_active=True).order_by('pk')
+        processed = stored = 0
+        last_pk = None
+        while True:
+            batch = users if last_pk is None else users.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:options['batch_size']])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            stored += compute(pks, options['limit'])
+            processed += len(pks)
+        self.stdout.write(f'{processed} users processed, {stored} suggestions stored')
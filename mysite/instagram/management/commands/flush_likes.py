@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from instagram.like_buffer import flush
+
+
+class Command(BaseCommand):
+    help = 'Apply likes buffered in the cache to the database, once or every FLUSH_INTERVAL seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Flush once and exit.')
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Seconds between flushes (default: LIKE_BUFFER['FLUSH_INTERVAL']).")
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or settings.LIKE_BUFFER['FLUSH_INTERVAL']
+        if options['once']:
+            self.stdout.write(f"{flush(options['batch_size'])} likes flushed")
+            return
+        while True:
+            started = time.monotonic()
+            flushed = flush(options['batch_size'])
+            if flushed and options['verbosity'] > 1:
+                self.stdout.write(f'{flushed} likes flushed')
+            time.sleep(max(interval - (time.monotonic() - started), 0))
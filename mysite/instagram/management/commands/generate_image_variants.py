@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from instagram.images import generate_variants, pending
+from instagram.models import Post, Story, UserProfile
+
+MODELS = {'post': Post, 'story': Story, 'user': UserProfile}
+
+
+class Command(BaseCommand):
+    help = ('Render missing or outdated image variants, including renders a worker restart lost '
+            '(safe to run periodically).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(MODELS), action='append',
+                            help='Limit to these models (default: all).')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also retry images recorded as missing or unreadable.')
+
+    def handle(self, *args, **options):
+        for name in options['model'] or sorted(MODELS):
+            model = MODELS[name]
+            retry_failed = options['retry_failed']
+            queryset = pending(model.objects.all(), retry_failed).order_by('pk')
+            checked = generated = failed = 0
+            last_pk = None
+            while True:
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                pks = list(batch.values_list('pk', flat=True)[:options['batch_size']])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                for pk in pks:
+                    checked += 1
+                    try:
+                        generated += generate_variants(model, pk, retry_failed)
+                    except Exception as exc:
+                        failed += 1
+                        self.stderr.write(f'{name} {pk}: {exc}')
+            self.stdout.write(f'{name}: {checked} checked, {generated} generated, {failed} failed')
@@ -0,0 +1,36 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from instagram.models import Story
+
+
+class Command(BaseCommand):
+    help = 'Delete expired stories and their media files in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--grace-hours', type=int, default=0,
+                            help='Keep stories this many hours past their expiry.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches to spread the load.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+        deleted = 0
+        while True:
+            batch = list(Story.objects.filter(expires_at__lte=cutoff).order_by('expires_at')
+                         .values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            with transaction.atomic():
+                # Files, including image variants, are released by the
+                # post_delete hooks once the rows are gone
+                Story.objects.filter(pk__in=batch).delete()
+            deleted += len(batch)
+            self.stdout.write(f'{deleted} expired stories deleted')
+            if options['sleep']:
+                time.sleep(options['sleep'])
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from instagram.models import Upload
+from instagram.uploads import remove_temp_file
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned resumable uploads and their temp files, and old completed upload records.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=None,
+                            help="Idle hours before an upload is purged (default: UPLOADS['EXPIRE_HOURS']).")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        hours = options['hours'] if options['hours'] is not None else settings.UPLOADS['EXPIRE_HOURS']
+        cutoff = timezone.now() - timedelta(hours=hours)
+        deleted = 0
+        while True:
+            batch = list(Upload.objects.filter(updated_at__lt=cutoff).order_by('updated_at')
+                         [:options['batch_size']])
+            if not batch:
+                break
+            Upload.objects.filter(pk__in=[upload.pk for upload in batch]).delete()
+            # Rows first: a crash here leaves a stray temp file, not an upload without one
+            for upload in batch:
+                remove_temp_file(upload)
+            deleted += len(batch)
+        self.stdout.write(f'{deleted} uploads purged')
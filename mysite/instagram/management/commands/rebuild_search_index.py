@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from instagram.models import SearchDocument
+from instagram.search import DOCUMENTS, build_document
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search documents of posts, comments and users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Documents are upserted in place, so search keeps working meanwhile;
+        # whatever was not touched afterwards belongs to rows that are gone.
+        started = timezone.now()
+        for model, (kind, fields, build) in DOCUMENTS.items():
+            queryset = model.objects.only('pk', *fields).order_by('pk')
+            indexed = 0
+            last_pk = None
+            while True:
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                rows = list(batch[:options['batch_size']])
+                if not rows:
+                    break
+                last_pk = rows[-1].pk
+                documents = [document for document in map(build_document, rows) if document is not None]
+                for document in documents:
+                    document.updated_at = timezone.now()
+                SearchDocument.objects.bulk_create(
+                    documents, update_conflicts=True, unique_fields=['kind', 'object_id'],
+                    update_fields=['title', 'body', 'updated_at'],
+                )
+                indexed += len(documents)
+            self.stdout.write(f'{kind}: {indexed} indexed')
+        stale, _ = SearchDocument.objects.filter(updated_at__lt=started).delete()
+        if connection.vendor == 'sqlite':
+            # Resync the FTS5 index with its content table
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO instagram_searchdocument_fts(instagram_searchdocument_fts) VALUES ('rebuild')")
+        self.stdout.write(f'{stale} stale documents removed')
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from instagram.feed import fan_out_post
+from instagram.models import Post, PendingFanOut
+
+
+class Command(BaseCommand):
+    help = 'Fan out existing posts into follower timelines (safe to re-run).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only posts created at or after this ISO timestamp.')
+        parser.add_argument('--pending', action='store_true',
+                            help='Only posts whose fan-out did not finish, e.g. because the worker restarted.')
+        parser.add_argument('--older-than', type=int, default=300,
+                            help='With --pending, skip fan-outs scheduled less than this many seconds ago.')
+
+    def handle(self, *args, **options):
+        posts = Post.objects.order_by('pk')
+        if options['since']:
+            posts = posts.filter(created_at__gte=options['since'])
+        if options['pending']:
+            cutoff = timezone.now() - timedelta(seconds=options['older_than'])
+            posts = posts.filter(pk__in=PendingFanOut.objects.filter(created_at__lte=cutoff).values('post_id'))
+        total = 0
+        for post_id in posts.values_list('pk', flat=True).iterator(chunk_size=settings.FEED_FANOUT_BATCH):
+            fan_out_post(post_id)
+            total += 1
+        self.stdout.write(f'{total} posts fanned out')
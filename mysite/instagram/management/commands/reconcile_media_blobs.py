@@ -0,0 +1,93 @@
+import os
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from instagram.images import variant_files
+from instagram.models import MediaBlob
+from instagram.signals import MEDIA_FIELDS
+from instagram.storage import BLOB_DIR, is_blob
+
+
+class Command(BaseCommand):
+    help = ('Recount references to content-addressed media blobs, fix drifted counts '
+            'and delete blobs nothing refers to.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it.')
+        parser.add_argument('--min-age-hours', type=float, default=1,
+                            help='Leave younger blobs alone; their rows may not be committed yet.')
+
+    def count_references(self, batch_size):
+        references = Counter()
+        for model, fields in MEDIA_FIELDS.items():
+            columns = list(fields)
+            if any(field.name == 'image_variants' for field in model._meta.fields):
+                columns.append('image_variants')
+            queryset = model.objects.order_by('pk')
+            last_pk = None
+            while True:
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                rows = list(batch.values_list('pk', *columns)[:batch_size])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                for pk, *values in rows:
+                    names = values[:len(fields)]
+                    if len(values) > len(fields):
+                        names += list(variant_files(values[-1]))
+                    references.update(name for name in names if name and is_blob(name))
+        return references
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        min_age = timedelta(hours=options['min_age_hours'])
+        cutoff = timezone.now() - min_age
+        references = self.count_references(options['batch_size'])
+        fixed = removed = 0
+
+        blobs = list(MediaBlob.objects.values_list('pk', 'name', 'refcount', 'created_at'))
+        known = {name for _, name, _, _ in blobs}
+        for pk, name, refcount, created_at in blobs:
+            count = references.pop(name, 0)
+            if count == refcount or created_at > cutoff:
+                continue
+            if count:
+                fixed += 1
+                if not dry_run:
+                    MediaBlob.objects.filter(pk=pk).update(refcount=count)
+            else:
+                removed += 1
+                if not dry_run:
+                    MediaBlob.objects.filter(pk=pk).delete()
+                    default_storage.remove(name)
+
+        # Referenced files that lost their row
+        for name, count in references.items():
+            if name in known or not default_storage.exists(name):
+                continue
+            fixed += 1
+            known.add(name)
+            if not dry_run:
+                MediaBlob.objects.create(name=name, size=default_storage.size(name), refcount=count)
+
+        # Files on disk without a row, e.g. left by a rolled back transaction
+        orphans = 0
+        for directory, _, filenames in os.walk(default_storage.path(BLOB_DIR)):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, default_storage.location).replace(os.sep, '/')
+                if name in known or time.time() - os.path.getmtime(path) < min_age.total_seconds():
+                    continue
+                orphans += 1
+                if not dry_run:
+                    os.remove(path)
+
+        verb = 'drifted' if dry_run else 'repaired'
+        found = 'found' if dry_run else 'deleted'
+        self.stdout.write(f'{fixed} counts {verb}, {removed} unreferenced blobs {found}, {orphans} orphaned files {found}')
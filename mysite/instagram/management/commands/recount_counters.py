@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from instagram.counters import COUNTERS, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Verify denormalized counters against the source tables and repair drift in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it.')
+
+    def handle(self, *args, **options):
+        for model in COUNTERS:
+            checked, repaired = reconcile(model, batch_size=options['batch_size'],
+                                          dry_run=options['dry_run'])
+            verb = 'drifted' if options['dry_run'] else 'repaired'
+            self.stdout.write(f'{model.__name__}: {checked} checked, {repaired} {verb}')
@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from instagram.feed import trim
+from instagram.models import TimelineEntry
+
+
+class Command(BaseCommand):
+    help = 'Cut every home timeline back to its newest FEED_TIMELINE_LENGTH entries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between timelines to spread the load.')
+
+    def handle(self, *args, **options):
+        over = (TimelineEntry.objects.values('user_id').annotate(entries=Count('pk'))
+                .filter(entries__gt=settings.FEED_TIMELINE_LENGTH).order_by('user_id'))
+        timelines = deleted = 0
+        for user_id in list(over.values_list('user_id', flat=True)):
+            deleted += trim(user_id)
+            timelines += 1
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write(f'{deleted} entries deleted from {timelines} timelines')
@@ -0,0 +1,137 @@
+"""
+Serving files under MEDIA_ROOT.
+
+Supports conditional requests (ETag / Last-Modified) and single byte
+ranges, so video players can seek without downloading from byte 0. Bodies
+are streamed from the file handle in MEDIA_SERVING['BLOCK_SIZE'] pieces.
+When MEDIA_SERVING['SENDFILE'] names a front proxy mechanism the view only
+checks the request and leaves the transfer to the proxy:
+
+* ``'x-accel-redirect'`` (nginx): redirects internally to
+  MEDIA_SERVING['ACCEL_PREFIX'] + path, see nginx/nginx.conf;
+* ``'x-sendfile'`` (Apache mod_xsendfile, lighttpd): sends the absolute path.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Return ``(start, end)`` (inclusive) for a single-range header, None to
+    serve the whole file, or raise ValueError if the range is unsatisfiable.
+    Multi-range requests are answered with the whole file, which RFC 9110
+    allows.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        raise ValueError(header)
+    return start, end
+
+
+def read_range(path, start, length, block_size):
+    with open(path, 'rb') as source:
+        source.seek(start)
+        while length > 0:
+            data = source.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def range_applies(request, etag, mtime):
+    """If-Range: honour Range only while the validator still matches the file."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+@require_safe
+def serve_media(request, path):
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Not found')
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('Not found')
+    if not os.path.isfile(full_path):
+        raise Http404('Not found')
+
+    size, mtime = stat.st_size, stat.st_mtime
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(mtime))
+    if not_modified is not None:
+        return not_modified
+
+    start, end = 0, size - 1
+    partial = False
+    if request.headers.get('Range') and range_applies(request, etag, mtime):
+        try:
+            requested = parse_range(request.headers['Range'], size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if requested is not None:
+            (start, end), partial = requested, True
+    length = end - start + 1 if size else 0
+
+    config = settings.MEDIA_SERVING
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    if config['SENDFILE'] == 'x-accel-redirect':
+        # nginx re-evaluates Range and the validators itself
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(config['ACCEL_PREFIX'] + path)
+    elif config['SENDFILE'] == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+    else:
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+        else:
+            response = StreamingHttpResponse(read_range(full_path, start, length, config['BLOCK_SIZE']),
+                                             content_type=content_type)
+        response['Content-Length'] = str(length)
+        if partial:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
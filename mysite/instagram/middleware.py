@@ -0,0 +1,111 @@
+"""
+JWT authentication for websockets, and per-viewer follow flags for REST
+responses.
+
+The REST API only accepts simplejwt access tokens, so sockets present the
+same token, either as ``?token=<access>`` or as a ``jwt.<access>``
+subprotocol for browsers, which cannot set headers on a websocket.
+
+A validated token's claims are cached until the token expires, and the
+user it names is cached for as long, so a reconnect storm does not verify
+the same signature or load the same user once per socket. The user entry
+is dropped whenever the profile is saved or deleted (see signals.py),
+which keeps deactivations and password changes effective immediately.
+"""
+import hashlib
+import time
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from . import follow_graph
+
+TOKEN_SUBPROTOCOL_PREFIX = 'jwt.'
+
+
+def claims_key(raw_token):
+    return 'ws-jwt:' + hashlib.sha256(raw_token.encode()).hexdigest()
+
+
+def user_key(user_id):
+    return f'ws-user:{user_id}'
+
+
+def get_token(scope):
+    """Return ``(token, subprotocol)``; subprotocol is the one carrying the token, if any."""
+    for subprotocol in scope.get('subprotocols') or ():
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):], subprotocol
+    params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    token = params.get('token', [None])[-1]
+    return token, None
+
+
+def _validate(raw_token):
+    authentication = JWTAuthentication()
+    validated = authentication.get_validated_token(raw_token.encode())
+    return dict(validated.payload), authentication.get_user(validated)
+
+
+async def get_user(raw_token):
+    """Return the user for an access token, or AnonymousUser when it is invalid."""
+    claims = await cache.aget(claims_key(raw_token))
+    if claims is not None:
+        if claims['exp'] <= time.time():
+            return AnonymousUser()
+        user = await cache.aget(user_key(claims[api_settings.USER_ID_CLAIM]))
+        if user is not None:
+            return user
+
+    try:
+        claims, user = await database_sync_to_async(_validate)(raw_token)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return AnonymousUser()
+
+    timeout = claims['exp'] - time.time()
+    if timeout > 0:
+        await cache.aset_many({
+            claims_key(raw_token): claims,
+            user_key(user.pk): user,
+        }, timeout=timeout)
+    return user
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets ``scope['user']`` from a JWT access token. Sockets without a token
+    keep whatever user the session middleware around it found.
+    """
+
+    async def __call__(self, scope, receive, send):
+        token, subprotocol = get_token(scope)
+        if token:
+            scope = dict(scope, user=await get_user(token), token_subprotocol=subprotocol)
+        return await super().__call__(scope, receive, send)
+
+
+class FollowFlagsMiddleware:
+    """
+    Fills the ``is_following`` flags of every user in a successful REST
+    response for the requesting user, from the follow graph or, while it
+    loads, one Follow query for the whole response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_template_response(self, request, response):
+        data = getattr(response, 'data', None)
+        if data is not None and response.status_code == 200:
+            follow_graph.apply_flags(data, getattr(request, 'user', None))
+        return response
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:45
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def _count(queryset, fk):
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{fk: OuterRef('pk')}).order_by()
+            .values(fk).annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def fill_counters(apps, schema_editor):
+    UserProfile = apps.get_model('instagram', 'UserProfile')
+    Follow = apps.get_model('instagram', 'Follow')
+    Post = apps.get_model('instagram', 'Post')
+    UserProfile.objects.update(
+        count_follower=_count(Follow.objects.all(), 'follower'),
+        count_following=_count(Follow.objects.all(), 'following'),
+        count_post=_count(Post.objects.all(), 'user'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram', '0006_alter_follow_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='count_follower',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='count_following',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='count_post',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:45
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def _count(queryset, fk):
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{fk: OuterRef('pk')}).order_by()
+            .values(fk).annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def fill_counters(apps, schema_editor):
+    Post = apps.get_model('instagram', 'Post')
+    PostLike = apps.get_model('instagram', 'PostLike')
+    Comment = apps.get_model('instagram', 'Comment')
+    CommentLike = apps.get_model('instagram', 'CommentLike')
+    Post.objects.update(
+        count_post_like=_count(PostLike.objects.filter(like=True), 'post'),
+        count_comment=_count(Comment.objects.all(), 'post'),
+    )
+    Comment.objects.update(
+        count_comment_like=_count(CommentLike.objects.filter(like=True), 'comment'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram', '0007_userprofile_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='count_comment_like',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='count_comment',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='count_post_like',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
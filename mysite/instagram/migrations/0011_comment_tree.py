@@ -0,0 +1,95 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:51
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+STEP = 10
+MAX_DEPTH = 24
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def _segment(pk):
+    segment = ''
+    while pk:
+        pk, rest = divmod(pk, 36)
+        segment = DIGITS[rest] + segment
+    return segment.rjust(STEP, '0')
+
+
+def fill_paths(apps, schema_editor):
+    Comment = apps.get_model('instagram', 'Comment')
+    parents = dict(Comment.objects.values_list('pk', 'parent_id'))
+    paths = {}
+    # Comments that become top-level: part of a parent cycle, or deeper than MAX_DEPTH
+    detached = set()
+
+    def path_of(pk):
+        chain = []
+        seen = set()
+        while pk is not None and pk not in paths:
+            if pk in seen:
+                # A cycle; the comment that closes it becomes top-level
+                detached.add(chain[-1])
+                pk = None
+                break
+            chain.append(pk)
+            seen.add(pk)
+            pk = parents.get(pk)
+        prefix = paths[pk] if pk is not None else ''
+        for item in reversed(chain):
+            if item in detached or len(prefix) // STEP > MAX_DEPTH:
+                detached.add(item)
+                prefix = ''
+            prefix += _segment(item)
+            paths[item] = prefix
+        return paths[chain[0]] if chain else prefix
+
+    batch = []
+    for pk in sorted(parents):
+        path = path_of(pk)
+        batch.append(Comment(pk=pk, path=path, depth=len(path) // STEP - 1,
+                             parent_id=None if pk in detached else parents[pk]))
+        if len(batch) >= 1000:
+            Comment.objects.bulk_update(batch, ['path', 'depth', 'parent'])
+            batch = []
+    if batch:
+        Comment.objects.bulk_update(batch, ['path', 'depth', 'parent'])
+
+    replies = (Comment.objects.filter(parent=OuterRef('pk')).order_by()
+               .values('parent').annotate(total=Count('pk')).values('total'))
+    Comment.objects.update(count_reply=Coalesce(Subquery(replies, output_field=IntegerField()), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram', '0010_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='count_reply',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, default='', editable=False, max_length=250),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'depth', 'path'], name='instagram_c_post_id_5b1d0e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='instagram_c_post_id_3bca13_idx'),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
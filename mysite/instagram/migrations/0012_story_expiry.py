@@ -0,0 +1,32 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:52
+
+import instagram.models
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def expire_from_creation(apps, schema_editor):
+    Story = apps.get_model('instagram', 'Story')
+    Story.objects.update(expires_at=F('created_at') + timedelta(hours=24))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram', '0011_comment_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, default=instagram.models.default_story_expiry),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['user', 'expires_at'], name='instagram_s_user_id_c4ee0f_idx'),
+        ),
+        migrations.RunPython(expire_from_creation, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.1.7 on 2026-10-18 17:53
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_inbox(apps, schema_editor):
+    Chat = apps.get_model('instagram', 'Chat')
+    Message = apps.get_model('instagram', 'Message')
+    ChatRead = apps.get_model('instagram', 'ChatRead')
+    for chat in Chat.objects.iterator():
+        last = Message.objects.filter(chat=chat).order_by('-created_date', '-id').first()
+        if last is not None:
+            Chat.objects.filter(pk=chat.pk).update(last_message=last, last_message_at=last.created_date)
+        ChatRead.objects.bulk_create(
+            [ChatRead(chat=chat, user_id=user_id, last_read_message=last)
+             for user_id in chat.person.values_list('pk', flat=True)],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram', '0012_story_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatRead',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='instagram.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['-last_message_at', '-id'], name='instagram_c_last_me_c7f0ad_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_date', 'id'], name='instagram_m_chat_id_23bccc_idx'),
+        ),
+        migrations.AddField(
+            model_name='chatread',
+            name='chat',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reads', to='instagram.chat'),
+        ),
+        migrations.AddField(
+            model_name='chatread',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='instagram.message'),
+        ),
+        migrations.AddField(
+            model_name='chatread',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_reads', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='chatread',
+            unique_together={('chat', 'user')},
+        ),
+        migrations.RunPython(fill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.1.7 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+# SQLite: an external-content FTS5 table over the documents, kept in sync
+# by triggers. Postgres: a generated tsvector column with a GIN index.
+SQL = {
+    'sqlite': (
+        [
+            "CREATE VIRTUAL TABLE instagram_searchdocument_fts USING fts5("
+            "title, body, content='instagram_searchdocument', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')",
+            "CREATE TRIGGER instagram_searchdocument_ai AFTER INSERT ON instagram_searchdocument BEGIN "
+            "INSERT INTO instagram_searchdocument_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+            "CREATE TRIGGER instagram_searchdocument_ad AFTER DELETE ON instagram_searchdocument BEGIN "
+            "INSERT INTO instagram_searchdocument_fts(instagram_searchdocument_fts, rowid, title, body) "
+            "VALUES ('delete', old.id, old.title, old.body); END",
+            "CREATE TRIGGER instagram_searchdocument_au AFTER UPDATE ON instagram_searchdocument BEGIN "
+            "INSERT INTO instagram_searchdocument_fts(instagram_searchdocument_fts, rowid, title, body) "
+            "VALUES ('delete', old.id, old.title, old.body); "
+            "INSERT INTO instagram_searchdocument_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+        ],
+        [
+            'DROP TRIGGER IF EXISTS instagram_searchdocument_au',
+            'DROP TRIGGER IF EXISTS instagram_searchdocument_ad',
+            'DROP TRIGGER IF EXISTS instagram_searchdocument_ai',
+            'DROP TABLE IF EXISTS instagram_searchdocument_fts',
+        ],
+    ),
+    'postgresql': (
+        [
+            "ALTER TABLE instagram_searchdocument ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', body), 'B')) STORED",
+            'CREATE INDEX instagram_searchdocument_vector ON instagram_searchdocument USING GIN (search_vector)',
+        ],
+        [
+            'DROP INDEX IF EXISTS instagram_searchdocument_vector',
+            'ALTER TABLE instagram_searchdocument DROP COLUMN IF EXISTS search_vector',
+        ],
+    ),
+}
+
+
+def create_index(apps, schema_editor):
+    for statement in SQL.get(schema_editor.connection.vendor, ([], []))[0]:
+        schema_editor.execute(statement)
+
+
+def drop_index(apps, schema_editor):
+    for statement in SQL.get(schema_editor.connection.vendor, ([], []))[1]:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instagram', '0016_media_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('post', 'post'), ('comment', 'comment'), ('user', 'user')], max_length=7)),
+                ('object_id', models.PositiveIntegerField()),
+                ('title', models.CharField(blank=True, max_length=255)),
+                ('body', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+        migrations.RunPython(create_index, drop_index),
+    ]
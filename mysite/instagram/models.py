@@ -1,42 +1,57 @@
-from django.db import models
+import uuid
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Now, Substr
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from phonenumber_field.modelfields import PhoneNumberField
 from django.core.validators import MinValueValidator, MaxValueValidator
 from rest_framework.exceptions import ValidationError
 
 
+class AtomicSaveModel(models.Model):
+    # save() runs in a transaction so counter updates made by
+    # instagram.signals commit or roll back together with the row.
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+
 class UserProfile(AbstractUser):
     phone_number = PhoneNumberField(null=True, blank=True)
     bio = models.TextField(null=True, blank=True)
     age = models.PositiveSmallIntegerField(validators=[MinValueValidator(15),
                                                        MaxValueValidator(85)], null=True, blank=True)
     image = models.ImageField(upload_to='user_images', null=True, blank=True)
+    # Resized copies of image, see instagram.images
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     website = models.URLField(null=True, blank=True)
+    # Denormalized counters, kept in sync by instagram.signals and
+    # repaired by `manage.py recount_counters`.
+    count_follower = models.PositiveIntegerField(default=0)
+    count_following = models.PositiveIntegerField(default=0)
+    count_post = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f'{self.first_name}, {self.last_name}'
 
     def get_count_follower(self):
-        title =self.user_follower.all()
-        if title.exists():
-            return title.count()
-        return 0
+        return self.count_follower
 
     def get_count_following(self):
-        title =self.user_following.all()
-        if title.exists():
-            return title.count()
-        return 0
+        return self.count_following
 
     def get_avg_post(self):
-        total = self.user_post.all()
-        if total.exists():
-            return total.count()
-        return 0
+        return self.count_post
 
 
 
-class Follow(models.Model):
+class Follow(AtomicSaveModel):
     follower = models.ForeignKey(UserProfile, on_delete=models.CASCADE, null=True, blank=True, related_name='user_follower')
     following = models.ForeignKey(UserProfile, on_delete=models.CASCADE, null=True, blank=True, related_name='user_following')
     created_at = models.DateField(auto_now_add=True)
@@ -46,38 +61,118 @@ class Follow(models.Model):
 
     class Meta:
         unique_together = ('follower', 'following')
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+        ]
+
+
+class FollowSuggestion(models.Model):
+    """
+    A second-degree account ``user`` does not follow yet, with the number of
+    accounts ``user`` follows that follow it. Precomputed by
+    ``manage.py compute_follow_suggestions``.
+    """
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='follow_suggestions')
+    suggested = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='+')
+    mutual_count = models.PositiveIntegerField()
+    computed_at = models.DateTimeField()
 
+    def __str__(self):
+        return f'{self.user}, {self.suggested}'
+
+    class Meta:
+        unique_together = ('user', 'suggested')
+        indexes = [
+            models.Index(fields=['user', '-mutual_count', 'suggested']),
+        ]
 
 
-class Post(models.Model):
+
+class Post(AtomicSaveModel):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='user_post')
     image = models.ImageField(upload_to='post_images', null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     video = models.FileField(upload_to='post_videos', null=True, blank=True)
     description = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    count_post_like = models.PositiveIntegerField(default=0)
+    count_comment = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f'{self.user}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+            models.Index(fields=['user', '-created_at', '-id']),
+        ]
+
     def clean(self):
         super().clean()
         if not self.image and not self.video:
             raise ValidationError('Choose minimum one of (image, video)!')
 
     def get_count_post_like(self):
-        total = self.post_like.all()
-        if total.exists():
-            return total.count()
-        return 0
+        return self.count_post_like
 
     def get_count_comment(self):
-        total = self.comment_post.all()
-        if total.exists():
-            return total.count()
-        return 0
+        return self.count_comment
+
 
+class TimelineEntry(models.Model):
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='timeline')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+')
+    author = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()
 
-class PostLike(models.Model):
+    def __str__(self):
+        return f'{self.user}, {self.post_id}'
+
+    class Meta:
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-post']),
+            models.Index(fields=['user', 'author']),
+        ]
+
+
+class PendingFanOut(models.Model):
+    # Written with the post, deleted once every timeline has it; see instagram.feed
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.post_id}'
+
+
+class Hashtag(models.Model):
+    # Normalized (casefolded, without '#'), see instagram.hashtags
+    name = models.CharField(max_length=100, unique=True)
+    # Denormalized, kept in sync by instagram.hashtags and instagram.signals
+    post_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'#{self.name}'
+
+
+class PostHashtag(models.Model):
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='post_hashtags')
+    hashtag = models.ForeignKey(Hashtag, on_delete=models.CASCADE, related_name='post_hashtags')
+    # Copy of post.created_at, so a tag page is one range scan of the index
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.hashtag}, {self.post_id}'
+
+    class Meta:
+        unique_together = ('hashtag', 'post')
+        indexes = [
+            models.Index(fields=['hashtag', '-created_at', '-post']),
+        ]
+
+
+class PostLike(AtomicSaveModel):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='post_like')
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='post_like')
     like = models.BooleanField(null=True, blank=True, default=False)
@@ -88,27 +183,80 @@ class PostLike(models.Model):
 
     class Meta:
         unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+        ]
+
+
+def comment_path_segment(pk):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    segment = ''
+    while pk:
+        pk, rest = divmod(pk, 36)
+        segment = digits[rest] + segment
+    return segment.rjust(Comment.PATH_STEP, '0')
+
 
+class Comment(AtomicSaveModel):
+    # Materialized path: one fixed-width base36 segment per ancestor, so
+    # ordering by path walks the reply tree depth-first and a subtree is a
+    # single prefix range.
+    PATH_STEP = 10
+    MAX_DEPTH = 24
 
-class Comment(models.Model):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comment_post')
     text = models.TextField(null=True, blank=True)
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    count_comment_like = models.PositiveIntegerField(default=0)
+    count_reply = models.PositiveIntegerField(default=0)
+    path = models.CharField(max_length=PATH_STEP * (MAX_DEPTH + 1), blank=True, default='', editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
 
     def get_count_comment_like(self):
-        total = self.comment_like.all()
-        if total.exists():
-            return total.count()
-        return 0
-
+        return self.count_comment_like
 
     def __str__(self):
         return f'{self.user}, {self.text}'
 
+    def clean(self):
+        super().clean()
+        if self.parent is not None and self.parent.depth >= self.MAX_DEPTH:
+            raise ValidationError('Reply chain is too deep!')
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._update_path()
+
+    def _update_path(self):
+        path, depth = '', 0
+        if self.parent_id is not None:
+            path, depth = Comment.objects.filter(pk=self.parent_id).values_list('path', 'depth').get()
+            if self.path and path.startswith(self.path):
+                raise ValidationError('A comment cannot reply to its own reply!')
+            depth += 1
+        path += comment_path_segment(self.pk)
+        if path == self.path:
+            return
+        old_path, old_depth = self.path, self.depth
+        Comment.objects.filter(pk=self.pk).update(path=path, depth=depth)
+        if old_path:
+            (Comment.objects.filter(path__startswith=old_path).exclude(pk=self.pk)
+             .update(path=Concat(Value(path), Substr('path', len(old_path) + 1)),
+                     depth=F('depth') + (depth - old_depth)))
+        self.path, self.depth = path, depth
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+            models.Index(fields=['post', 'depth', 'path']),
+            models.Index(fields=['post', 'path']),
+        ]
 
-class CommentLike(models.Model):
+
+class CommentLike(AtomicSaveModel):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='comment_like')
     like = models.BooleanField(null=True, blank=True, default=False)
@@ -119,17 +267,42 @@ class CommentLike(models.Model):
 
     class Meta:
         unique_together = ('user', 'comment')
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+        ]
+
+
+def default_story_expiry():
+    return timezone.now() + settings.STORY_LIFETIME
+
+
+class StoryQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(expires_at__gt=Now())
+
+    def expired(self):
+        return self.filter(expires_at__lte=Now())
 
 
 class Story(models.Model):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='story_post')
     image = models.ImageField(upload_to='story_images', null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     video = models.FileField(upload_to='story_videos', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(default=default_story_expiry, db_index=True)
+
+    objects = StoryQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.user}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id']),
+            models.Index(fields=['user', 'expires_at']),
+        ]
+
     def clean(self):
         super().clean()
         if not self.image and not self.video:
@@ -148,6 +321,14 @@ class SaveItem(models.Model):
 class Chat(models.Model):
     person = models.ManyToManyField(UserProfile)
     created_date = models.DateField(auto_now_add=True)
+    # Inbox pointers, maintained by instagram.inbox.record_messages()
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_message_at', '-id']),
+        ]
 
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
@@ -156,3 +337,90 @@ class Message(models.Model):
     image = models.ImageField(upload_to='chat_images', null=True, blank=True)
     video = models.FileField(upload_to='chat_videos', null=True, blank=True)
     created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'created_date', 'id']),
+        ]
+
+
+class ChatRead(models.Model):
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='reads')
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_reads')
+    last_read_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('chat', 'user')
+
+
+class MediaBlob(models.Model):
+    """A stored file and the number of references to it, see instagram.storage."""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Upload(models.Model):
+    """A resumable upload; chunks are appended to a temp file until it is completed."""
+    STATUS_CHOICES = (
+        ('pending', 'pending'),
+        ('complete', 'complete'),
+    )
+    KIND_CHOICES = (
+        ('image', 'image'),
+        ('video', 'video'),
+    )
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='uploads')
+    filename = models.CharField(max_length=255)
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    size = models.PositiveBigIntegerField()
+    # SHA-256 of the whole file, checked on completion when given
+    checksum = models.CharField(max_length=64, blank=True)
+    chunk_size = models.PositiveIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    next_chunk = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default='pending')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.filename}'
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+
+class SearchDocument(models.Model):
+    """
+    Searchable text of one post, comment or user, indexed by SQLite FTS5 or
+    a Postgres tsvector column (see migration 0017 and instagram.search).
+    """
+    KIND_CHOICES = (
+        ('post', 'post'),
+        ('comment', 'comment'),
+        ('user', 'user'),
+    )
+    kind = models.CharField(max_length=7, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    # Ranked above body: user names for users, empty otherwise
+    title = models.CharField(max_length=255, blank=True)
+    body = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('kind', 'object_id')
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id}'
@@ -0,0 +1,126 @@
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+def keyset_filter(ordering, values):
+    """
+    Build the lexicographic "rows after ``values``" condition for
+    ``ordering``, e.g. ('-created_at', '-id') ->
+    created_at < c OR (created_at = c AND id < i).
+    """
+    condition = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    return condition
+
+
+def keyset_ordering(model, ordering):
+    """
+    Turn a client-chosen ``ordering`` into one keyset pagination can use:
+    foreign keys compare by their column, and ``id`` breaks ties.
+    """
+    fields = []
+    for field in ordering:
+        name = field.lstrip('-')
+        if name == 'pk':
+            name = 'id'
+        prefix = '-' if field.startswith('-') else ''
+        fields.append(prefix + model._meta.get_field(name).attname)
+    if fields[-1].lstrip('-') != 'id':
+        fields.append(('-' if fields[-1].startswith('-') else '') + 'id')
+    return fields
+
+
+def encode_cursor(values):
+    data = json.dumps([v.isoformat() if hasattr(v, 'isoformat') else v for v in values])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor, model, ordering):
+    """
+    Return the ``ordering`` values of ``cursor`` converted by ``model``'s
+    fields, or None if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(ordering):
+        return None
+    converted = []
+    for field, value in zip(ordering, values):
+        try:
+            value = model._meta.get_field(field.lstrip('-')).to_python(value)
+        except FieldDoesNotExist:
+            pass
+        except (ValidationError, TypeError, ValueError):
+            return None
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        converted.append(value)
+    return converted
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Forward-only keyset pagination. Unlike CursorPagination, which
+    encodes one position field plus an offset, the cursor carries every
+    ordering field, so each page is a single index range scan no matter
+    how deep it is. Views can override the default ordering with
+    ``cursor_ordering``; its last field must be unique. Views with an
+    OrderingFilter are ordered by the ``?ordering=`` the client picked, see
+    keyset_ordering().
+    """
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        for backend in getattr(view, 'filter_backends', ()):
+            if issubclass(backend, OrderingFilter):
+                requested = backend().get_ordering(request, queryset, view)
+                if requested:
+                    return tuple(keyset_ordering(queryset.model, requested))
+        return tuple(getattr(view, 'cursor_ordering', self.ordering))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.ordering = self.get_ordering(request, queryset, view)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            after = decode_cursor(cursor, queryset.model, self.ordering)
+            if after is None:
+                raise NotFound(self.invalid_cursor_message)
+            queryset = queryset.filter(keyset_filter(self.ordering, after))
+
+        results = list(queryset.order_by(*self.ordering)[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        self.has_previous = False
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        values = [getattr(last, field.lstrip('-')) for field in self.ordering]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(values))
+
+    def get_previous_link(self):
+        return None
@@ -0,0 +1,79 @@
+"""
+Presence and typing state shared through the cache.
+
+Each user has one ``presence:<id>`` key holding the time of their last
+heartbeat and one counter of open sockets; a user is online while they
+have a socket open and the heartbeat is younger than PRESENCE['TTL']. Typing events are rate limited
+with an ``add`` on a short-lived key per user and room, so at most one
+typing broadcast per interval leaves any worker.
+"""
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+
+LAST_SEEN_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _presence_key(user_id):
+    return f'presence:{user_id}'
+
+
+def _connections_key(user_id):
+    return f'presence:conn:{user_id}'
+
+
+def _as_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+async def heartbeat(user_id):
+    await cache.aset(_presence_key(user_id), time.time(), timeout=LAST_SEEN_TIMEOUT)
+    await cache.atouch(_connections_key(user_id), timeout=settings.PRESENCE['TTL'] * 10)
+
+
+async def connected(user_id):
+    """Register a socket; returns True when it is the user's first one."""
+    key = _connections_key(user_id)
+    await cache.aadd(key, 0, timeout=settings.PRESENCE['TTL'] * 10)
+    await heartbeat(user_id)
+    try:
+        return await cache.aincr(key) == 1
+    except ValueError:
+        return True
+
+
+async def disconnected(user_id):
+    """Unregister a socket; returns True when the user has none left."""
+    await heartbeat(user_id)
+    try:
+        remaining = await cache.adecr(_connections_key(user_id))
+    except ValueError:
+        return True
+    if remaining <= 0:
+        await cache.adelete(_connections_key(user_id))
+        return True
+    return False
+
+
+async def allow_typing(room, user_id):
+    return await cache.aadd(f'typing:{room}:{user_id}', 1, timeout=settings.PRESENCE['TYPING_INTERVAL'])
+
+
+def get_presence(user_ids):
+    keys = [_presence_key(user_id) for user_id in user_ids]
+    keys += [_connections_key(user_id) for user_id in user_ids]
+    values = cache.get_many(keys)
+    now = time.time()
+    result = {}
+    for user_id in user_ids:
+        last_seen = values.get(_presence_key(user_id))
+        sockets = values.get(_connections_key(user_id)) or 0
+        result[user_id] = {
+            'online': sockets > 0 and last_seen is not None and now - last_seen < settings.PRESENCE['TTL'],
+            'last_seen': _as_datetime(last_seen),
+        }
+    return result
@@ -0,0 +1,119 @@
+"""
+Versioned response cache for hot read endpoints.
+
+Every cached response records the versions of the objects it was built
+from (e.g. ``post:5`` and ``user:3``). Signals bump those versions on
+writes, so a cached response stops matching as soon as any dependency
+changes, and nothing has to be deleted explicitly. Stale entries (expired
+or invalidated) are still served to concurrent readers while one request
+rebuilds them, which keeps hot keys from stampeding the database.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+
+STATS = ('hit', 'miss', 'stale')
+
+
+def _cache():
+    return caches[settings.RESPONSE_CACHE['ALIAS']]
+
+
+def version_key(scope, pk):
+    return f'ver:{scope}:{pk}'
+
+
+def get_versions(keys):
+    cache = _cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Never treat a missing version as a fixed value: an evicted
+            # version key would otherwise revive responses built before
+            # the last bump.
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def bump(*dependencies):
+    cache = _cache()
+    cache.set_many({version_key(scope, pk): time.time_ns() for scope, pk in dependencies if pk is not None},
+                   timeout=None)
+
+
+def _count(stat):
+    cache = _cache()
+    key = f'respcache:stats:{stat}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def stats():
+    cache = _cache()
+    values = cache.get_many([f'respcache:stats:{stat}' for stat in STATS])
+    return {stat: values.get(f'respcache:stats:{stat}', 0) for stat in STATS}
+
+
+class CachedResponseMixin:
+    """
+    Caches successful GET responses of a view. Views list the objects the
+    response depends on in ``get_cache_dependencies()`` and may add more
+    while building the response through ``self.cache_dependencies``.
+
+    Cached data is shared by every viewer. Its per-viewer ``is_following``
+    flags are filled on every request by FollowFlagsMiddleware.
+    """
+    cache_timeout = 60
+    cache_stale_timeout = 30
+    cache_lock_timeout = 10
+
+    def get_cache_key(self, request):
+        return f'resp:{type(self).__name__}:{request.get_full_path()}'
+
+    def get_cache_dependencies(self, request, *args, **kwargs):
+        return []
+
+    def get(self, request, *args, **kwargs):
+        self.cache_dependencies = []
+        if not settings.RESPONSE_CACHE['ENABLED']:
+            return super().get(request, *args, **kwargs)
+
+        cache = _cache()
+        key = self.get_cache_key(request)
+        entry = cache.get(key)
+        locked = False
+        if entry is not None:
+            versions = get_versions(list(entry['versions']))
+            fresh = versions == entry['versions'] and entry['fresh_until'] > time.time()
+            if fresh:
+                _count('hit')
+                return Response(entry['data'])
+            locked = cache.add(f'{key}:lock', 1, timeout=self.cache_lock_timeout)
+            if not locked:
+                _count('stale')
+                return Response(entry['data'])
+
+        _count('miss')
+        try:
+            self.cache_dependencies.extend(self.get_cache_dependencies(request, *args, **kwargs))
+            before = get_versions([version_key(scope, pk) for scope, pk in self.cache_dependencies])
+            response = super().get(request, *args, **kwargs)
+            if response.status_code == 200:
+                versions = get_versions([version_key(scope, pk) for scope, pk in self.cache_dependencies])
+                versions.update(before)
+                cache.set(key, {
+                    'data': response.data,
+                    'versions': versions,
+                    'fresh_until': time.time() + self.cache_timeout,
+                }, timeout=self.cache_timeout + self.cache_stale_timeout)
+        finally:
+            # Also when the rebuild raised (Http404, a database error)
+            if locked:
+                cache.delete(f'{key}:lock')
+        return response
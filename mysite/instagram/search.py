@@ -0,0 +1,114 @@
+"""
+Full-text search over posts, comments and users.
+
+Every searchable row has one SearchDocument, kept current by signals (see
+signals.py) and rebuilt with ``manage.py rebuild_search_index``. Queries
+run against SQLite FTS5, ranked by bm25, or the Postgres tsvector column,
+ranked by ts_rank; both are created by migration 0017. Every word of the
+query has to match and the last one also matches as a prefix, so results
+show up while the user is still typing. Other databases are not
+supported: substring scans cannot keep up with our row counts, so
+``manage.py check`` fails on them (instagram.E001).
+"""
+import re
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+from .models import UserProfile, Post, Comment, SearchDocument
+
+WORD_RE = re.compile(r'[^\W_]+')
+MAX_WORDS = 8
+TITLE_LENGTH = SearchDocument._meta.get_field('title').max_length
+
+
+def _post(post):
+    return '', post.description or ''
+
+
+def _comment(comment):
+    return '', comment.text or ''
+
+
+def _user(user):
+    return ' '.join(filter(None, [user.username, user.first_name, user.last_name])), user.bio or ''
+
+
+# model -> (kind, fields the document is built from, builder returning (title, body))
+DOCUMENTS = {
+    Post: ('post', ('description',), _post),
+    Comment: ('comment', ('text',), _comment),
+    UserProfile: ('user', ('username', 'first_name', 'last_name', 'bio'), _user),
+}
+
+QUERIES = {
+    'sqlite': (
+        'SELECT d.* FROM instagram_searchdocument_fts f '
+        'JOIN instagram_searchdocument d ON d.id = f.rowid '
+        'WHERE instagram_searchdocument_fts MATCH %s{kind} '
+        'ORDER BY bm25(instagram_searchdocument_fts, 10.0, 1.0), d.id LIMIT %s OFFSET %s'
+    ),
+    'postgresql': (
+        "SELECT d.* FROM instagram_searchdocument d, to_tsquery('simple', %s) query "
+        'WHERE d.search_vector @@ query{kind} '
+        'ORDER BY ts_rank(d.search_vector, query) DESC, d.id LIMIT %s OFFSET %s'
+    ),
+}
+
+
+def build_document(instance):
+    """Return an unsaved SearchDocument for ``instance``, or None if it has no text."""
+    kind, fields, build = DOCUMENTS[type(instance)]
+    title, body = build(instance)
+    if not title and not body:
+        return None
+    return SearchDocument(kind=kind, object_id=instance.pk, title=title[:TITLE_LENGTH], body=body)
+
+
+def index(instance):
+    document = build_document(instance)
+    if document is None:
+        return unindex(instance)
+    SearchDocument.objects.update_or_create(
+        kind=document.kind, object_id=document.object_id,
+        defaults={'title': document.title, 'body': document.body},
+    )
+
+
+def unindex(instance):
+    SearchDocument.objects.filter(kind=DOCUMENTS[type(instance)][0], object_id=instance.pk).delete()
+
+
+def match_expression(words, vendor):
+    if vendor == 'postgresql':
+        return ' & '.join(words[:-1] + [words[-1] + ':*'])
+    return ' '.join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+def search(query, kind=None, limit=None, offset=0):
+    """Return the SearchDocuments matching ``query``, best first."""
+    words = WORD_RE.findall(query.lower())[:MAX_WORDS]
+    if not words:
+        return []
+    limit = limit or settings.SEARCH_PAGE_SIZE
+    vendor = connection.vendor
+    if vendor not in QUERIES:
+        raise ImproperlyConfigured(f'Full-text search is not available on {vendor}.')
+    params = [match_expression(words, vendor)]
+    if kind:
+        params.append(kind)
+    sql = QUERIES[vendor].format(kind=' AND d.kind = %s' if kind else '')
+    return list(SearchDocument.objects.raw(sql, params + [limit, offset]))
+
+
+@checks.register()
+def check_search_backend(app_configs, **kwargs):
+    if connection.vendor in QUERIES:
+        return []
+    return [checks.Error(
+        f'Full-text search is not available on {connection.vendor}.',
+        hint=f'Use one of: {", ".join(sorted(QUERIES))}.',
+        id='instagram.E001',
+    )]
@@ -1,7 +1,44 @@
 from rest_framework import serializers
-from .models import UserProfile, Follow, Post, PostLike, Comment, CommentLike, Story, Save, SaveItem
+from .models import (UserProfile, Follow, Post, PostLike, Comment, CommentLike, Story, Save, SaveItem, Chat, Message, Upload, SearchDocument,
+                     FollowSuggestion)
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.core.files.storage import default_storage
+from .images import META_KEYS
+
+
+class FollowFlagField(serializers.ReadOnlyField):
+    """
+    Whether the requesting user follows this user. Serialized as None and
+    filled by FollowFlagsMiddleware with one lookup for the whole response,
+    which also keeps cached responses free of per-viewer data.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = 'pk'
+        super().__init__(**kwargs)
+
+    def to_representation(self, pk):
+        return None
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """URLs and dimensions of the resized copies in ``image_variants``."""
+
+    def to_representation(self, value):
+        request = self.context.get('request')
+        result = {}
+        for size, formats in value.items():
+            if size in META_KEYS:
+                continue
+            result[size] = {}
+            for extension, info in formats.items():
+                url = default_storage.url(info['name'])
+                if request is not None:
+                    url = request.build_absolute_uri(url)
+                result[size][extension] = {'url': url, 'width': info['width'], 'height': info['height']}
+        return result
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -43,44 +80,40 @@ class UserProfileCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserProfile
         fields = '__all__'
+        read_only_fields = ['count_follower', 'count_following', 'count_post']
 
 class UserProfileSimpleSerializer(serializers.ModelSerializer):
+    is_following = FollowFlagField()
+
     class Meta:
         model = UserProfile
-        fields = ['username']
+        fields = ['id', 'username', 'is_following']
 
 class PostSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
         fields = '__all__'
+        read_only_fields = ['count_post_like', 'count_comment']
 
 class PostListSerializer(serializers.ModelSerializer):
     user = UserProfileSimpleSerializer()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Post
-        fields = ['id', 'user', 'image']
+        fields = ['id', 'user', 'image', 'image_variants']
 
 
 
 class UserProfileSerializer(serializers.ModelSerializer):
-    count_follower = serializers.SerializerMethodField()
-    count_following = serializers.SerializerMethodField()
-    avg_post = serializers.SerializerMethodField()
+    avg_post = serializers.IntegerField(source='count_post', read_only=True)
     user_post = PostListSerializer(many=True, read_only=True)
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = UserProfile
-        fields = ['id', 'username', 'first_name', 'last_name', 'image', 'bio','age', 'website', 'count_follower', 'count_following', 'avg_post', 'user_post']
-
-    def get_count_follower(self, obj):
-        return obj.get_count_follower()
-
-    def get_count_following(self, obj):
-        return obj.get_count_following()
-
-    def get_avg_post(self, obj):
-        return obj.get_avg_post()
+        fields = ['id', 'username', 'first_name', 'last_name', 'image', 'image_variants', 'bio','age', 'website', 'count_follower', 'count_following', 'avg_post', 'user_post']
+        read_only_fields = ['count_follower', 'count_following']
 
 
 class FollowSerializer(serializers.ModelSerializer):
@@ -107,6 +140,17 @@ class CommentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = '__all__'
+        read_only_fields = ['count_comment_like', 'count_reply']
+
+    def validate(self, attrs):
+        parent = attrs.get('parent')
+        if parent is not None:
+            post = attrs.get('post') or self.instance.post
+            if parent.post_id != post.pk:
+                raise serializers.ValidationError({'parent': 'The parent comment belongs to another post!'})
+            if parent.depth >= Comment.MAX_DEPTH:
+                raise serializers.ValidationError({'parent': 'Reply chain is too deep!'})
+        return attrs
 
 
 class CommentListSerializer(serializers.ModelSerializer):
@@ -127,22 +171,15 @@ class StoryListSerializer(serializers.ModelSerializer):
 class PostDetailSerializer(serializers.ModelSerializer):
     user = UserProfileSimpleSerializer()
     post_like = PostLikeListSerializer(many=True, read_only=True)
-    count_post_like = serializers.SerializerMethodField()
     comment_post = CommentListSerializer(many=True, read_only=True)
-    count_comment = serializers.SerializerMethodField()
-    story_post = StoryListSerializer(many=True, read_only=True)
+    story_post = StoryListSerializer(source='user.story_post', many=True, read_only=True)
     created_at = serializers.DateTimeField(format('%d-%m-%Y'))
 
 
     class Meta:
         model = Post
         fields = ['user', 'image', 'video', 'story_post', 'post_like', 'count_post_like', 'description', 'count_comment', 'comment_post', 'created_at']
-
-    def get_count_post_like(self, obj):
-        return obj.get_count_post_like()
-
-    def get_count_comment(self, obj):
-        return obj.get_count_comment()
+        read_only_fields = ['count_post_like', 'count_comment']
 
 
 class PostLikeSerializer(serializers.ModelSerializer):
@@ -153,16 +190,22 @@ class PostLikeSerializer(serializers.ModelSerializer):
 
 
 class CommentDetailSerializer(serializers.ModelSerializer):
-    count_comment_like = serializers.SerializerMethodField()
     created_at = serializers.DateTimeField(format('%d-%m-%Y'))
     user = UserProfileSimpleSerializer()
 
     class Meta:
         model = Comment
         fields = ['user', 'text', 'parent', 'count_comment_like', 'created_at']
+        read_only_fields = ['count_comment_like']
+
 
-    def get_count_comment_like(self, obj):
-        return obj.get_count_comment_like()
+class CommentTreeSerializer(serializers.ModelSerializer):
+    user = UserProfileSimpleSerializer()
+    created_at = serializers.DateTimeField(format('%d-%m-%Y'))
+
+    class Meta:
+        model = Comment
+        fields = ['id', 'user', 'text', 'parent', 'depth', 'count_reply', 'count_comment_like', 'created_at']
 
 
 class CommentLikeSerializer(serializers.ModelSerializer):
@@ -171,6 +214,13 @@ class CommentLikeSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class LikeSetSerializer(serializers.Serializer):
+    """Desired like state for a batch of posts or comments."""
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False,
+                                max_length=settings.LIKE_SET_MAX_BATCH)
+    like = serializers.BooleanField(default=True)
+
+
 class CommentLikeListSerializer(serializers.ModelSerializer):
     class Meta:
         model = CommentLike
@@ -189,6 +239,7 @@ class StorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Story
         fields = '__all__'
+        read_only_fields = ['expires_at']
 
 
 class StoryDetailSerializer(serializers.ModelSerializer):
@@ -200,6 +251,19 @@ class StoryDetailSerializer(serializers.ModelSerializer):
         fields = ['user', 'image', 'video', 'created_at']
 
 
+class ActiveStorySerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
+    class Meta:
+        model = Story
+        fields = ['id', 'image', 'image_variants', 'video', 'created_at', 'expires_at']
+
+
+class ActiveStoryGroupSerializer(serializers.Serializer):
+    user = UserProfileSimpleSerializer()
+    stories = ActiveStorySerializer(many=True)
+
+
 class SaveItemSerializer(serializers.ModelSerializer):
     post = PostListSerializer(read_only=True)
     post_id = serializers.PrimaryKeyRelatedField(queryset=Post.objects.all(), write_only=True, source='post')
@@ -218,3 +282,77 @@ class SaveSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'save_item']
 
 
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    author = UserProfileSimpleSerializer()
+
+    class Meta:
+        model = Message
+        fields = ['id', 'chat', 'author', 'text', 'image', 'video', 'created_date']
+
+
+class ChatInboxSerializer(serializers.ModelSerializer):
+    person = UserProfileSimpleSerializer(many=True, read_only=True)
+    last_message = MessageSerializer(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Chat
+        fields = ['id', 'person', 'last_message', 'last_message_at', 'unread_count']
+
+
+class ChatReadSerializer(serializers.Serializer):
+    message = serializers.IntegerField(required=False)
+
+
+class MessageCreateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Message
+        fields = ['id', 'chat', 'text', 'image', 'video', 'created_date']
+
+    def validate_chat(self, chat):
+        if not chat.person.filter(pk=self.context['request'].user.pk).exists():
+            raise serializers.ValidationError('You are not a member of this chat.')
+        return chat
+
+
+class UploadSerializer(serializers.ModelSerializer):
+    chunk_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Upload
+        fields = ['id', 'filename', 'kind', 'size', 'checksum', 'chunk_size', 'chunk_count',
+                  'offset', 'next_chunk', 'status', 'created_at']
+        read_only_fields = ['chunk_size', 'offset', 'next_chunk', 'status', 'created_at']
+
+    def validate_size(self, size):
+        if not 0 < size <= settings.UPLOADS['MAX_SIZE']:
+            raise serializers.ValidationError(f'Size must be between 1 and {settings.UPLOADS["MAX_SIZE"]} bytes.')
+        return size
+
+    def validate_checksum(self, checksum):
+        if checksum and (len(checksum) != 64 or any(c not in '0123456789abcdef' for c in checksum.lower())):
+            raise serializers.ValidationError('Expected a hex SHA-256 digest.')
+        return checksum.lower()
+
+
+class UploadCompleteSerializer(serializers.Serializer):
+    target = serializers.ChoiceField(choices=['post', 'story', 'message'])
+
+
+class SearchResultSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='object_id')
+
+    class Meta:
+        model = SearchDocument
+        fields = ['kind', 'id', 'title', 'body']
+
+
+class FollowSuggestionSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='suggested_id')
+    user = UserProfileSimpleSerializer(source='suggested')
+
+    class Meta:
+        model = FollowSuggestion
+        fields = ['id', 'user', 'mutual_count', 'computed_at']
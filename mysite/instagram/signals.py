@@ -0,0 +1,370 @@
+from functools import partial
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import feed, follow_graph, hashtags, images, response_cache, search, typeahead
+from .counters import adjust
+from .inbox import record_messages
+from .middleware import user_key
+from .models import (UserProfile, Follow, Post, PostLike, Comment, CommentLike, Story, Chat, ChatRead, Message,
+                     Hashtag, PostHashtag)
+
+
+def _remember(instance, *fields):
+    # Called from pre_save, which already runs inside AtomicSaveModel.save(),
+    # so the row lock is held until the counters are updated.
+    instance._previous = None
+    if instance.pk is not None:
+        instance._previous = (type(instance).objects.select_for_update()
+                              .filter(pk=instance.pk).values_list(*fields).first())
+
+
+def _previous(instance, created):
+    if created:
+        return None
+    return getattr(instance, '_previous', None)
+
+
+@receiver(pre_save, sender=Follow)
+def follow_remember_previous(sender, instance, **kwargs):
+    _remember(instance, 'follower_id', 'following_id')
+
+
+@receiver(post_save, sender=Follow)
+def follow_saved(sender, instance, created, **kwargs):
+    previous = _previous(instance, created)
+    if previous is not None:
+        if previous == (instance.follower_id, instance.following_id):
+            return
+        adjust(UserProfile, previous[0], count_follower=-1)
+        adjust(UserProfile, previous[1], count_following=-1)
+        _audience_changed(previous[1])
+        _graph_changed('remove', *previous)
+        feed.remove_follow(*previous)
+    elif not created:
+        return
+    adjust(UserProfile, instance.follower_id, count_follower=1)
+    adjust(UserProfile, instance.following_id, count_following=1)
+    _audience_changed(instance.following_id)
+    _graph_changed('add', instance.follower_id, instance.following_id)
+    transaction.on_commit(partial(feed.backfill_follow, instance.follower_id, instance.following_id))
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    adjust(UserProfile, instance.follower_id, count_follower=-1)
+    adjust(UserProfile, instance.following_id, count_following=-1)
+    _audience_changed(instance.following_id)
+    _graph_changed('remove', instance.follower_id, instance.following_id)
+    feed.remove_follow(instance.follower_id, instance.following_id)
+
+
+def _audience_changed(user_id):
+    # Typeahead ranking; the in-process index follows committed changes only
+    if user_id is not None:
+        transaction.on_commit(partial(typeahead.audience_changed, user_id))
+
+
+def _graph_changed(method, follower_id, following_id):
+    # Likewise for the in-process follow graph
+    transaction.on_commit(partial(follow_graph.apply, method, follower_id, following_id))
+
+
+@receiver(pre_save, sender=Post)
+def post_remember_previous(sender, instance, **kwargs):
+    _remember(instance, 'user_id')
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    previous = _previous(instance, created)
+    if previous is not None:
+        if previous[0] == instance.user_id:
+            return
+        adjust(UserProfile, previous[0], count_post=-1)
+        feed.remove_post(instance.pk)
+    elif not created:
+        return
+    adjust(UserProfile, instance.user_id, count_post=1)
+    feed.schedule_fan_out(instance.pk)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    adjust(UserProfile, instance.user_id, count_post=-1)
+
+
+@receiver(post_save, sender=Post)
+def post_hashtags_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'description' not in update_fields:
+        return
+    hashtags.sync_posts([instance])
+
+
+@receiver(post_delete, sender=PostHashtag)
+def post_hashtag_deleted(sender, instance, **kwargs):
+    adjust(Hashtag, instance.hashtag_id, post_count=-1)
+
+
+def _like_saved(instance, created, target_model, target_fk, counter):
+    target_id = getattr(instance, target_fk)
+    previous = _previous(instance, created)
+    if previous is not None:
+        if (previous[0], bool(previous[1])) == (target_id, bool(instance.like)):
+            return
+        if previous[1]:
+            adjust(target_model, previous[0], **{counter: -1})
+    elif not created:
+        return
+    if instance.like:
+        adjust(target_model, target_id, **{counter: 1})
+
+
+@receiver(pre_save, sender=PostLike)
+def post_like_remember_previous(sender, instance, **kwargs):
+    # Writers of a user's post likes take the user's row first (see
+    # likes.set_likes and like_buffer.apply_events), so an upsert never
+    # meets a row inserted after it read the previous state
+    list(UserProfile.objects.select_for_update().filter(pk=instance.user_id).values_list('pk'))
+    _remember(instance, 'post_id', 'like')
+
+
+@receiver(post_save, sender=PostLike)
+def post_like_saved(sender, instance, created, **kwargs):
+    _like_saved(instance, created, Post, 'post_id', 'count_post_like')
+
+
+@receiver(post_delete, sender=PostLike)
+def post_like_deleted(sender, instance, **kwargs):
+    if instance.like:
+        adjust(Post, instance.post_id, count_post_like=-1)
+
+
+@receiver(pre_save, sender=CommentLike)
+def comment_like_remember_previous(sender, instance, **kwargs):
+    _remember(instance, 'comment_id', 'like')
+
+
+@receiver(post_save, sender=CommentLike)
+def comment_like_saved(sender, instance, created, **kwargs):
+    _like_saved(instance, created, Comment, 'comment_id', 'count_comment_like')
+
+
+@receiver(post_delete, sender=CommentLike)
+def comment_like_deleted(sender, instance, **kwargs):
+    if instance.like:
+        adjust(Comment, instance.comment_id, count_comment_like=-1)
+
+
+@receiver(pre_save, sender=Comment)
+def comment_remember_previous(sender, instance, **kwargs):
+    _remember(instance, 'post_id', 'parent_id')
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    previous = _previous(instance, created)
+    if previous is not None:
+        if previous[0] != instance.post_id:
+            adjust(Post, previous[0], count_comment=-1)
+            adjust(Post, instance.post_id, count_comment=1)
+        if previous[1] != instance.parent_id:
+            adjust(Comment, previous[1], count_reply=-1)
+            adjust(Comment, instance.parent_id, count_reply=1)
+        return
+    if not created:
+        return
+    adjust(Post, instance.post_id, count_comment=1)
+    adjust(Comment, instance.parent_id, count_reply=1)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    adjust(Post, instance.post_id, count_comment=-1)
+    adjust(Comment, instance.parent_id, count_reply=-1)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Comment)
+def search_document_saved(sender, instance, update_fields=None, **kwargs):
+    # Logins save last_login only; skip saves that leave the text alone
+    if update_fields is not None and not set(update_fields) & set(search.DOCUMENTS[sender][1]):
+        return
+    search.index(instance)
+
+
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Comment)
+def search_document_deleted(sender, instance, **kwargs):
+    search.unindex(instance)
+
+
+@receiver(post_save, sender=UserProfile)
+def typeahead_user_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'username', 'is_active'} & set(update_fields):
+        return
+    if instance.is_active:
+        change = ('set_user', instance.pk, instance.username)
+    else:
+        change = ('remove_user', instance.pk)
+    transaction.on_commit(partial(typeahead.apply, *change))
+
+
+@receiver(post_delete, sender=UserProfile)
+def typeahead_user_deleted(sender, instance, **kwargs):
+    transaction.on_commit(partial(typeahead.apply, 'remove_user', instance.pk))
+
+
+def _invalidate(*dependencies):
+    transaction.on_commit(partial(response_cache.bump, *dependencies))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_user(sender, instance, **kwargs):
+    _invalidate(('user', instance.pk))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def forget_socket_user(sender, instance, **kwargs):
+    # Websocket auth caches users per token lifetime; drop stale copies
+    transaction.on_commit(partial(cache.delete, user_key(instance.pk)))
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def invalidate_follow(sender, instance, **kwargs):
+    dependencies = [('user', instance.follower_id), ('user', instance.following_id)]
+    previous = getattr(instance, '_previous', None)
+    if previous is not None:
+        dependencies += [('user', previous[0]), ('user', previous[1])]
+    _invalidate(*dependencies)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post(sender, instance, **kwargs):
+    dependencies = [('post', instance.pk), ('user', instance.user_id)]
+    previous = getattr(instance, '_previous', None)
+    if previous is not None:
+        dependencies.append(('user', previous[0]))
+    _invalidate(*dependencies)
+
+
+@receiver(post_save, sender=PostLike)
+@receiver(post_delete, sender=PostLike)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_post_children(sender, instance, **kwargs):
+    dependencies = [('post', instance.post_id)]
+    previous = getattr(instance, '_previous', None)
+    if previous is not None:
+        dependencies.append(('post', previous[0]))
+    _invalidate(*dependencies)
+
+
+@receiver(post_save, sender=Story)
+@receiver(post_delete, sender=Story)
+def invalidate_story(sender, instance, **kwargs):
+    _invalidate(('user', instance.user_id))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Story)
+def image_saved(sender, instance, **kwargs):
+    # New or replaced uploads get their resized variants after commit
+    if images.needs_variants(instance):
+        images.schedule(instance)
+
+
+MEDIA_FIELDS = {
+    UserProfile: ('image',),
+    Post: ('image', 'video'),
+    Story: ('image', 'video'),
+    Message: ('image', 'video'),
+}
+
+
+def _release_files(instance, names):
+    # Storage keeps a reference per saved file; give them back once the
+    # change is committed, so a rollback never loses a file still in use.
+    # Other backends count nothing, and their files were never deleted.
+    release = getattr(instance._meta.get_field('image').storage, 'release', None)
+    if release is None:
+        return
+    for name in names:
+        if name:
+            transaction.on_commit(partial(release, name), robust=True)
+
+
+@receiver(pre_save, sender=UserProfile)
+@receiver(pre_save, sender=Post)
+@receiver(pre_save, sender=Story)
+@receiver(pre_save, sender=Message)
+def media_remember_previous(sender, instance, update_fields=None, **kwargs):
+    fields = MEDIA_FIELDS[sender]
+    instance._previous_files = None
+    if instance.pk is not None and (update_fields is None or set(fields) & set(update_fields)):
+        instance._previous_files = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+    # Files the field stores during this save, each taking a reference
+    instance._storing_files = {field for field in fields
+                               if getattr(instance, field) and not getattr(instance, field)._committed}
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Story)
+@receiver(post_save, sender=Message)
+def media_replaced(sender, instance, **kwargs):
+    previous = getattr(instance, '_previous_files', None)
+    if previous is None:
+        return
+    stored = getattr(instance, '_storing_files', set())
+    # Identical content gets the same name, and a second reference that
+    # replaces the first
+    _release_files(instance, [old for field, old in zip(MEDIA_FIELDS[sender], previous)
+                              if old != getattr(instance, field).name or field in stored])
+
+
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Story)
+@receiver(post_delete, sender=Message)
+def media_deleted(sender, instance, **kwargs):
+    names = [getattr(instance, field).name for field in MEDIA_FIELDS[sender]]
+    if hasattr(instance, 'image_variants'):
+        names += images.variant_files(instance.image_variants)
+    _release_files(instance, names)
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    # Messages written by the chat buffer use bulk_create and are recorded there
+    if created:
+        record_messages([instance])
+
+
+@receiver(m2m_changed, sender=Chat.person.through)
+def chat_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        pairs = [(chat_id, instance.pk) for chat_id in pk_set or ()]
+    else:
+        pairs = [(instance.pk, user_id) for user_id in pk_set or ()]
+    if action == 'post_add':
+        ChatRead.objects.bulk_create([ChatRead(chat_id=chat_id, user_id=user_id) for chat_id, user_id in pairs],
+                                     ignore_conflicts=True)
+    elif action == 'post_remove':
+        for chat_id, user_id in pairs:
+            ChatRead.objects.filter(chat_id=chat_id, user_id=user_id).delete()
+    elif action == 'pre_clear':
+        if reverse:
+            ChatRead.objects.filter(user=instance).delete()
+        else:
+            ChatRead.objects.filter(chat=instance).delete()
@@ -0,0 +1,134 @@
+"""
+Content-addressed media storage.
+
+Every saved file is hashed while it is streamed to a temp file and stored
+once as ``blobs/<h[:2]>/<h[2:4]>/<sha256><ext>``, whatever ``upload_to``
+asked for; saving identical bytes again returns the existing name. The
+two-level shard keeps directories small.
+
+Each save() hands out one reference, counted in MediaBlob, and release()
+(or delete(), which is the same) gives one back; the file is removed only
+when its last reference goes. Model rows release their files on delete
+and on replacement (see signals.py), and ``manage.py
+reconcile_media_blobs`` repairs the counts. A name without a MediaBlob
+row is never removed here: files stored before this backend was enabled
+keep their old names and may be shared by any number of rows, and a
+blob that lost its row gets it back, or is removed, once the reconcile
+command has counted its references.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import MediaBlob
+
+BLOB_DIR = 'blobs'
+READ_SIZE = 64 * 1024
+
+
+def blob_name(digest, extension):
+    return posixpath.join(BLOB_DIR, digest[:2], digest[2:4], digest + extension.lower())
+
+
+def is_blob(name):
+    return name.startswith(BLOB_DIR + '/')
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(READ_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # Names are derived from the content in _save(); never suffix them
+        return name
+
+    def _write_temp(self, content):
+        """Stream ``content`` to a temp file next to the blobs; return (path, digest, size)."""
+        directory = self.path(BLOB_DIR)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    target.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest(), size
+
+    def _save(self, name, content):
+        if hasattr(content, 'temporary_file_path'):
+            # Already on disk: hash it in place and move it, like FileSystemStorage
+            source_path, owned = content.temporary_file_path(), False
+            digest, size = file_digest(source_path)
+        else:
+            (source_path, digest, size), owned = self._write_temp(content), True
+        name = blob_name(digest, os.path.splitext(name)[1])
+        try:
+            with transaction.atomic():
+                self._acquire(name, size)
+                # Still under the blob's row lock, so a concurrent release
+                # cannot remove the file between this check and the move
+                if not os.path.exists(self.path(name)):
+                    os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+                    file_move_safe(source_path, self.path(name), allow_overwrite=True)
+                    if self.file_permissions_mode is not None:
+                        os.chmod(self.path(name), self.file_permissions_mode)
+        finally:
+            if owned and os.path.exists(source_path):
+                os.remove(source_path)
+        return name
+
+    def _acquire(self, name, size):
+        blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+        if blob is not None:
+            MediaBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+            return
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(name=name, size=size, refcount=1)
+        except IntegrityError:
+            MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + 1)
+
+    def release(self, name):
+        """Give back one reference to a blob; names without a MediaBlob row are kept."""
+        if not name:
+            raise ValueError('The name must be given to release().')
+        if not is_blob(name):
+            return
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                return
+            if blob.refcount > 1:
+                MediaBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+                return
+            blob.delete()
+            super().delete(name)
+
+    def delete(self, name):
+        """Same as release(); use remove() to delete a file outright."""
+        self.release(name)
+
+    def remove(self, name):
+        """Delete the file whatever references it; for reconcile_media_blobs."""
+        super().delete(name)
@@ -0,0 +1,38 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import translation
+
+
+@contextmanager
+def assert_max_queries(budget, using=DEFAULT_DB_ALIAS):
+    """Fail if the block runs more than ``budget`` SQL queries."""
+    with CaptureQueriesContext(connections[using]) as context:
+        yield context
+    if len(context) > budget:
+        queries = '\n'.join(f'{i}. {query["sql"]}' for i, query in enumerate(context.captured_queries, 1))
+        raise AssertionError(f'{len(context)} queries executed, budget is {budget}:\n{queries}')
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin that requests ``url`` and fails when the resolved view
+    runs more queries than its ``query_budget`` attribute declares.
+    """
+
+    def assertWithinQueryBudget(self, url, method='get', client=None, **kwargs):
+        path = url.split('?')[0]
+        # URLs are language-prefixed; resolve in the language of the path
+        with translation.override(translation.get_language_from_path(path)):
+            view = resolve(path).func
+        # ViewSets keep their class under ``cls``
+        view_class = getattr(view, 'view_class', None) or view.cls
+        budget = getattr(view_class, 'query_budget', None)
+        if budget is None:
+            self.fail(f'{view_class.__name__} does not declare a query_budget')
+        client = client or self.client
+        with assert_max_queries(budget):
+            response = getattr(client, method)(url, **kwargs)
+        return response
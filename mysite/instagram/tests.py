@@ -1,3 +1,1227 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.core import checks
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image as PILImage
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (chat_buffer, feed, follow_graph, frames, hashtags, images, like_buffer, middleware, presence, search,
+               typeahead, uploads)
+from .local_index import LocalIndex
+from .middleware import JWTAuthMiddleware
+from .inbox import record_messages
+from .models import (UserProfile, Follow, FollowSuggestion, Post, PostLike, Comment, CommentLike, Story, Save,
+                     SaveItem, Chat, Message, MediaBlob, TimelineEntry, PendingFanOut, Upload, Hashtag, PostHashtag)
+from .routing import websocket_urlpatterns
+from .testing import QueryBudgetMixin
+
+
+def make_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+@override_settings(FEED_FANOUT_ASYNC=False)
+class UserCounterTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(follow_graph.graph, '_refresh_in_background'))
+        self.alice = UserProfile.objects.create_user('alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def counts(self):
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        return self.alice.count_follower, self.bob.count_following
+
+    def follow(self):
+        response = self.client.post('/en/follows/', {'follower': self.alice.pk, 'following': self.bob.pk})
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def test_follow_unfollow_and_follow_again(self):
+        pk = self.follow()
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertEqual(self.client.delete(f'/en/follows/{pk}/').status_code, 204)
+        self.assertEqual(self.counts(), (0, 0))
+        self.follow()
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_post_count(self):
+        posts = [Post.objects.create(user=self.alice) for _ in range(2)]
+        posts[0].delete()
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.count_post, 1)
+
+    def test_recount_repairs_drift(self):
+        self.follow()
+        UserProfile.objects.filter(pk=self.bob.pk).update(count_following=5)
+        call_command('recount_counters', stdout=StringIO())
+        self.assertEqual(self.counts(), (1, 1))
+
+
+@override_settings(FEED_FANOUT_ASYNC=False)
+class PostCounterTests(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        self.post = Post.objects.create(user=self.user)
+
+    def refreshed(self, instance):
+        instance.refresh_from_db()
+        return instance
+
+    def test_like_toggle_and_delete(self):
+        like = PostLike.objects.create(user=self.user, post=self.post, like=True)
+        self.assertEqual(self.refreshed(self.post).count_post_like, 1)
+        like.like = False
+        like.save()
+        self.assertEqual(self.refreshed(self.post).count_post_like, 0)
+        like.like = True
+        like.save()
+        like.delete()
+        self.assertEqual(self.refreshed(self.post).count_post_like, 0)
+
+    def test_comment_counts(self):
+        comment = Comment.objects.create(user=self.user, post=self.post, text='first')
+        reply = Comment.objects.create(user=self.user, post=self.post, parent=comment, text='reply')
+        CommentLike.objects.create(user=self.user, comment=comment, like=True)
+        self.assertEqual(self.refreshed(self.post).count_comment, 2)
+        self.assertEqual((self.refreshed(comment).count_reply, comment.count_comment_like), (1, 1))
+        reply.delete()
+        self.assertEqual(self.refreshed(self.post).count_comment, 1)
+        self.assertEqual(self.refreshed(comment).count_reply, 0)
+
+    def test_moved_comment_moves_its_count(self):
+        other = Post.objects.create(user=self.user)
+        comment = Comment.objects.create(user=self.user, post=self.post, text='first')
+        comment.post = other
+        comment.save()
+        self.assertEqual((self.refreshed(self.post).count_comment, self.refreshed(other).count_comment), (0, 1))
+
+
+@override_settings(LIKE_BUFFER={**settings.LIKE_BUFFER, 'ENABLED': False})
+class LikeSetTests(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        self.posts = [Post.objects.create(user=self.user) for _ in range(2)]
+        self.comment = Comment.objects.create(user=self.user, post=self.posts[0], text='first')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def set(self, url, ids, like=True):
+        response = self.client.post(url, {'ids': ids, 'like': like}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_repeated_request_changes_nothing(self):
+        ids = [post.pk for post in self.posts]
+        for _ in range(2):
+            data = self.set('/en/post_like/set/', ids)
+            self.assertEqual(data['results'], [{'id': pk, 'count_post_like': 1} for pk in ids])
+        self.assertEqual(PostLike.objects.filter(user=self.user, like=True).count(), 2)
+        for _ in range(2):
+            data = self.set('/en/post_like/set/', ids, like=False)
+            self.assertEqual(data['results'], [{'id': pk, 'count_post_like': 0} for pk in ids])
+        self.assertEqual(PostLike.objects.filter(user=self.user).count(), 2)
+
+    def test_mixed_previous_state(self):
+        PostLike.objects.create(user=self.user, post=self.posts[0], like=True)
+        data = self.set('/en/post_like/set/', [self.posts[0].pk, self.posts[1].pk, self.posts[1].pk])
+        self.assertEqual([row['count_post_like'] for row in data['results']], [1, 1])
+
+    def test_missing_targets(self):
+        data = self.set('/en/post_like/set/', [self.posts[0].pk, 999999])
+        self.assertEqual(data['missing'], [999999])
+        self.assertEqual(len(data['results']), 1)
+
+    def test_comment_likes(self):
+        for _ in range(2):
+            data = self.set('/en/comment_like/set/', [self.comment.pk])
+            self.assertEqual(data['results'], [{'id': self.comment.pk, 'count_comment_like': 1}])
+        self.set('/en/comment_like/set/', [self.comment.pk], like=False)
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.count_comment_like, 0)
+
+
+@override_settings(FEED_FANOUT_ASYNC=False)
+class KeysetCursorTests(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice', password='secret')
+        self.author = UserProfile.objects.create_user('bob', password='secret')
+        Follow.objects.create(follower=self.user, following=self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts = [Post.objects.create(user=self.author) for _ in range(3)]
+        follow_graph.graph.refresh()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        follow_graph.reset()
+
+    def test_malformed_cursor_values_are_not_found(self):
+        for url in ('/en/post/', '/en/feed/'):
+            for values in (['garbage', 1], [{'a': 1}, 1], [None, 1], ['2024-01-01T00:00:00Z', 'x'], [1]):
+                with self.subTest(url=url, values=values):
+                    response = self.client.get(url, {'cursor': make_cursor(values)})
+                    self.assertEqual(response.status_code, 404)
+
+    def test_next_cursor_round_trips(self):
+        for url in ('/en/post/', '/en/feed/'):
+            with self.subTest(url=url):
+                response = self.client.get(url, {'cursor': make_cursor([self.posts[2].created_at.isoformat(),
+                                                                        self.posts[2].pk])})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([post['id'] for post in response.data['results']],
+                                 [self.posts[1].pk, self.posts[0].pk])
+
+
+class FollowOrderingTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(follow_graph.graph, '_refresh_in_background'))
+        self.users = [UserProfile.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+        for follower, following in ((0, 2), (1, 0), (2, 1), (1, 2)):
+            Follow.objects.create(follower=self.users[follower], following=self.users[following])
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def pages(self, ordering):
+        pairs = []
+        response = self.client.get('/en/follows/', {'ordering': ordering, 'page_size': 1})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pairs += [(follow['follower'], follow['following']) for follow in response.data['results']]
+            if not response.data['next']:
+                return pairs
+            response = self.client.get(response.data['next'])
+
+    def test_ordering_is_kept_across_pages(self):
+        follows = Follow.objects.all()
+        for ordering, fields in (('follower', ('follower', 'id')), ('-following', ('-following', '-id'))):
+            with self.subTest(ordering=ordering):
+                self.assertEqual(self.pages(ordering),
+                                 list(follows.order_by(*fields).values_list('follower', 'following')))
+
+
+class FollowSuggestionTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(follow_graph.graph, '_refresh_in_background'))
+        self.alice, self.bob, self.carol, self.dave, self.erin = (
+            UserProfile.objects.create_user(name) for name in ('alice', 'bob', 'carol', 'dave', 'erin'))
+        for follower, following in ((self.alice, self.bob), (self.alice, self.carol), (self.bob, self.dave),
+                                    (self.bob, self.erin), (self.carol, self.dave), (self.carol, self.alice)):
+            Follow.objects.create(follower=follower, following=following)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def suggested(self, user):
+        return list(FollowSuggestion.objects.filter(user=user).order_by('-mutual_count', 'suggested_id')
+                    .values_list('suggested_id', 'mutual_count'))
+
+    def test_mutual_counts_exclude_followed_and_self(self):
+        for _ in range(2):
+            call_command('compute_follow_suggestions', batch_size=2, stdout=StringIO())
+        self.assertEqual(self.suggested(self.alice), [(self.dave.pk, 2), (self.erin.pk, 1)])
+        self.assertEqual(self.suggested(self.carol), [(self.bob.pk, 1)])
+
+    def test_limit_keeps_the_best(self):
+        call_command('compute_follow_suggestions', limit=1, stdout=StringIO())
+        self.assertEqual(self.suggested(self.alice), [(self.dave.pk, 2)])
+
+    def test_list_drops_accounts_followed_since(self):
+        call_command('compute_follow_suggestions', stdout=StringIO())
+        Follow.objects.create(follower=self.alice, following=self.dave)
+        response = self.client.get('/en/suggestions/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['id'], row['mutual_count']) for row in response.data['results']],
+                         [(self.erin.pk, 1)])
+
+
+class ChatInboxTests(TestCase):
+    def setUp(self):
+        self.alice = UserProfile.objects.create_user('alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.chat = Chat.objects.create()
+        self.chat.person.add(self.alice, self.bob)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, author, text='hello'):
+        return Message.objects.create(chat=self.chat, author=author, text=text)
+
+    def unread(self):
+        response = self.client.get('/en/chat/')
+        self.assertEqual(response.status_code, 200)
+        return {chat['id']: chat['unread_count'] for chat in response.data['results']}[self.chat.pk]
+
+    def test_unread_count_after_read_and_new_message(self):
+        first = self.send(self.bob)
+        self.send(self.bob)
+        self.send(self.alice)
+        self.assertEqual(self.unread(), 2)
+        response = self.client.post(f'/en/chat/{self.chat.pk}/read/', {})
+        self.assertEqual(response.data['unread_count'], 0)
+        self.assertEqual(self.unread(), 0)
+        self.send(self.bob)
+        self.assertEqual(self.unread(), 1)
+        # Read only up to the first message
+        response = self.client.post(f'/en/chat/{self.chat.pk}/read/', {'message': first.pk})
+        self.assertEqual(response.data['unread_count'], 2)
+        self.assertEqual(self.unread(), 2)
+
+    def test_history_before_a_message(self):
+        messages = [self.send(self.bob, str(i)) for i in range(3)]
+        response = self.client.get(f'/en/chat/{self.chat.pk}/messages/', {'before': messages[2].pk})
+        self.assertEqual([message['id'] for message in response.data['results']],
+                         [messages[1].pk, messages[0].pk])
+
+    def test_non_members_get_not_found(self):
+        self.client.force_authenticate(UserProfile.objects.create_user('carol'))
+        self.assertEqual(self.client.get(f'/en/chat/{self.chat.pk}/messages/').status_code, 404)
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Every view with a ``query_budget``, requested the way clients do: with a JWT and a cold response cache."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create_user('alice', password='secret')
+        cls.others = [UserProfile.objects.create_user(f'user{i}', password='secret') for i in range(3)]
+        for other in cls.others:
+            Follow.objects.create(follower=cls.user, following=other)
+            Follow.objects.create(follower=other, following=cls.user)
+        FollowSuggestion.objects.create(user=cls.user, suggested=UserProfile.objects.create_user('carol'),
+                                        mutual_count=2, computed_at=timezone.now())
+        cls.posts = []
+        for other in cls.others:
+            for i in range(2):
+                post = Post.objects.create(user=other, description=f'#sunset number {i}')
+                cls.posts.append(post)
+                Story.objects.create(user=other, image='story_images/a.jpg')
+                PostLike.objects.create(user=cls.user, post=post, like=True)
+                comment = Comment.objects.create(user=cls.user, post=post, text='nice')
+                reply = Comment.objects.create(user=other, post=post, parent=comment, text='thanks')
+                CommentLike.objects.create(user=other, comment=comment, like=True)
+                CommentLike.objects.create(user=cls.user, comment=reply, like=True)
+        cls.post = cls.posts[0]
+        cls.comment = Comment.objects.filter(post=cls.post, parent=None).first()
+        # SaveItem.save is the foreign key, so the row can't be saved with save()
+        cls.save_item, = SaveItem.objects.bulk_create([SaveItem(post=cls.post, save=Save.objects.create(user=cls.user))])
+        cls.chat = Chat.objects.create()
+        cls.chat.person.add(cls.user, *cls.others)
+        record_messages([Message.objects.create(chat=cls.chat, author=author, text='hello')
+                         for author in [cls.user, *cls.others]])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        # Loaded as the worker would at startup, not inside the measured request
+        follow_graph.reset()
+        typeahead.reset()
+        follow_graph.graph.refresh()
+        typeahead.index.refresh()
+
+    def tearDown(self):
+        follow_graph.reset()
+        typeahead.reset()
+
+    def test_views_stay_within_query_budget(self):
+        urls = [
+            '/en/user/',
+            '/en/follows/',
+            '/en/follows/?ordering=-following',
+            '/en/suggestions/',
+            '/en/post/',
+            '/en/feed/',
+            f'/en/post/{self.post.pk}/',
+            f'/en/post/{self.post.pk}/comments/',
+            '/en/tag/sunset/posts/',
+            '/en/user/typeahead/?q=us',
+            '/en/search/?q=sunset',
+            '/en/post_like/',
+            f'/en/post_like/{PostLike.objects.first().pk}/',
+            '/en/comment/',
+            f'/en/comment/{self.comment.pk}/',
+            '/en/comment_like/',
+            f'/en/comment_like/{CommentLike.objects.first().pk}/',
+            '/en/story/',
+            '/en/story/active/',
+            f'/en/story/{Story.objects.first().pk}/',
+            '/en/save/',
+            f'/en/save/{self.save_item.pk}/',
+            '/en/chat/',
+            f'/en/chat/{self.chat.pk}/messages/',
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.assertWithinQueryBudget(url)
+                self.assertEqual(response.status_code, 200, response.data)
+
+
+class TypeaheadIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        typeahead.reset()
+        self.user = UserProfile.objects.create_user('alice')
+        self.stars = [UserProfile.objects.create_user(name) for name in ('anna', 'andrew')]
+
+    def tearDown(self):
+        typeahead.reset()
+
+    def follow(self, following):
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(follower=self.user, following=following)
+
+    def test_search_queries_the_database_until_loaded(self):
+        self.follow(self.stars[1])
+        with mock.patch.object(typeahead.index, '_refresh_in_background') as refresh, self.assertNumQueries(1):
+            results = typeahead.search('an', 10)
+        refresh.assert_called_once_with()
+        self.assertEqual([pk for pk, username, audience in results], [self.stars[1].pk, self.stars[0].pk])
+
+    def test_rebuild_does_not_count_changes_twice(self):
+        load = typeahead.index.load
+
+        def load_after_follow():
+            # Committed after the rebuild read the journal position
+            self.follow(self.stars[0])
+            return load()
+
+        with mock.patch.object(typeahead.index, 'load', load_after_follow):
+            typeahead.index.refresh()
+        self.assertEqual(typeahead.search('anna', 1), [(self.stars[0].pk, 'anna', 1)])
+
+    def test_changes_reach_other_workers(self):
+        other = LocalIndex('username index', typeahead.load, lambda: 300)
+        other.refresh()
+        typeahead.index.refresh()
+        self.follow(self.stars[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stars[0].username = 'annabel'
+            self.stars[0].save()
+        self.assertEqual(other.get().search('an', 10),
+                         [(self.stars[1].pk, 'andrew', 1), (self.stars[0].pk, 'annabel', 0)])
+
+
+class FollowFlagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        follow_graph.reset()
+        self.user = UserProfile.objects.create_user('alice')
+        self.authors = [UserProfile.objects.create_user(name) for name in ('bob', 'carol', 'dave')]
+        for author in self.authors:
+            Post.objects.create(user=author)
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(follower=self.user, following=self.authors[0])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        follow_graph.reset()
+
+    def flags(self, url):
+        return {post['user']['id']: post['user']['is_following'] for post in self.client.get(url).data['results']}
+
+    def test_flags_come_from_one_query_until_the_graph_is_loaded(self):
+        expected = {self.authors[0].pk: True, self.authors[1].pk: False, self.authors[2].pk: False}
+        with mock.patch.object(follow_graph.graph, '_refresh_in_background') as refresh:
+            with self.assertNumQueries(2):
+                self.assertEqual(self.flags('/en/post/'), expected)
+        refresh.assert_called_with()
+        follow_graph.graph.refresh()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.flags('/en/post/'), expected)
+
+    def test_cached_responses_are_flagged_per_viewer(self):
+        follow_graph.graph.refresh()
+        post = Post.objects.get(user=self.authors[0])
+        other = APIClient()
+        other.force_authenticate(self.authors[1])
+        self.assertTrue(self.client.get(f'/en/post/{post.pk}/').data['user']['is_following'])
+        self.assertFalse(other.get(f'/en/post/{post.pk}/').data['user']['is_following'])
+
+    def test_follows_reach_other_workers(self):
+        other = LocalIndex('follow graph', follow_graph.load, lambda: 600)
+        other.refresh()
+        follow_graph.graph.refresh()
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.create(follower=self.user, following=self.authors[2])
+            Follow.objects.filter(following=self.authors[0]).delete()
+        self.assertEqual(other.get().is_following(self.user.pk, [author.pk for author in self.authors]),
+                         {self.authors[0].pk: False, self.authors[1].pk: False, self.authors[2].pk: True})
+
+
+@override_settings(LIKE_BUFFER={**settings.LIKE_BUFFER, 'ENABLED': True}, FEED_FANOUT_ASYNC=False)
+class LikeBufferTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserProfile.objects.create_user('alice')
+        self.post = Post.objects.create(user=self.user)
+
+    def pending(self):
+        return like_buffer.pending_counts({self.post.pk: 0})[self.post.pk]
+
+    def stored(self):
+        self.post.refresh_from_db()
+        return self.post.count_post_like
+
+    def test_repeated_taps_are_one_like(self):
+        for _ in range(3):
+            like_buffer.record_likes(self.user, [self.post.pk], True)
+        self.assertEqual(self.pending(), 1)
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual((self.stored(), self.pending()), (1, 0))
+
+    def test_concurrent_taps_are_one_like(self):
+        real = like_buffer._cache()
+
+        class SlowCache:
+            # Widens the window between reading the previous state and writing the new one
+            def __getattr__(self, name):
+                return getattr(real, name)
+
+            def get_many(self, keys):
+                values = real.get_many(keys)
+                time.sleep(0.05)
+                return values
+
+        barrier = threading.Barrier(4)
+        conflicts = []
+
+        def tap():
+            try:
+                barrier.wait()
+                like_buffer.record_likes(self.user, [self.post.pk], True)
+            except like_buffer.LikeConflict:
+                conflicts.append(1)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=tap) for _ in range(4)]
+        with mock.patch.object(like_buffer, '_cache', SlowCache):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.pending(), 1)
+        self.assertLess(len(conflicts), 4)
+        like_buffer.flush()
+        self.assertEqual(self.stored(), 1)
+
+    def test_busy_user_lock_is_a_conflict(self):
+        cache.add(f'likebuf:lock:user:{self.user.pk}', 1)
+        with self.assertRaises(like_buffer.LikeConflict):
+            like_buffer.record_likes(self.user, [self.post.pk], True)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/en/post_like/set/', {'ids': [self.post.pk], 'like': True}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+    def test_flush_waits_for_a_slow_writer(self):
+        other = UserProfile.objects.create_user('bob')
+        # bob's writer took its sequence number but has not stored the event yet
+        cache.add(like_buffer.SEQ_KEY, 0, timeout=None)
+        cache.incr(like_buffer.SEQ_KEY)
+        like_buffer.record_likes(self.user, [self.post.pk], True)
+        self.assertEqual(like_buffer.flush(), 0)
+        cache.set(like_buffer._event_key(1), (other.pk, self.post.pk, True, 1))
+        like_buffer._add_delta(cache, self.post.pk, 1)
+        self.assertEqual(like_buffer.flush(), 2)
+        self.assertEqual((self.stored(), self.pending()), (2, 0))
+
+    def test_flush_skips_a_lost_event_after_the_grace_period(self):
+        cache.add(like_buffer.SEQ_KEY, 0, timeout=None)
+        cache.incr(like_buffer.SEQ_KEY)
+        like_buffer.record_likes(self.user, [self.post.pk], True)
+        self.assertEqual(like_buffer.flush(), 0)
+        with mock.patch.object(like_buffer.time, 'time', return_value=time.time() + 61), \
+                self.assertLogs('instagram.like_buffer', 'WARNING'):
+            self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual((self.stored(), self.pending()), (1, 0))
+
+    def test_duplicate_events_count_once(self):
+        event = (self.user.pk, self.post.pk, True, 1)
+        self.assertEqual(like_buffer.apply_events([event, event]), [self.post.pk])
+        self.assertEqual(self.stored(), 1)
+        # The row already holds the like; replaying the event changes nothing
+        self.assertEqual(like_buffer.apply_events([event]), [])
+        self.assertEqual(self.stored(), 1)
+        self.assertEqual(PostLike.objects.get().like, True)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        # Flags come from the database; no background load of the follow graph
+        self.enterContext(mock.patch.object(follow_graph.graph, '_refresh_in_background'))
+        cache.clear()
+        self.user = UserProfile.objects.create_user('alice')
+        self.commenter = UserProfile.objects.create_user('bob')
+        self.post = Post.objects.create(user=self.user)
+        Comment.objects.create(user=self.commenter, post=self.post, text='nice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f'/en/post/{self.post.pk}/'
+
+    def test_renamed_commenter_invalidates_post_detail(self):
+        self.assertEqual(self.client.get(self.url).data['comment_post'][0]['user']['username'], 'bob')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.commenter.username = 'robert'
+            self.commenter.save()
+        self.assertEqual(self.client.get(self.url).data['comment_post'][0]['user']['username'], 'robert')
+
+    def test_failed_rebuild_releases_lock(self):
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post.description = 'changed'
+            self.post.save()
+        key = f'resp:PostDetailAPIView:{self.url}'
+        with mock.patch('rest_framework.generics.RetrieveAPIView.get', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.get(self.url)
+        self.assertIsNone(cache.get(f'{key}:lock'))
+        self.assertEqual(self.client.get(self.url).data['description'], 'changed')
+
+
+class MediaReleaseTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.user = UserProfile.objects.create_user('alice')
+
+    def delete(self, instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.delete()
+
+    def test_blob_goes_with_its_last_reference(self):
+        first, second = [Post.objects.create(user=self.user, video=ContentFile(b'same', name='a.mp4'))
+                         for _ in range(2)]
+        name = first.video.name
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 2)
+        self.delete(first)
+        self.assertTrue(default_storage.exists(name))
+        self.delete(second)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+
+    def test_files_without_blob_row_are_kept(self):
+        for name in ('post_videos/legacy.mp4', 'blobs/00/00/unknown.mp4'):
+            with self.subTest(name=name):
+                path = default_storage.path(name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as file:
+                    file.write(b'legacy')
+                self.delete(Post.objects.create(user=self.user, video=name))
+                self.assertTrue(default_storage.exists(name))
+                default_storage.delete(name)
+                self.assertTrue(default_storage.exists(name))
+
+    def test_saving_the_same_content_again_keeps_one_reference(self):
+        post = Post.objects.create(user=self.user, video=ContentFile(b'same', name='a.mp4'))
+        with self.captureOnCommitCallbacks(execute=True):
+            post.video = ContentFile(b'same', name='b.mp4')
+            post.save()
+        self.assertEqual(MediaBlob.objects.get(name=post.video.name).refcount, 1)
+        self.delete(post)
+        self.assertFalse(MediaBlob.objects.exists())
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        os.makedirs(os.path.join(media_root, 'post_videos'))
+        with open(os.path.join(media_root, 'post_videos', 'a.mp4'), 'wb') as file:
+            file.write(b'0123456789')
+        self.url = '/media/post_videos/a.mp4'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_whole_file(self):
+        response, body = self.get()
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_ranges(self):
+        for header, content_range, body in (('bytes=2-4', 'bytes 2-4/10', b'234'),
+                                            ('bytes=7-', 'bytes 7-9/10', b'789'),
+                                            ('bytes=-3', 'bytes 7-9/10', b'789'),
+                                            ('bytes=8-100', 'bytes 8-9/10', b'89')):
+            with self.subTest(header=header):
+                response, content = self.get(Range=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual((response['Content-Range'], response['Content-Length'], content),
+                                 (content_range, str(len(body)), body))
+
+    def test_unsatisfiable_range(self):
+        for header in ('bytes=10-', 'bytes=5-2', 'bytes=-0'):
+            with self.subTest(header=header):
+                response, _ = self.get(Range=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_if_range(self):
+        etag = self.get()[0]['ETag']
+        response, body = self.get(Range='bytes=0-1', If_Range=etag)
+        self.assertEqual((response.status_code, body), (206, b'01'))
+        # The file changed since the client saw it: the whole file, not a slice of the new one
+        response, body = self.get(Range='bytes=0-1', If_Range='"stale"')
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+
+    def test_conditional_get(self):
+        etag = self.get()[0]['ETag']
+        self.assertEqual(self.get(If_None_Match=etag)[0].status_code, 304)
+
+    def test_outside_media_root_is_not_found(self):
+        self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
+
+    @override_settings(MEDIA_SERVING={**settings.MEDIA_SERVING, 'SENDFILE': 'x-accel-redirect'})
+    def test_sendfile_offload(self):
+        response, body = self.get(Range='bytes=0-1')
+        self.assertEqual((response.status_code, body), (200, b''))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/post_videos/a.mp4')
+
+
+@override_settings(IMAGE_VARIANTS={**settings.IMAGE_VARIANTS, 'SIZES': {'thumb': {'size': (4, 4), 'crop': True}},
+                                   'FORMATS': ['jpeg'], 'ASYNC': False}, FEED_FANOUT_ASYNC=False)
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.user = UserProfile.objects.create_user('alice')
+
+    def jpeg(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (8, 8), 'red').save(buffer, 'JPEG')
+        return ContentFile(buffer.getvalue(), name='a.jpg')
+
+    def test_variants_are_listed_and_replaced(self):
+        self.enterContext(mock.patch.object(follow_graph.graph, '_refresh_in_background'))
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(user=self.user, image=self.jpeg())
+        post.refresh_from_db()
+        old = post.image_variants['thumb']['jpeg']['name']
+        client = APIClient()
+        client.force_authenticate(self.user)
+        variants = client.get('/en/post/').data['results'][0]['image_variants']
+        self.assertEqual(variants, {'thumb': {'jpeg': {'url': f'http://testserver{default_storage.url(old)}',
+                                                       'width': 4, 'height': 4}}})
+        buffer = BytesIO()
+        PILImage.new('RGB', (8, 8), 'blue').save(buffer, 'JPEG')
+        with self.captureOnCommitCallbacks(execute=True):
+            post.image = ContentFile(buffer.getvalue(), name='b.jpg')
+            post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.image_variants['source'], post.image.name)
+        self.assertNotEqual(post.image_variants['thumb']['jpeg']['name'], old)
+        self.assertFalse(default_storage.exists(old))
+
+    def test_lost_render_is_done_by_the_command(self):
+        # The queued render dies with its worker
+        with self.settings(IMAGE_VARIANTS={**settings.IMAGE_VARIANTS, 'ASYNC': True}), \
+                mock.patch.object(images, 'get_executor'), self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(user=self.user, image=self.jpeg())
+        self.assertEqual(list(images.pending(Post.objects.all())), [post])
+        call_command('generate_image_variants', model=['post'], stdout=StringIO())
+        post.refresh_from_db()
+        self.assertEqual(post.image_variants['source'], post.image.name)
+        self.assertEqual(post.image_variants['thumb']['jpeg']['width'], 4)
+        self.assertFalse(images.pending(Post.objects.all()).exists())
+
+    def test_unreadable_image_is_not_retried_on_save(self):
+        with self.assertLogs('instagram.images', 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(user=self.user, image='post_images/missing.jpg')
+        post.refresh_from_db()
+        self.assertEqual(set(post.image_variants), {'source', 'error'})
+        with mock.patch.object(images, 'schedule') as schedule:
+            post.description = 'edited'
+            post.save()
+        schedule.assert_not_called()
+        self.assertFalse(images.pending(Post.objects.all()).exists())
+        self.assertTrue(images.pending(Post.objects.all(), retry_failed=True).exists())
+
+
+@override_settings(FEED_FANOUT_ASYNC=False)
+class HashtagTests(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def counts(self):
+        return dict(Hashtag.objects.values_list('name', 'post_count'))
+
+    def test_extract(self):
+        self.assertEqual(hashtags.extract('#Sunset at the #beach, #sunset again #2024 a#b &#39; http://x/#y'),
+                         ['sunset', 'beach'])
+        self.assertEqual(hashtags.extract(None), [])
+
+    def test_counts_follow_edits_and_deletes(self):
+        first = Post.objects.create(user=self.user, description='#sunset #beach')
+        second = Post.objects.create(user=self.user, description='#SUNSET')
+        self.assertEqual(self.counts(), {'sunset': 2, 'beach': 1})
+        first.description = '#beach #sea'
+        first.save()
+        self.assertEqual(self.counts(), {'sunset': 1, 'beach': 1, 'sea': 1})
+        second.delete()
+        self.assertEqual(self.counts(), {'sunset': 0, 'beach': 1, 'sea': 1})
+
+    def test_backfill_is_idempotent(self):
+        post = Post.objects.create(user=self.user, description='#sunset')
+        PostHashtag.objects.all().delete()
+        Hashtag.objects.update(post_count=0)
+        for _ in range(2):
+            call_command('backfill_hashtags', stdout=StringIO())
+        self.assertEqual(self.counts(), {'sunset': 1})
+        self.assertEqual(list(PostHashtag.objects.values_list('post_id', flat=True)), [post.pk])
+
+    def test_tag_page(self):
+        posts = [Post.objects.create(user=self.user, description=f'#sunset {n}') for n in range(3)]
+        Post.objects.create(user=self.user, description='#beach')
+        response = self.client.get('/en/tag/%23Sunset/posts/', {'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['hashtag'], {'name': 'sunset', 'post_count': 3})
+        self.assertEqual([post['id'] for post in response.data['results']], [posts[2].pk, posts[1].pk])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([post['id'] for post in response.data['results']], [posts[0].pk])
+        self.assertIsNone(response.data['next'])
+
+    def test_unknown_tag_is_not_found(self):
+        self.assertEqual(self.client.get('/en/tag/nothing/posts/').status_code, 404)
+
+
+class CommentValidationTests(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        self.posts = [Post.objects.create(user=self.user) for _ in range(2)]
+        self.comment = Comment.objects.create(user=self.user, post=self.posts[0], text='first')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def reply(self, post, parent):
+        return self.client.post('/en/comment/create/', {'user': self.user.pk, 'post': post.pk,
+                                                        'parent': parent.pk, 'text': 'reply'})
+
+    def test_reply_to_same_post(self):
+        self.assertEqual(self.reply(self.posts[0], self.comment).status_code, 201)
+
+    def test_reply_to_comment_of_another_post_is_rejected(self):
+        response = self.reply(self.posts[1], self.comment)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('parent', response.data)
+        self.assertFalse(Comment.objects.filter(post=self.posts[1]).exists())
+
+
+class CommentPathMigrationTests(TestCase):
+    fill_paths = staticmethod(import_module('instagram.migrations.0011_comment_tree').fill_paths)
+
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        self.post = Post.objects.create(user=self.user)
+
+    def chain(self, length):
+        comments = [Comment.objects.create(user=self.user, post=self.post, text=str(i)) for i in range(length)]
+        for parent, comment in zip(comments, comments[1:]):
+            Comment.objects.filter(pk=comment.pk).update(parent=parent)
+        return comments
+
+    def test_parent_cycle_is_cut(self):
+        first, second, third = self.chain(3)
+        Comment.objects.filter(pk=first.pk).update(parent=third)
+        self.fill_paths(django_apps, None)
+        rows = {pk: (parent, depth) for pk, parent, depth in Comment.objects.values_list('pk', 'parent', 'depth')}
+        self.assertEqual(sorted(depth for _, depth in rows.values()), [0, 1, 2])
+        self.assertEqual(sum(parent is None for parent, _ in rows.values()), 1)
+
+    def test_replies_past_the_path_length_become_top_level(self):
+        comments = self.chain(Comment.MAX_DEPTH + 3)
+        self.fill_paths(django_apps, None)
+        deepest = Comment.objects.get(pk=comments[Comment.MAX_DEPTH].pk)
+        self.assertEqual(deepest.depth, Comment.MAX_DEPTH)
+        detached = Comment.objects.get(pk=comments[Comment.MAX_DEPTH + 1].pk)
+        self.assertEqual((detached.parent_id, detached.depth), (None, 0))
+        self.assertEqual(Comment.objects.get(pk=comments[-1].pk).depth, 1)
+        self.assertLessEqual(max(len(path) for path in Comment.objects.values_list('path', flat=True)),
+                             Comment._meta.get_field('path').max_length)
+
+
+@override_settings(FEED_FANOUT_ASYNC=False, FEED_TIMELINE_LENGTH=3)
+class FeedFanOutTests(TestCase):
+    def setUp(self):
+        self.author = UserProfile.objects.create_user('alice')
+        self.followers = [UserProfile.objects.create_user(name) for name in ('bob', 'carol')]
+        for follower in self.followers:
+            Follow.objects.create(follower=follower, following=self.author)
+
+    def post(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Post.objects.create(user=self.author)
+
+    def test_trim_keeps_the_newest_entries(self):
+        posts = [self.post() for _ in range(5)]
+        self.assertEqual(TimelineEntry.objects.filter(user=self.author).count(), 5)
+        call_command('trim_timelines', stdout=StringIO())
+        for user in [self.author, *self.followers]:
+            self.assertEqual(list(TimelineEntry.objects.filter(user=user).order_by('-created_at', '-post_id')
+                                  .values_list('post_id', flat=True)),
+                             [post.pk for post in posts[:1:-1]])
+
+    def test_backfill_is_trimmed(self):
+        posts = [self.post() for _ in range(5)]
+        reader = UserProfile.objects.create_user('dave')
+        with self.captureOnCommitCallbacks(execute=True), self.settings(FEED_BACKFILL=5):
+            Follow.objects.create(follower=reader, following=self.author)
+        self.assertEqual(set(TimelineEntry.objects.filter(user=reader).values_list('post_id', flat=True)),
+                         {post.pk for post in posts[2:]})
+
+    @override_settings(FEED_FANOUT_ASYNC=True)
+    def test_fan_out_runs_in_the_background(self):
+        with mock.patch.object(feed, 'get_executor') as get_executor:
+            post = self.post()
+        get_executor.return_value.submit.assert_called_once_with(feed._run, post.pk)
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    @override_settings(FEED_FANOUT_ASYNC=True)
+    def test_lost_fan_out_is_finished_by_rebuild(self):
+        # The worker restarts before the queued fan-out runs
+        with mock.patch.object(feed, 'get_executor'):
+            post = self.post()
+        self.assertTrue(PendingFanOut.objects.filter(post=post).exists())
+        call_command('rebuild_timelines', pending=True, older_than=0, stdout=StringIO())
+        self.assertEqual(set(TimelineEntry.objects.filter(post=post).values_list('user_id', flat=True)),
+                         {self.author.pk, *(follower.pk for follower in self.followers)})
+        self.assertFalse(PendingFanOut.objects.exists())
+
+    def test_finished_fan_out_is_not_pending(self):
+        self.post()
+        self.assertFalse(PendingFanOut.objects.exists())
+
+
+@override_settings(STORY_GROUP_PAGE_SIZE=2)
+class ActiveStoryTests(TestCase):
+    def setUp(self):
+        # Flags come from the database; no background load of the follow graph
+        self.enterContext(mock.patch.object(follow_graph.graph, '_refresh_in_background'))
+        self.user = UserProfile.objects.create_user('alice')
+        self.authors = [UserProfile.objects.create_user(name) for name in ('bob', 'carol', 'dave')]
+        now = timezone.now()
+        self.stories = {}
+        # carol posted last, then dave, then bob
+        for author, minutes in zip(self.authors, ([30, 20], [5], [25, 10])):
+            Follow.objects.create(follower=self.user, following=author)
+            for age in minutes:
+                story = Story.objects.create(user=author, image='story_images/a.jpg')
+                Story.objects.filter(pk=story.pk).update(created_at=now - timedelta(minutes=age))
+                self.stories.setdefault(author.pk, []).append(story.pk)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_groups_are_paginated_by_latest_story(self):
+        response = self.client.get('/en/story/active/')
+        self.assertEqual([group['user']['id'] for group in response.data['results']],
+                         [self.authors[1].pk, self.authors[2].pk])
+        self.assertEqual([story['id'] for story in response.data['results'][1]['stories']],
+                         self.stories[self.authors[2].pk])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([group['user']['id'] for group in response.data['results']], [self.authors[0].pk])
+        self.assertIsNone(response.data['next'])
+
+    def test_malformed_cursor_is_not_found(self):
+        response = self.client.get('/en/story/active/', {'cursor': make_cursor(['soon', 1])})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(FEED_FANOUT_ASYNC=False)
+class SearchBackendTests(TestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.posts = [Post.objects.create(user=self.user, description=text)
+                          for text in ('Sunset over the mountains', 'Mountain lake', 'City lights')]
+
+    def test_unsupported_database_is_a_configuration_error(self):
+        # Other vendors have no entry in QUERIES
+        with mock.patch.dict(search.QUERIES, clear=True):
+            errors = search.check_search_backend(None)
+            self.assertEqual([(error.id, error.level) for error in errors], [('instagram.E001', checks.ERROR)])
+            with self.assertRaises(ImproperlyConfigured):
+                search.search('mountain', kind='post')
+
+    def test_search_ranks_matches(self):
+        documents = search.search('mountain', kind='post')
+        self.assertEqual({document.object_id for document in documents}, {self.posts[0].pk, self.posts[1].pk})
+
+    def test_supported_database_passes_the_check(self):
+        self.assertEqual(search.check_search_backend(None), [])
+
+
+class UploadChunkTests(TestCase):
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.enterContext(self.settings(UPLOADS={**settings.UPLOADS, 'TEMP_DIR': temp_dir}))
+        self.user = UserProfile.objects.create_user('alice')
+        self.chunks = [b'a' * 4, b'b' * 4, b'c' * 2]
+        self.upload = Upload.objects.create(user=self.user, filename='a.mp4', kind='video', size=10, chunk_size=4)
+        uploads.create_temp_file(self.upload)
+
+    def write(self, upload, number, data=None, checksum=None):
+        data = self.chunks[number] if data is None else data
+        return uploads.write_chunk(upload, number, BytesIO(data), len(data),
+                                   checksum or hashlib.sha256(data).hexdigest())
+
+    def test_late_duplicate_does_not_overwrite_later_chunks(self):
+        stale = Upload.objects.get(pk=self.upload.pk)
+        self.assertTrue(self.write(self.upload, 0))
+        self.assertTrue(self.write(self.upload, 1))
+        # A slow retry of chunk 0 that read the row before the first one was stored
+        self.assertFalse(self.write(stale, 0))
+        self.assertTrue(self.write(self.upload, 2))
+        with open(uploads.temp_path(self.upload), 'rb') as part:
+            self.assertEqual(part.read(), b''.join(self.chunks))
+        with uploads.assemble(self.upload) as media:
+            self.assertEqual(media.size, 10)
+
+    def test_corrupt_chunk_is_not_stored(self):
+        with self.assertRaises(ValidationError):
+            self.write(self.upload, 0, checksum='0' * 64)
+        self.assertEqual((self.upload.offset, os.path.getsize(uploads.temp_path(self.upload))), (0, 0))
+        self.assertTrue(self.write(self.upload, 0))
+
+    def test_assemble_checks_the_file_size(self):
+        for number in range(3):
+            self.write(self.upload, number)
+        with open(uploads.temp_path(self.upload), 'r+b') as part:
+            part.truncate(8)
+        with self.assertRaises(uploads.ChunkConflict):
+            uploads.assemble(self.upload)
+
+
+@override_settings(CHAT_BUFFER={'FLUSH_SIZE': 100, 'FLUSH_INTERVAL_MS': 60000, 'MAX_PENDING': 2})
+class ChatBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.user = UserProfile.objects.create_user('alice')
+        self.chat = Chat.objects.create()
+        self.chat.person.add(self.user)
+
+    def message(self):
+        return Message(chat=self.chat, author=self.user, text='hello')
+
+    async def test_put_waits_while_the_buffer_is_full(self):
+        buffer = chat_buffer.MessageBuffer(flush_size=100, flush_interval=60, max_pending=2)
+        for _ in range(2):
+            await buffer.put(self.message())
+        blocked = asyncio.ensure_future(buffer.put(self.message()))
+        await asyncio.sleep(0.05)
+        self.assertFalse(blocked.done())
+        await buffer.flush()
+        await asyncio.wait_for(blocked, 1)
+        await buffer.flush()
+        buffer._task.cancel()
+        self.assertEqual(await Message.objects.acount(), 3)
+
+    async def test_failed_batch_is_retried_and_only_bad_rows_are_dropped(self):
+        gone = await Chat.objects.acreate()
+        buffer = chat_buffer.MessageBuffer(flush_size=100, flush_interval=60, max_pending=10)
+        await buffer.put(self.message())
+        await buffer.put(Message(chat_id=gone.pk, author=self.user, text='lost'))
+        await buffer.put(self.message())
+        await gone.adelete()
+        with self.assertLogs('instagram.chat_buffer', 'ERROR') as logs:
+            await buffer.flush()
+            self.assertEqual(await Message.objects.acount(), 0)
+            self.assertFalse(buffer.empty())
+            await buffer.flush()
+        buffer._task.cancel()
+        self.assertEqual(len(logs.records), 2)
+        self.assertTrue(buffer.empty())
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 2)
+
+    def test_pending_messages_outlive_their_loop(self):
+        async def send():
+            await chat_buffer.get_buffer().put(self.message())
+
+        asyncio.run(send())
+        self.assertEqual(Message.objects.count(), 0)
+        chat_buffer.drain_all()
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertFalse(any(loop.is_closed() for loop in chat_buffer._buffers))
+
+    async def test_lifespan_shutdown_drains_the_buffers(self):
+        buffer = chat_buffer.get_buffer()
+        await buffer.put(self.message())
+        received = asyncio.Queue()
+        for message_type in ('lifespan.startup', 'lifespan.shutdown'):
+            received.put_nowait({'type': message_type})
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await chat_buffer.lifespan({'type': 'lifespan'}, received.get, send)
+        buffer._task.cancel()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertEqual(await Message.objects.acount(), 1)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatSocketTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = UserProfile.objects.create_user('alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.chat = Chat.objects.create()
+        self.chat.person.add(self.alice, self.bob)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    async def connect(self, user, token=None, subprotocols=None, query='', accepted=True):
+        token = token or str(AccessToken.for_user(user))
+        path = f'/ws/chat/{self.chat.pk}/?token={token}{query}'
+        communicator = WebsocketCommunicator(self.application, path, subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(connected, accepted)
+        return communicator, subprotocol
+
+    async def test_presence_is_broadcast_once_per_user(self):
+        alice, _ = await self.connect(self.alice)
+        bob, _ = await self.connect(self.bob)
+        self.assertEqual(await alice.receive_json_from(),
+                         {'type': 'presence', 'user': self.bob.pk, 'online': True, 'last_seen': mock.ANY})
+        # A second socket of bob's is not news
+        second, _ = await self.connect(self.bob)
+        self.assertTrue(await alice.receive_nothing())
+        self.assertTrue(presence.get_presence([self.bob.pk])[self.bob.pk]['online'])
+        await second.disconnect()
+        self.assertTrue(await alice.receive_nothing())
+        await bob.disconnect()
+        self.assertEqual((await alice.receive_json_from())['online'], False)
+        await alice.disconnect()
+
+    async def test_typing_is_coalesced(self):
+        alice, _ = await self.connect(self.alice)
+        bob, _ = await self.connect(self.bob)
+        await alice.receive_from()
+        for _ in range(3):
+            await alice.send_json_to({'type': 'typing'})
+        self.assertEqual(await bob.receive_json_from(), {'type': 'typing', 'user': self.alice.pk})
+        self.assertTrue(await bob.receive_nothing())
+        # Not echoed to the typist
+        self.assertTrue(await alice.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_heartbeat_is_refreshed_once_per_interval(self):
+        alice, _ = await self.connect(self.alice)
+        # Let connect() register the socket first
+        self.assertTrue(await alice.receive_nothing())
+        with mock.patch.object(presence, 'heartbeat', mock.AsyncMock()) as heartbeat:
+            for _ in range(3):
+                await alice.send_json_to({'type': 'heartbeat'})
+            self.assertTrue(await alice.receive_nothing())
+            heartbeat.assert_not_called()
+            with self.settings(PRESENCE={**settings.PRESENCE, 'HEARTBEAT': 0}):
+                await alice.send_json_to({'type': 'heartbeat'})
+                self.assertTrue(await alice.receive_nothing())
+            heartbeat.assert_called_once_with(self.alice.pk)
+        await alice.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        alice, subprotocol = await self.connect(self.alice, subprotocols=['chat.msgpack'])
+        self.assertEqual(subprotocol, 'chat.msgpack')
+        bob, _ = await self.connect(self.bob)
+        self.assertEqual(msgpack.unpackb(await alice.receive_from())['user'], self.bob.pk)
+        await bob.send_json_to({'type': 'typing'})
+        self.assertEqual(msgpack.unpackb(await alice.receive_from()), {'type': 'typing', 'user': self.bob.pk})
+        # Frames from a msgpack client are decoded too
+        await alice.send_to(bytes_data=msgpack.packb({'type': 'typing'}))
+        self.assertEqual(await bob.receive_json_from(), {'type': 'typing', 'user': self.alice.pk})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(CHAT_FRAMES={**settings.CHAT_FRAMES, 'BATCH_INTERVAL_MS': 60000, 'BATCH_MAX_MESSAGES': 3})
+    async def test_batched_frames_from_the_query_string(self):
+        alice, subprotocol = await self.connect(self.alice, query='&encoding=msgpack&batch=1')
+        self.assertIsNone(subprotocol)
+        bob, _ = await self.connect(self.bob)
+        for text in ('one', 'two'):
+            await bob.send_json_to({'message': text})
+        self.assertEqual(msgpack.unpackb(await alice.receive_from()), [
+            {'type': 'presence', 'user': self.bob.pk, 'online': True, 'last_seen': mock.ANY},
+            {'message': 'one'}, {'message': 'two'},
+        ])
+        # Disconnecting flushes the sender's buffer
+        await alice.disconnect()
+        await bob.disconnect()
+        chat_buffer.get_buffer()._task.cancel()
+        self.assertEqual(await Message.objects.acount(), 2)
+
+    def test_subprotocol_wins_over_query_string(self):
+        scope = {'subprotocols': ['jwt.token', 'chat.json.batch'], 'query_string': b'encoding=msgpack'}
+        self.assertEqual(frames.negotiate(scope), ('json', True, 'chat.json.batch'))
+        self.assertEqual(frames.negotiate({'query_string': b'encoding=xml'}), ('json', False, None))
+
+    async def test_expired_token_is_rejected(self):
+        token = AccessToken.for_user(self.alice)
+        token.set_exp(lifetime=-timedelta(seconds=1))
+        await self.connect(self.alice, token=str(token), accepted=False)
+
+    async def test_cached_token_is_rejected_once_expired(self):
+        token = AccessToken.for_user(self.alice)
+        alice, _ = await self.connect(self.alice, token=str(token))
+        await alice.disconnect()
+        # Only the middleware's clock moves, so the claims are still cached
+        with mock.patch.object(middleware, 'time', mock.Mock(time=mock.Mock(return_value=token['exp'] + 1))):
+            await self.connect(self.alice, token=str(token), accepted=False)
+
+    async def test_token_subprotocol(self):
+        token = AccessToken.for_user(self.alice)
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.chat.pk}/',
+                                             subprotocols=[f'jwt.{token}'])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, f'jwt.{token}')
+        await communicator.disconnect()
+
+    async def test_invalid_token_and_non_members_are_rejected(self):
+        await self.connect(self.alice, token='garbage', accepted=False)
+        carol = await UserProfile.objects.acreate(username='carol')
+        await self.connect(carol, accepted=False)
+
+    async def test_deactivated_user_is_rejected_despite_the_cache(self):
+        token = str(AccessToken.for_user(self.alice))
+        alice, _ = await self.connect(self.alice, token=token)
+        await alice.disconnect()
+        self.alice.is_active = False
+        await self.alice.asave()
+        await self.connect(self.alice, token=token, accepted=False)
@@ -0,0 +1,160 @@
+"""
+In-process username typeahead.
+
+Each worker keeps all active usernames in a sorted array (lowercased, with
+the user ids alongside), so the users matching a prefix are one contiguous
+slice found with bisect. Matches are ranked by audience (count_following)
+and then by name. Slices longer than TYPEAHEAD['SCAN_LIMIT'] are ranked
+once and their top entries memoized per prefix, and those lists are
+patched in place as users change, so short prefixes cost the same as long
+ones.
+
+The index is held by a LocalIndex: loaded in the background when a worker
+starts, kept current through signals and reloaded every
+TYPEAHEAD['REFRESH_SECONDS']. Until it is loaded, searches run one prefix
+query against the database.
+"""
+import bisect
+import heapq
+import threading
+
+from django.conf import settings
+from django.db.models.functions import Lower
+
+from .local_index import LocalIndex
+from .models import UserProfile
+
+# Sorts after every character, so prefix + END bounds the prefix's slice
+END = '\U0010ffff'
+
+
+class UsernameIndex:
+    def __init__(self, rows=()):
+        """``rows`` are ``(pk, username, audience)`` tuples."""
+        self.users = {pk: (username, audience) for pk, username, audience in rows}
+        entries = sorted((username.lower(), pk) for pk, (username, audience) in self.users.items())
+        self.names = [name for name, pk in entries]
+        self.ids = [pk for name, pk in entries]
+        self._top = {}
+        self._lock = threading.Lock()
+        # The longest slices belong to one and two letter prefixes; rank
+        # them now rather than on some user's keystroke
+        for length in (1, 2):
+            for prefix in sorted({name[:length] for name in self.names if len(name) >= length}):
+                self._slice_top(prefix)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _rank(self, pk):
+        username, audience = self.users[pk]
+        return -audience, username.lower(), pk
+
+    def _slice(self, prefix):
+        start = bisect.bisect_left(self.names, prefix)
+        return start, bisect.bisect_left(self.names, prefix + END, start)
+
+    def _slice_top(self, prefix):
+        """Memoized best entries of a long slice, or None for a short one."""
+        top = self._top.get(prefix)
+        if top is None:
+            start, stop = self._slice(prefix)
+            if stop - start <= settings.TYPEAHEAD['SCAN_LIMIT']:
+                return None
+            # Keep spare entries, so users dropping out rarely force a re-rank
+            top = self._top[prefix] = heapq.nsmallest(2 * settings.TYPEAHEAD['MAX_LIMIT'],
+                                                      self.ids[start:stop], key=self._rank)
+        return top
+
+    def search(self, prefix, limit):
+        """Return up to ``limit`` ``(pk, username, audience)`` for usernames starting with ``prefix``."""
+        prefix = prefix.lower()
+        with self._lock:
+            top = self._slice_top(prefix)
+            if top is None:
+                start, stop = self._slice(prefix)
+                top = heapq.nsmallest(limit, self.ids[start:stop], key=self._rank)
+            return [(pk, *self.users[pk]) for pk in top[:limit]]
+
+    def _rerank(self, pk, name, removed=False):
+        """
+        Keep the memoized lists of ``name``'s prefixes exact after ``pk``
+        changed. Every user outside a list ranks below its last entry, so
+        ``pk`` belongs in the list exactly when it now ranks above that
+        entry; a list that shrinks below MAX_LIMIT is dropped and re-ranked
+        on its next use.
+        """
+        for length in range(1, len(name) + 1):
+            top = self._top.get(name[:length])
+            if top is None:
+                continue
+            member = pk in top
+            if member:
+                top.remove(pk)
+            if not removed and top and self._rank(pk) < self._rank(top[-1]):
+                bisect.insort(top, pk, key=self._rank)
+                if not member:
+                    top.pop()
+            if len(top) < settings.TYPEAHEAD['MAX_LIMIT']:
+                del self._top[name[:length]]
+
+    def _unlink(self, pk):
+        name = self.users[pk][0].lower()
+        position = bisect.bisect_left(self.names, name)
+        while self.ids[position] != pk:
+            position += 1
+        del self.names[position]
+        del self.ids[position]
+        self._rerank(pk, name, removed=True)
+
+    def set_user(self, pk, username, audience=None):
+        with self._lock:
+            if pk in self.users:
+                if audience is None:
+                    audience = self.users[pk][1]
+                self._unlink(pk)
+            name = username.lower()
+            position = bisect.bisect_left(self.names, name)
+            self.names.insert(position, name)
+            self.ids.insert(position, pk)
+            self.users[pk] = (username, audience or 0)
+            self._rerank(pk, name)
+
+    def remove_user(self, pk):
+        with self._lock:
+            if pk in self.users:
+                self._unlink(pk)
+                del self.users[pk]
+
+    def set_audience(self, pk, audience):
+        with self._lock:
+            if pk in self.users:
+                username = self.users[pk][0]
+                self.users[pk] = (username, audience)
+                self._rerank(pk, username.lower())
+
+
+def load():
+    rows = (UserProfile.objects.filter(is_active=True)
+            .values_list('pk', 'username', 'count_following').iterator(chunk_size=10000))
+    return UsernameIndex(rows)
+
+
+index = LocalIndex('username index', load, lambda: settings.TYPEAHEAD['REFRESH_SECONDS'])
+get_index, warm, reset, apply = index.get, index.warm, index.reset, index.apply
+
+
+def search(prefix, limit):
+    index = get_index()
+    if index is None:
+        return list(UserProfile.objects.filter(is_active=True, username__istartswith=prefix)
+                    .order_by('-count_following', Lower('username'), 'pk')
+                    .values_list('pk', 'username', 'count_following')[:limit])
+    return index.search(prefix, limit)
+
+
+def audience_changed(user_id):
+    """Publish ``user_id``'s committed audience as a value, so replaying it is harmless."""
+    audience = UserProfile.objects.filter(pk=user_id).values_list('count_following', flat=True).first()
+    if audience is not None:
+        apply('set_audience', user_id, audience)
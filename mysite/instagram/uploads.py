@@ -0,0 +1,130 @@
+"""
+Resumable uploads.
+
+A client creates an Upload, PUTs its chunks in order (chunk ``n`` covers
+bytes ``n * chunk_size`` up to the next chunk) and then completes it. Each
+chunk is streamed from the request into a file of its own in TEMP_DIR
+while its SHA-256 is computed, so a worker never holds more than one read
+buffer in memory. A chunk whose checksum does not match is discarded. A
+verified chunk is appended to ``<TEMP_DIR>/<id>.part`` while the Upload
+row is locked, so two requests for the same chunk cannot both write it,
+and re-sending a chunk that was already stored is acknowledged without
+writing it twice; clients can safely retry after a dropped connection.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from .models import Upload
+
+READ_SIZE = 64 * 1024
+
+
+class ChunkConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Chunks must be uploaded in order.'
+    default_code = 'chunk_conflict'
+
+
+class AssembledUpload(UploadedFile):
+    """The assembled temp file, handed to storage, which moves it into place."""
+
+    def __init__(self, upload):
+        super().__init__(open(temp_path(upload), 'rb'), upload.filename, None, upload.size)
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def temp_path(upload):
+    return os.path.join(settings.UPLOADS['TEMP_DIR'], f'{upload.pk}.part')
+
+
+def create_temp_file(upload):
+    os.makedirs(settings.UPLOADS['TEMP_DIR'], exist_ok=True)
+    open(temp_path(upload), 'wb').close()
+
+
+def remove_temp_file(upload):
+    try:
+        os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def expected_length(upload, number):
+    start = number * upload.chunk_size
+    return min(upload.chunk_size, upload.size - start)
+
+
+def write_chunk(upload, number, stream, length, checksum):
+    """
+    Append chunk ``number`` read from ``stream`` and return True, or return
+    False when that chunk is already stored.
+    """
+    if upload.status != 'pending':
+        raise ChunkConflict('Upload is already complete.')
+    if number < upload.next_chunk:
+        return False
+    if number > upload.next_chunk or number >= upload.chunk_count:
+        raise ChunkConflict(f'Expected chunk {upload.next_chunk}.')
+    if length != expected_length(upload, number):
+        raise ValidationError({'Content-Length': f'Chunk {number} must be {expected_length(upload, number)} bytes.'})
+
+    digest = hashlib.sha256()
+    remaining = length
+    with tempfile.NamedTemporaryFile(dir=settings.UPLOADS['TEMP_DIR'], prefix=f'{upload.pk}.{number}.',
+                                     suffix='.chunk') as chunk:
+        while remaining:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            chunk.write(data)
+            remaining -= len(data)
+        if remaining or digest.hexdigest() != checksum.lower():
+            # The partial or corrupt chunk is dropped, so the client can resend it
+            raise ValidationError({'checksum': f'Chunk {number} did not match its checksum.'})
+        chunk.flush()
+        chunk.seek(0)
+        with transaction.atomic():
+            current = Upload.objects.select_for_update().get(pk=upload.pk)
+            if current.status != 'pending' or current.next_chunk != number:
+                # A concurrent request for the same chunk won
+                upload.refresh_from_db()
+                return False
+            with open(temp_path(upload), 'r+b') as target:
+                target.seek(current.offset)
+                shutil.copyfileobj(chunk, target, READ_SIZE)
+                target.truncate()
+            Upload.objects.filter(pk=upload.pk).update(next_chunk=number + 1, offset=current.offset + length,
+                                                       updated_at=timezone.now())
+    upload.refresh_from_db()
+    return True
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def assemble(upload):
+    """Return the finished file, after checking that every byte arrived intact."""
+    if upload.offset != upload.size:
+        raise ChunkConflict(f'Only {upload.offset} of {upload.size} bytes were received.')
+    if os.path.getsize(temp_path(upload)) != upload.size:
+        raise ChunkConflict('The assembled file does not have the size of the upload.')
+    if upload.checksum and file_checksum(temp_path(upload)) != upload.checksum.lower():
+        raise ValidationError({'checksum': 'The assembled file did not match its checksum.'})
+    return AssembledUpload(upload)
@@ -1,9 +1,13 @@
 from django.urls import path, include
 from rest_framework import routers
 from .views import (UserProfileListAPIView, UserProfileEditAPIView, FollowViewSet,
-                    PostCreateAPIView, PostListAPIView, PostDetailAPIView, PostLikeCreateAPIView, PostLikeListAPIView, PostLikeDetailAPIView,
-                    CommentCreateAPIView, CommentListAPIView, CommentDetailAPIView, CommentLikeCreateAPIView, CommentLikeListAPIView, CommentLikeDetailAPIView,
-                    StoryCreateAPIView, StoryListAPIView, StoryDetailAPIView, SaveListAPIView, SaveItemDetailAPIView, RegisterView, LoginView, LogoutView
+                    PostCreateAPIView, PostListAPIView, PostDetailAPIView, FeedAPIView, PostLikeCreateAPIView, PostLikeSetAPIView, PostLikeListAPIView, PostLikeDetailAPIView,
+                    CommentCreateAPIView, CommentListAPIView, CommentDetailAPIView, CommentTreeAPIView, CommentLikeCreateAPIView, CommentLikeSetAPIView, CommentLikeListAPIView, CommentLikeDetailAPIView,
+                    StoryCreateAPIView, StoryListAPIView, StoryDetailAPIView, ActiveStoryAPIView, SaveListAPIView, SaveItemDetailAPIView, RegisterView, LoginView, LogoutView,
+                    ResponseCacheStatsAPIView, ChatInboxAPIView, ChatMessageListAPIView, ChatReadAPIView,
+                    ChatPresenceAPIView, UploadCreateAPIView, UploadDetailAPIView, UploadChunkAPIView,
+                    UploadCompleteAPIView, SearchAPIView, UsernameTypeaheadAPIView,
+                    HashtagPostListAPIView, FollowSuggestionListAPIView
                     )
 
 
@@ -15,14 +19,21 @@ urlpatterns = [
 
     path('user/', UserProfileListAPIView.as_view(), name='user_list'),
     path('user/<int:pk>/', UserProfileEditAPIView.as_view(), name='user_edit'),
+    path('user/typeahead/', UsernameTypeaheadAPIView.as_view(), name='user_typeahead'),
+    path('suggestions/', FollowSuggestionListAPIView.as_view(), name='follow_suggestions'),
 
     path('post_create/', PostCreateAPIView.as_view(), name='post_create'),
     path('post/', PostListAPIView.as_view(), name='post_list'),
     path('post/<int:pk>/', PostDetailAPIView.as_view(), name='post_detail'),
+    path('feed/', FeedAPIView.as_view(), name='feed'),
+    path('post/<int:pk>/comments/', CommentTreeAPIView.as_view(), name='comment_tree'),
+    path('search/', SearchAPIView.as_view(), name='search'),
+    path('tag/<str:name>/posts/', HashtagPostListAPIView.as_view(), name='hashtag_posts'),
 
     path('post_like/', PostLikeListAPIView.as_view(), name='post_like_list'),
     path('post_like/<int:pk>/', PostLikeDetailAPIView.as_view(), name='post_like_detail'),
     path('post_like/create/', PostLikeCreateAPIView.as_view(), name='post_like_create'),
+    path('post_like/set/', PostLikeSetAPIView.as_view(), name='post_like_set'),
 
     path('comment/', CommentListAPIView.as_view(), name='comment_list'),
     path('comment/<int:pk>/', CommentDetailAPIView.as_view(), name='comment_detail'),
@@ -31,16 +42,30 @@ urlpatterns = [
     path('comment_like/', CommentLikeListAPIView.as_view(), name='comment_like_list'),
     path('comment_like/<int:pk>/', CommentLikeDetailAPIView.as_view(), name='comment_like_detail'),
     path('comment_like/create/', CommentLikeCreateAPIView.as_view(), name='comment_like_create'),
+    path('comment_like/set/', CommentLikeSetAPIView.as_view(), name='comment_like_set'),
 
     path('story/', StoryListAPIView.as_view(), name='story_list'),
     path('story/<int:pk>/', StoryDetailAPIView.as_view(), name='story_detail'),
     path('story/create/', StoryCreateAPIView.as_view(), name='story_create'),
+    path('story/active/', ActiveStoryAPIView.as_view(), name='story_active'),
 
     path('save/', SaveListAPIView.as_view(), name='save_list'),
     path('save/<int:pk>/', SaveItemDetailAPIView.as_view(), name='save_detail'),
 
+    path('chat/', ChatInboxAPIView.as_view(), name='chat_inbox'),
+    path('chat/<int:pk>/messages/', ChatMessageListAPIView.as_view(), name='chat_messages'),
+    path('chat/<int:pk>/read/', ChatReadAPIView.as_view(), name='chat_read'),
+    path('chat/<int:pk>/presence/', ChatPresenceAPIView.as_view(), name='chat_presence'),
+
+    path('upload/', UploadCreateAPIView.as_view(), name='upload_create'),
+    path('upload/<uuid:pk>/', UploadDetailAPIView.as_view(), name='upload_detail'),
+    path('upload/<uuid:pk>/chunks/<int:number>/', UploadChunkAPIView.as_view(), name='upload_chunk'),
+    path('upload/<uuid:pk>/complete/', UploadCompleteAPIView.as_view(), name='upload_complete'),
+
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
-    path('logout/', LogoutView.as_view(), name='logout')
+    path('logout/', LogoutView.as_view(), name='logout'),
+
+    path('cache/stats/', ResponseCacheStatsAPIView.as_view(), name='cache_stats'),
 
 ]
\ No newline at end of file
@@ -1,21 +1,43 @@
+from django.conf import settings
 from django.core.serializers import serialize, get_serializer
+from django.db import transaction
+from django.db.models import Exists, F, FilteredRelation, Max, OuterRef, Prefetch, Q
+from django.db.models.functions import Coalesce
+from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, generics, status
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 
-from .models import UserProfile, Follow, Post, PostLike, Comment, CommentLike, Story, Save, SaveItem
+from .models import (UserProfile, Follow, Post, PostLike, Comment, CommentLike, Story, Save, SaveItem, Chat, Message,
+                     Upload, SearchDocument, Hashtag, PostHashtag, FollowSuggestion, TimelineEntry)
 from .serializers import (UserProfileSerializer, UserProfileCreateSerializer, FollowSerializer,
                           PostSerializer, PostListSerializer, PostDetailSerializer,
                           PostLikeSerializer, PostLikeListSerializer, PostLikeDetailSerializer,
                           CommentSerializer, CommentListSerializer, CommentDetailSerializer,
                           CommentLikeSerializer, CommentLikeListSerializer, CommentLikeDetailSerializer,
                           StorySerializer, StoryListSerializer, StoryDetailSerializer, SaveSerializer,
-                          SaveItemSerializer, UserSerializer, LoginSerializer
+                          SaveItemSerializer, UserSerializer, LoginSerializer, CommentTreeSerializer,
+                          ActiveStoryGroupSerializer, MessageSerializer, ChatInboxSerializer, ChatReadSerializer,
+                          MessageCreateSerializer, UploadSerializer, UploadCompleteSerializer, LikeSetSerializer,
+                          SearchResultSerializer, FollowSuggestionSerializer
 )
 from .filters import PostFilter
+from .feed import ORDERING as FEED_ORDERING, read_feed
+from .inbox import mark_read
+from .likes import set_likes
+from . import like_buffer
+from .presence import get_presence
+from .pagination import encode_cursor, decode_cursor, keyset_filter
+from .response_cache import CachedResponseMixin, stats as response_cache_stats
+from . import uploads
+from .search import search
+from . import typeahead
+from .hashtags import normalize as normalize_hashtag
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter, SearchFilter
 from rest_framework import permissions
 
 class RegisterView(generics.CreateAPIView):
@@ -53,13 +75,23 @@ class LogoutView(generics.GenericAPIView):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserProfileListAPIView(generics.ListAPIView):
-    queryset = UserProfile.objects.all()
+class UserProfileListAPIView(CachedResponseMixin, generics.ListAPIView):
+    queryset = UserProfile.objects.prefetch_related(
+        Prefetch('user_post', queryset=Post.objects.select_related('user')),
+    )
     serializer_class = UserProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    cursor_ordering = ('-date_joined', '-id')
+    query_budget = 3
 
     def get_queryset(self):
-        return UserProfile.objects.filter(id=self.request.user.id)
+        return super().get_queryset().filter(id=self.request.user.id)
+
+    def get_cache_key(self, request):
+        return f'{super().get_cache_key(request)}:{request.user.id}'
+
+    def get_cache_dependencies(self, request, *args, **kwargs):
+        return [('user', request.user.id)]
 
 class UserProfileEditAPIView(generics.RetrieveUpdateDestroyAPIView):
     queryset = UserProfile.objects.all()
@@ -69,11 +101,28 @@ class UserProfileEditAPIView(generics.RetrieveUpdateDestroyAPIView):
 
 
 class FollowViewSet(viewsets.ModelViewSet):
-    queryset = Follow.objects.all()
+    # Rows missing a side have no place in a keyset ordered by it
+    queryset = Follow.objects.filter(follower__isnull=False, following__isnull=False)
     serializer_class = FollowSerializer
     filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_fields = ['follower', 'following']
     ordering_fields = ['follower', 'following']
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+
+class FollowSuggestionListAPIView(generics.ListAPIView):
+    """People the user may know, most mutual follows first (see instagram.suggestions)."""
+    serializer_class = FollowSuggestionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    cursor_ordering = ('-mutual_count', 'suggested_id')
+    query_budget = 2
+
+    def get_queryset(self):
+        user = self.request.user
+        # Accounts followed since the last run are dropped here, not recomputed
+        return (FollowSuggestion.objects.filter(user=user).select_related('suggested')
+                .exclude(Exists(Follow.objects.filter(follower=user, following=OuterRef('suggested')))))
 
 
 class PostCreateAPIView(generics.CreateAPIView):
@@ -82,32 +131,174 @@ class PostCreateAPIView(generics.CreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
 class PostListAPIView(generics.ListAPIView):
-    queryset = Post.objects.all()
+    queryset = Post.objects.select_related('user')
     serializer_class = PostListSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
-class PostDetailAPIView(generics.RetrieveAPIView):
-    queryset = Post.objects.all()
+class FeedAPIView(generics.GenericAPIView):
+    serializer_class = PostListSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 5
+
+    def get(self, request, *args, **kwargs):
+        after = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            after = decode_cursor(cursor, TimelineEntry, FEED_ORDERING)
+            if after is None:
+                raise NotFound('Invalid cursor')
+        posts, keys = read_feed(request.user, settings.FEED_PAGE_SIZE, after)
+        next_url = None
+        if len(keys) == settings.FEED_PAGE_SIZE:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', encode_cursor(keys[-1]))
+        serializer = self.get_serializer(posts, many=True)
+        return Response({'next': next_url, 'results': serializer.data})
+
+class PostDetailAPIView(CachedResponseMixin, generics.RetrieveAPIView):
+    queryset = Post.objects.select_related('user').prefetch_related(
+        'post_like',
+        Prefetch('comment_post', queryset=Comment.objects.select_related('user')),
+        Prefetch('user__story_post', queryset=Story.objects.active()),
+    )
     serializer_class = PostDetailSerializer
     filter_backends = [DjangoFilterBackend, SearchFilter]
     filterset_class = PostFilter
     search_fields = ['user']
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 5
+
+    def get_cache_dependencies(self, request, *args, **kwargs):
+        return [('post', kwargs['pk'])]
+
+    def get_object(self):
+        post = super().get_object()
+        # The author and every commenter are embedded with their usernames
+        users = {post.user_id, *(comment.user_id for comment in post.comment_post.all())}
+        self.cache_dependencies.extend(('user', pk) for pk in sorted(users))
+        return post
+
+    def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == 200 and like_buffer.enabled():
+            # Cached responses hold the stored counter; add likes not flushed yet
+            counts = like_buffer.pending_counts({int(kwargs['pk']): response.data['count_post_like']})
+            response.data = {**response.data, 'count_post_like': counts[int(kwargs['pk'])]}
+        return response
+
+class HashtagPostListAPIView(generics.ListAPIView):
+    """Posts tagged ``#<name>``, newest first, paginated along the PostHashtag index."""
+    serializer_class = PostListSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    cursor_ordering = ('-created_at', '-post_id')
+    query_budget = 3
+
+    def get_queryset(self):
+        self.hashtag = get_object_or_404(Hashtag, name=normalize_hashtag(self.kwargs['name']))
+        return PostHashtag.objects.filter(hashtag=self.hashtag).select_related('post__user')
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        response = self.get_paginated_response(self.get_serializer([entry.post for entry in page], many=True).data)
+        response.data['hashtag'] = {'name': self.hashtag.name, 'post_count': self.hashtag.post_count}
+        return response
+
 
 class PostLikeCreateAPIView(generics.CreateAPIView):
     queryset = PostLike.objects.all()
     serializer_class = PostLikeSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+class LikeSetAPIView(generics.GenericAPIView):
+    """
+    Set the requesting user's like on a batch of targets, e.g.
+    ``{"ids": [1, 2], "like": true}``. Repeating a request is harmless.
+    """
+    serializer_class = LikeSetSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    like_model = None
+    counter = None
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids, like = list(dict.fromkeys(serializer.validated_data['ids'])), serializer.validated_data['like']
+        counts = self.set_likes(request.user, ids, like)
+        return Response({
+            'like': like,
+            'results': [{'id': pk, self.counter: counts[pk]} for pk in ids if pk in counts],
+            'missing': sorted(set(ids) - set(counts)),
+        })
+
+    def set_likes(self, user, ids, like):
+        return set_likes(self.like_model, user, ids, like)
+
+
+class PostLikeSetAPIView(LikeSetAPIView):
+    like_model = PostLike
+    counter = 'count_post_like'
+
+    def set_likes(self, user, ids, like):
+        if like_buffer.enabled():
+            return like_buffer.record_likes(user, ids, like)
+        return super().set_likes(user, ids, like)
+
+
+class UsernameTypeaheadAPIView(generics.GenericAPIView):
+    """
+    Usernames starting with ``?q=``, most followed first, from the worker's
+    in-memory index, or from one prefix query while the index is loading.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.query_params.get('q', '').strip().lstrip('@')
+        if not prefix:
+            return Response({'results': []})
+        limit = _bounded_int(request.query_params.get('limit'), settings.TYPEAHEAD['PAGE_SIZE'],
+                             settings.TYPEAHEAD['MAX_LIMIT'])
+        return Response({'results': [
+            {'id': pk, 'username': username, 'count_following': audience}
+            for pk, username, audience in typeahead.search(prefix[:150], limit)
+        ]})
+
+
+class SearchAPIView(generics.GenericAPIView):
+    """
+    Ranked full-text search over posts, comments and users:
+    ``?q=<words>[&kind=post|comment|user][&limit=20][&offset=0]``.
+    """
+    serializer_class = SearchResultSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')[:settings.SEARCH_MAX_QUERY_LENGTH]
+        kind = request.query_params.get('kind')
+        if kind and kind not in dict(SearchDocument.KIND_CHOICES):
+            raise ValidationError({'kind': f'Unknown kind {kind!r}.'})
+        limit = _bounded_int(request.query_params.get('limit'), settings.SEARCH_PAGE_SIZE, settings.SEARCH_MAX_LIMIT)
+        offset = min(_bounded_int(request.query_params.get('offset'), 0), settings.SEARCH_MAX_OFFSET)
+        documents = search(query, kind, limit + 1, offset)
+        next_url = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_url = replace_query_param(request.build_absolute_uri(), 'offset', offset + limit)
+        return Response({'next': next_url, 'results': self.get_serializer(documents, many=True).data})
+
+
 class PostLikeListAPIView(generics.ListAPIView):
     queryset = PostLike.objects.all()
     serializer_class = PostLikeListSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
 class PostLikeDetailAPIView(generics.RetrieveAPIView):
-    queryset = PostLike.objects.all()
+    queryset = PostLike.objects.select_related('user')
     serializer_class = PostLikeDetailSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
 
 class CommentCreateAPIView(generics.CreateAPIView):
@@ -116,14 +307,85 @@ class CommentCreateAPIView(generics.CreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
 class CommentListAPIView(generics.ListAPIView):
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related('user')
     serializer_class = CommentListSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
 class CommentDetailAPIView(generics.RetrieveAPIView):
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related('user')
     serializer_class = CommentDetailSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+class CommentTreeAPIView(generics.GenericAPIView):
+    """
+    Reply tree of a post, or of one comment with ?root=<id>. Each level
+    shows at most ?limit= replies ordered by path; ?after=<path> continues
+    a level and ?depth= bounds how many levels are returned.
+    """
+    serializer_class = CommentTreeSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 4
+
+    def get(self, request, pk, *args, **kwargs):
+        depth = _bounded_int(request.query_params.get('depth'), 2, settings.COMMENT_TREE_MAX_DEPTH)
+        limit = _bounded_int(request.query_params.get('limit'), 10, settings.COMMENT_TREE_MAX_LIMIT)
+        after = request.query_params.get('after', '')
+        prefix, base_depth = '', 0
+        if request.query_params.get('root'):
+            root = get_object_or_404(Comment, pk=_bounded_int(request.query_params['root'], 0), post_id=pk)
+            prefix, base_depth = root.path, root.depth + 1
+
+        level = Comment.objects.select_related('user').filter(post_id=pk, depth=base_depth,
+                                                              path__startswith=prefix, path__gt=after)
+        top = list(level.order_by('path')[:limit + 1])
+        has_more = len(top) > limit
+        top = top[:limit]
+
+        nodes = list(top)
+        if top and depth > 1:
+            nodes += (Comment.objects.select_related('user')
+                      .filter(post_id=pk, path__gt=top[0].path, path__lt=top[-1].path + '~',
+                              depth__gt=base_depth, depth__lt=base_depth + depth)
+                      .order_by('path')[:settings.COMMENT_TREE_MAX_NODES])
+
+        data = {node.pk: item for node, item in zip(nodes, self.get_serializer(nodes, many=True).data)}
+        children = {}
+        for node in nodes[len(top):]:
+            children.setdefault(node.parent_id, []).append(node)
+        for node in nodes:
+            if node.depth == base_depth + depth - 1:
+                continue
+            replies = children.get(node.pk, [])[:limit]
+            data[node.pk]['replies'] = [data[reply.pk] for reply in replies]
+            data[node.pk]['replies_next'] = None
+            if node.count_reply > len(replies):
+                data[node.pk]['replies_next'] = self._level_url(request, node.pk, replies[-1].path if replies else '')
+
+        next_url = None
+        if has_more:
+            next_url = self._level_url(request, request.query_params.get('root'), top[-1].path)
+        return Response({'next': next_url, 'results': [data[node.pk] for node in top]})
+
+    def _level_url(self, request, root, after):
+        url = request.build_absolute_uri()
+        if root:
+            url = replace_query_param(url, 'root', root)
+        return replace_query_param(url, 'after', after)
+
+
+def _bounded_int(value, default, maximum=None):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    if value < 1:
+        return default
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
 
 
 class CommentLikeCreateAPIView(generics.CreateAPIView):
@@ -131,15 +393,22 @@ class CommentLikeCreateAPIView(generics.CreateAPIView):
     serializer_class = CommentLikeSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+class CommentLikeSetAPIView(LikeSetAPIView):
+    like_model = CommentLike
+    counter = 'count_comment_like'
+
+
 class CommentLikeListAPIView(generics.ListAPIView):
     queryset = CommentLike.objects.all()
     serializer_class = CommentLikeListSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
 class CommentLikeDetailAPIView(generics.RetrieveAPIView):
-    queryset = CommentLike.objects.all()
+    queryset = CommentLike.objects.select_related('user')
     serializer_class = CommentLikeDetailSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
 
 class StoryCreateAPIView(generics.CreateAPIView):
@@ -148,23 +417,69 @@ class StoryCreateAPIView(generics.CreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
 class StoryListAPIView(generics.ListAPIView):
-    queryset = Story.objects.all()
+    queryset = Story.objects.active().select_related('user')
     serializer_class = StoryListSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
+
+class ActiveStoryAPIView(generics.GenericAPIView):
+    """
+    Active stories of followed accounts, one group per author, the most
+    recently updated author first; ``?cursor=`` continues after
+    STORY_GROUP_PAGE_SIZE authors.
+    """
+    serializer_class = ActiveStoryGroupSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = 3
+    group_ordering = ('-latest', '-user_id')
+
+    def get(self, request, *args, **kwargs):
+        following = Follow.objects.filter(follower=request.user).values('following_id')
+        authors = (Story.objects.active().filter(user_id__in=following).values('user_id')
+                   .annotate(latest=Max('created_at')).order_by(*self.group_ordering))
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            after = decode_cursor(cursor, Story, ('-created_at', '-user_id'))
+            if after is None:
+                raise NotFound('Invalid cursor')
+            authors = authors.filter(keyset_filter(self.group_ordering, after))
+        page_size = settings.STORY_GROUP_PAGE_SIZE
+        authors = list(authors.values_list('user_id', 'latest')[:page_size + 1])
+        next_url = None
+        if len(authors) > page_size:
+            authors = authors[:page_size]
+            user_id, latest = authors[-1]
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', encode_cursor((latest, user_id)))
+
+        groups = {user_id: {'stories': []} for user_id, _ in authors}
+        stories = (Story.objects.active().filter(user_id__in=groups)
+                   .select_related('user').order_by('user_id', 'created_at', 'id'))
+        for story in stories:
+            groups[story.user_id]['user'] = story.user
+            groups[story.user_id]['stories'].append(story)
+        # A story may have expired between the two queries
+        groups = [group for group in groups.values() if group['stories']]
+        return Response({'next': next_url, 'results': self.get_serializer(groups, many=True).data})
 
 class StoryDetailAPIView(generics.RetrieveAPIView):
-    queryset = Story.objects.all()
+    queryset = Story.objects.select_related('user')
     serializer_class = StoryDetailSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
 
 class SaveListAPIView(generics.ListAPIView):
     queryset = Save.objects.all()
     serializer_class = SaveSerializer
     permission_classes = [permissions.IsAuthenticated]
+    cursor_ordering = ('-id',)
+    query_budget = 3
 
     def get_queryset(self):
-        return UserProfile.objects.filter(user=self.request.user)
+        return Save.objects.filter(user=self.request.user).select_related('user').prefetch_related(
+            Prefetch('save_item', queryset=SaveItem.objects.select_related('post__user')
+                     .order_by('-created_date', '-id')),
+        )
 
     def retrieve(self, request, *args, **kwargs ):
         save, created = Save.objects.get_or_create(user=request.user)
@@ -173,8 +488,154 @@ class SaveListAPIView(generics.ListAPIView):
 
 
 
+class ChatInboxAPIView(generics.ListAPIView):
+    serializer_class = ChatInboxSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    cursor_ordering = ('-last_message_at', '-id')
+    query_budget = 3
+
+    def get_queryset(self):
+        user = self.request.user
+        return (Chat.objects.filter(person=user)
+                .select_related('last_message__author')
+                .annotate(own_read=FilteredRelation('reads', condition=Q(reads__user=user)),
+                          unread_count=Coalesce(F('own_read__unread_count'), 0))
+                .prefetch_related('person'))
+
+
+def _member_chat(request, pk):
+    return get_object_or_404(Chat.objects.filter(person=request.user), pk=pk)
+
+
+class ChatMessageListAPIView(generics.ListAPIView):
+    """Chat history, newest first; ?before=<message id> starts below that message."""
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    cursor_ordering = ('-created_date', '-id')
+    query_budget = 4
+
+    def get_queryset(self):
+        chat = _member_chat(self.request, self.kwargs['pk'])
+        messages = Message.objects.filter(chat=chat).select_related('author')
+        before = self.request.query_params.get('before')
+        if before:
+            anchor = get_object_or_404(Message.objects.filter(chat=chat), pk=_bounded_int(before, 0))
+            messages = messages.filter(keyset_filter(self.cursor_ordering, (anchor.created_date, anchor.pk)))
+        return messages
+
+
+class ChatReadAPIView(generics.GenericAPIView):
+    serializer_class = ChatReadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk, *args, **kwargs):
+        chat = _member_chat(request, pk)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message = None
+        if 'message' in serializer.validated_data:
+            message = get_object_or_404(Message.objects.filter(chat=chat), pk=serializer.validated_data['message'])
+        return Response({'unread_count': mark_read(chat, request.user, message)})
+
+
+class ChatPresenceAPIView(generics.GenericAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk, *args, **kwargs):
+        chat = _member_chat(request, pk)
+        members = list(chat.person.values_list('pk', flat=True))
+        return Response([{'user': user_id, **state} for user_id, state in get_presence(members).items()])
+
+
+class UploadCreateAPIView(generics.CreateAPIView):
+    """Start a resumable upload; the response says how to cut the file into chunks."""
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        upload = serializer.save(user=self.request.user, chunk_size=settings.UPLOADS['CHUNK_SIZE'])
+        uploads.create_temp_file(upload)
+
+
+class UploadDetailAPIView(generics.RetrieveDestroyAPIView):
+    """Upload progress, for resuming; DELETE abandons the upload."""
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return Upload.objects.filter(user=self.request.user)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        uploads.remove_temp_file(instance)
+
+
+class UploadChunkAPIView(generics.GenericAPIView):
+    """
+    PUT the raw bytes of chunk ``number`` with its hex SHA-256 in the
+    X-Checksum-SHA256 header.
+    """
+    serializer_class = UploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def put(self, request, pk, number, *args, **kwargs):
+        upload = get_object_or_404(Upload.objects.filter(user=request.user), pk=pk)
+        checksum = request.headers.get('X-Checksum-SHA256')
+        if not checksum:
+            return Response({'checksum': 'The X-Checksum-SHA256 header is required.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        length = _bounded_int(request.headers.get('Content-Length'), 0)
+        # Read the raw stream; request.data would buffer the whole body
+        uploads.write_chunk(upload, number, request.stream, length, checksum)
+        serializer = self.get_serializer(upload)
+        return Response(serializer.data)
+
+
+class UploadCompleteAPIView(generics.GenericAPIView):
+    """
+    Attach a fully received upload to a new post, story or chat message.
+    Other fields of the target are sent along, e.g. ``description`` or ``chat`` and ``text``.
+    """
+    serializer_class = UploadCompleteSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    targets = {
+        'post': (PostSerializer, 'user'),
+        'story': (StorySerializer, 'user'),
+        'message': (MessageCreateSerializer, 'author'),
+    }
+
+    def post(self, request, pk, *args, **kwargs):
+        upload = get_object_or_404(Upload.objects.filter(user=request.user), pk=pk)
+        if upload.status != 'pending':
+            raise uploads.ChunkConflict('Upload is already complete.')
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        target_serializer_class, owner = self.targets[serializer.validated_data['target']]
+
+        data = {key: value for key, value in request.data.items() if key != 'target'}
+        data[owner] = request.user.pk
+        with uploads.assemble(upload) as media:
+            data[upload.kind] = media
+            with transaction.atomic():
+                if not Upload.objects.filter(pk=upload.pk, status='pending').update(status='complete'):
+                    raise uploads.ChunkConflict('Upload is already complete.')
+                target = target_serializer_class(data=data, context=self.get_serializer_context())
+                target.is_valid(raise_exception=True)
+                target.save(**{owner: request.user})
+        uploads.remove_temp_file(upload)
+        return Response(target.data, status=status.HTTP_201_CREATED)
+
+
+class ResponseCacheStatsAPIView(generics.GenericAPIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(response_cache_stats())
+
+
 class SaveItemDetailAPIView(generics.RetrieveDestroyAPIView):
-    queryset = SaveItem.objects.all()
+    queryset = SaveItem.objects.select_related('post__user')
     serializer_class = SaveItemSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = 2
 
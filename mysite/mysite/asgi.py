@@ -9,19 +9,30 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
-from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
+from instagram.middleware import JWTAuthMiddleware
 from instagram.routing import websocket_urlpatterns
+from instagram import follow_graph, typeahead
+from instagram.chat_buffer import lifespan
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+follow_graph.warm()
+typeahead.warm()
 
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
+        "http": django_asgi_app,
+        "lifespan": lifespan,
         "websocket": AuthMiddlewareStack(
-            URLRouter(
-                websocket_urlpatterns
+            JWTAuthMiddleware(
+                URLRouter(
+                    websocket_urlpatterns
+                )
+            )
         )
-    )
-})
\ No newline at end of file
+})
@@ -60,6 +60,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.locale.LocaleMiddleware',
+    'instagram.middleware.FollowFlagsMiddleware',
 ]
 
 ROOT_URLCONF = 'mysite.urls'
@@ -92,6 +93,41 @@ CHANNEL_LAYERS = {
     },
 }
 
+# CHANNEL_LAYER=memory runs chat in-process without Redis (tests, benchmarks)
+if os.getenv('CHANNEL_LAYER') == 'memory':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Chat messages are written behind in batches: every FLUSH_SIZE messages or
+# FLUSH_INTERVAL_MS, whichever comes first. Senders wait once MAX_PENDING
+# messages are queued in a worker.
+CHAT_BUFFER = {
+    'FLUSH_SIZE': 100,
+    'FLUSH_INTERVAL_MS': 50,
+    'MAX_PENDING': 10000,
+}
+
+# Sockets that opt into batching receive one frame per BATCH_INTERVAL_MS,
+# or sooner once BATCH_MAX_MESSAGES or BATCH_MAX_BYTES are waiting.
+CHAT_FRAMES = {
+    'BATCH_INTERVAL_MS': 10,
+    'BATCH_MAX_MESSAGES': 50,
+    'BATCH_MAX_BYTES': 64 * 1024,
+}
+
+# Chat presence: users count as online while a socket is open and its last
+# heartbeat is younger than TTL seconds. Sockets refresh the heartbeat at
+# most every HEARTBEAT seconds, and each user emits at most one typing
+# event per room every TYPING_INTERVAL seconds.
+PRESENCE = {
+    'TTL': 60,
+    'HEARTBEAT': 20,
+    'TYPING_INTERVAL': 3,
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
@@ -103,6 +139,45 @@ DATABASES = {
 }
 
 
+# Cache
+# Local memory by default (development and tests); set REDIS_URL to share
+# the cache between workers in production.
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+RESPONSE_CACHE = {
+    'ALIAS': 'default',
+    'ENABLED': True,
+}
+
+# Opt-in write-behind for post likes, see instagram/like_buffer.py. Needs a
+# cache shared with ``manage.py flush_likes``; TIMEOUT must outlast any
+# flusher downtime, or buffered likes are lost.
+LIKE_BUFFER = {
+    'ENABLED': os.getenv('LIKE_BUFFER') == '1',
+    'ALIAS': 'default',
+    'FLUSH_INTERVAL': 1,
+    'BATCH_SIZE': 1000,
+    'TIMEOUT': 60 * 60 * 24,
+    # How long the flusher waits for an event whose writer is still busy
+    'GAP_SECONDS': 60,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -153,6 +228,55 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Uploads are deduplicated by content, see instagram/storage.py
+STORAGES = {
+    'default': {
+        'BACKEND': 'instagram.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Media is served by instagram.media.serve_media. With SENDFILE set to
+# 'x-accel-redirect' (nginx) or 'x-sendfile' the proxy sends the bytes;
+# nginx needs an internal location at ACCEL_PREFIX aliased to MEDIA_ROOT.
+MEDIA_SERVING = {
+    'SENDFILE': os.environ.get('MEDIA_SENDFILE') or None,
+    'ACCEL_PREFIX': '/protected-media/',
+    'BLOCK_SIZE': 64 * 1024,
+}
+
+# Resized copies of uploaded images, rendered in background threads after
+# commit (see instagram/images.py). Set ASYNC to False to render them in
+# the committing thread instead.
+IMAGE_VARIANTS = {
+    'SIZES': {
+        'thumb': {'size': (150, 150), 'crop': True},
+        'small': {'size': (320, 320)},
+        'medium': {'size': (640, 640)},
+        'large': {'size': (1080, 1080)},
+    },
+    'FORMATS': ['webp', 'jpeg'],
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'ASYNC': True,
+}
+
+# Resumable uploads (instagram/uploads.py). Chunks are appended to files in
+# TEMP_DIR, which should be on the same filesystem as MEDIA_ROOT so that
+# completed uploads are moved into place instead of copied. Unfinished
+# uploads are purged after EXPIRE_HOURS by `manage.py purge_uploads`.
+UPLOADS = {
+    'CHUNK_SIZE': 5 * 1024 * 1024,
+    'MAX_SIZE': 1024 * 1024 * 1024,
+    'TEMP_DIR': os.path.join(BASE_DIR, 'upload_tmp'),
+    'EXPIRE_HOURS': 24,
+}
+
+# Largest batch accepted by post_like/set/ and comment_like/set/
+LIKE_SET_MAX_BATCH = 100
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -164,9 +288,70 @@ AUTH_USER_MODEL = 'instagram.UserProfile'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'instagram.pagination.KeysetPagination',
+    'PAGE_SIZE': 20,
 }
 
+# Home feed: accounts with more followers than FEED_FANOUT_LIMIT are merged
+# into timelines at read time instead of being fanned out on write.
+FEED_FANOUT_LIMIT = 10000
+FEED_FANOUT_BATCH = 1000
+FEED_BACKFILL = 20
+FEED_PAGE_SIZE = 20
+# Fan-out runs on FEED_FANOUT_WORKERS background threads (unless
+# FEED_FANOUT_ASYNC is off); ``manage.py trim_timelines`` keeps the newest
+# FEED_TIMELINE_LENGTH entries of every timeline.
+FEED_FANOUT_ASYNC = True
+FEED_FANOUT_WORKERS = 2
+FEED_TIMELINE_LENGTH = 800
+
+STORY_LIFETIME = timedelta(hours=24)
+# Authors per page of story/active/
+STORY_GROUP_PAGE_SIZE = 20
+
+# Username typeahead, see instagram/typeahead.py. Prefixes matching more
+# than SCAN_LIMIT users have their top MAX_LIMIT results memoized.
+TYPEAHEAD = {
+    'PAGE_SIZE': 10,
+    'MAX_LIMIT': 20,
+    'SCAN_LIMIT': 1000,
+    'REFRESH_SECONDS': 300,
+}
+
+# Journal that carries committed changes to every worker's typeahead and
+# follow graph, see instagram/local_index.py. Needs a cache shared by all
+# workers (set REDIS_URL); a worker that falls more than MAX_REPLAY entries
+# behind, or misses an entry for GAP_SECONDS, reloads instead.
+LOCAL_INDEX = {
+    'ALIAS': 'default',
+    'JOURNAL_TIMEOUT': 60 * 60,
+    'MAX_REPLAY': 10000,
+    'GAP_SECONDS': 5,
+}
+
+HASHTAG_MAX_PER_POST = 30
+
+# Suggestions kept per user by ``manage.py compute_follow_suggestions``
+FOLLOW_SUGGESTIONS_PER_USER = 50
+
+# In-process follow graph for is_following flags, see instagram/follow_graph.py.
+# Follows reach every worker through the LOCAL_INDEX journal on its next
+# request; REFRESH_SECONDS bounds how long anything the journal lost stays stale.
+FOLLOW_GRAPH = {
+    'REFRESH_SECONDS': 600,
+}
+
+# Full-text search, see instagram/search.py
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_LIMIT = 50
+SEARCH_MAX_OFFSET = 1000
+SEARCH_MAX_QUERY_LENGTH = 200
+
+COMMENT_TREE_MAX_DEPTH = 5
+COMMENT_TREE_MAX_LIMIT = 50
+COMMENT_TREE_MAX_NODES = 1000
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=20),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
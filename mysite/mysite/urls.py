@@ -15,12 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
-from django.conf.urls.static import static
 from django.conf.urls.i18n import i18n_patterns
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
+from instagram.media import serve_media
 
 
 schema_view = get_schema_view(
@@ -36,4 +36,6 @@ urlpatterns = i18n_patterns(
     path('admin/', admin.site.urls),
     path('', include('instagram.urls')),
     path('docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-) + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+) + [
+    re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), serve_media, name='media'),
+]